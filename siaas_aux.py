@@ -10,17 +10,47 @@ import sys
 import re
 import json
 import socket
+import threading
+import time
+import siaas_cache
+import siaas_logging
+import siaas_metrics
+import siaas_mongo
 from copy import copy
 from datetime import datetime, timedelta
-from pymongo import MongoClient
-from urllib.parse import quote_plus
+from bson.objectid import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 
 logger = logging.getLogger(__name__)
 
+# Collection (in the same DB as the main collection) with the latest data snapshot of each agent
+AGENT_LATEST_COLLECTION = "agent_latest"
+
+# Collection (in the same DB as the main collection) with a version counter for each data scope, bumped on every write
+DATA_VERSIONS_COLLECTION = "data_versions"
+# Deferred version bumps of this process (scope -> collection), written together by a background thread, after a short delay
+PENDING_DATA_VERSIONS = {}
+PENDING_DATA_VERSIONS_LOCK = threading.Lock()
+PENDING_DATA_VERSIONS_EVENT = threading.Event()
+DATA_VERSIONS_THREAD = None
+DATA_VERSIONS_DELAY_SEC = 0.5
+
+# Maximum size of data dumps in debug logs (bigger dumps are truncated)
+LOG_DATA_MAX_CHARS = 4096
+# Only data smaller than this is pretty-printed in debug logs (pretty-printing is slow)
+LOG_DATA_PRETTY_MAX_CHARS = 1024
+LOG_DATA_MAX_DEPTH = 6
+
+# In-memory cache of parsed local DB files (path -> (file signature, parsed dict))
+LOCAL_FILE_CACHE = {}
+LOCAL_FILE_CACHE_LOCK = threading.Lock()
+
 
 def merge_module_dicts(modules=""):
     """
     Grabs all local DBs (dicts) from the module list and concatenates them
+    Local DBs are read from the in-memory cache, so each module dict is copied before being returned
     Returns False if it fails
     """
     merged_dict = {}
@@ -28,10 +58,10 @@ def merge_module_dicts(modules=""):
         next_dict_to_merge = {}
         module = module.strip()
         try:
-            module_dict = read_from_local_file(
+            module_dict = read_from_local_file_cached(
                 os.path.join(sys.path[0], 'var/'+str(module)+'.db'))
             if module_dict != None:
-                next_dict_to_merge[module] = module_dict
+                next_dict_to_merge[module] = dict(module_dict)
                 merged_dict = dict(
                     list(merged_dict.items())+list(next_dict_to_merge.items()))
         except:
@@ -57,6 +87,9 @@ def merge_configs_from_upstream(local_dict=os.path.join(sys.path[0], 'var/config
     delta_dict = {}
     protected_configs = ["log_level", "mongo_collection", "mongo_db",
                          "mongo_host", "mongo_port", "mongo_pwd", "mongo_user"]
+    protected_configs += [config_name for (config_name, convert, default)
+                          in siaas_mongo.MONGO_CLIENT_OPTIONS.values()]
+    protected_configs += siaas_logging.LOG_CONFIGS
     try:
         local_config_dict = get_config_from_configs_db(local_dict=local_dict)
         if type(upstream_dict) is not dict:
@@ -68,8 +101,8 @@ def merge_configs_from_upstream(local_dict=os.path.join(sys.path[0], 'var/config
         if len(upstream_dict) > 0:
             merged_config_dict = dict(
                 list(local_config_dict.items())+list(upstream_dict.items()))
-            logger.debug(
-                "The following configurations are being applied/overwritten from the server: "+str(upstream_dict))
+            log_debug_data(
+                "The following configurations are being applied/overwritten from the server:", upstream_dict)
         else:
             merged_config_dict = dict(
                 list(local_config_dict.items()))
@@ -88,33 +121,28 @@ def get_config_from_configs_db(local_dict=os.path.join(sys.path[0], 'var/config.
     Reads a configuration value from the configs db
     If the intput is "None" it returns an entire dict with all the values. Returns an empty dict if there are no configs
     If the input is a specific config key, it returns the value for that config key. Returns None if the config key does not exist
+    The configs db is parsed once and kept in memory, until the file changes on disk or the cache is invalidated
     """
     if config_name == None:
 
         logger.debug("Getting configuration dictionary from local DB ...")
-        config_dict = read_from_local_file(
+        config_dict = read_from_local_file_cached(
             local_dict)
         if not isinstance(config_dict, dict):
             logger.error(
                 "Configuration dictionary from the local DB is not in a valid format. Returning nothing.")
             return {}
         if len(config_dict or '') > 0:
-            out_dict = {}
-            for k in config_dict.keys():
-                if convert_to_string:
-                    out_dict[k] = str(config_dict[k])
-                else:
-                    out_dict[k] = config_dict[k]
-            return config_dict
+            return dict(config_dict)
 
         logger.error("Couldn't get configuration dictionary from local DB.")
         return {}
 
     else:
 
-        logger.debug("Getting configuration value '" +
-                     config_name+"' from local DB ...")
-        config_dict = read_from_local_file(
+        logger.debug(
+            "Getting configuration value '%s' from local DB ...", config_name)
+        config_dict = read_from_local_file_cached(
             local_dict)
         if not isinstance(config_dict, dict):
             logger.error(
@@ -122,13 +150,10 @@ def get_config_from_configs_db(local_dict=os.path.join(sys.path[0], 'var/config.
             return None
         if len(config_dict or '') > 0:
             if config_name in config_dict.keys():
-                value = config_dict[config_name]
-                if convert_to_string:
-                    value = str(value)
                 return config_dict[config_name]
 
-        logger.debug("Couldn't get configuration named '" +
-                     config_name+"' from local DB. Maybe it doesn't exist.")
+        logger.debug(
+            "Couldn't get configuration named '%s' from local DB. Maybe it doesn't exist.", config_name)
         return None
 
 
@@ -169,6 +194,7 @@ def write_config_db_from_conf_file(conf_file=os.path.join(sys.path[0], 'conf/sia
     return write_to_local_file(output, dict(sorted(config_dict.items(), key=lambda x: x[0].casefold() if len(x or "") > 0 else None)))
 
 
+@siaas_metrics.time_db_operation
 def get_dict_current_server_configs(collection):
     """
     Reads server configs from the Mongo DB collection
@@ -199,6 +225,7 @@ def get_dict_current_server_configs(collection):
     return out_dict
 
 
+@siaas_metrics.time_db_operation
 def create_or_update_server_configs(collection, config_dict=None, orig_ip="127.0.0.1", convert_to_string=True):
     """
     Receives a dict with server configs, validates it, and calls the mongodb insertion function to insert it
@@ -260,39 +287,38 @@ d or malicious data
     complete_dict["timestamp"] = get_now_utc_obj()
 
     result = create_or_update_in_mongodb_collection(collection, complete_dict)
+    if result:
+        bump_data_versions(collection, ["server_configs"])
 
     logger.info("Server configs upload to the DB finished.")
 
     return result
 
 
-def upload_agent_data(collection, agent_uid=None, data_dict=None, orig_ip="127.0.0.1"):
+def build_agent_data_record(agent_uid=None, data_dict=None, orig_ip="127.0.0.1"):
     """
-    Receives a dict with agent data, validates it, and calls the mongodb insertion function to insert it
-    Returns True if all OK; False if NOK
+    Receives a dict with agent data, validates it, and builds the DB record to be inserted
+    Returns the record dict if all OK; None if the agent UID or the data dict are not valid
     """
 
     if data_dict == None:
         data_dict = {}
 
-    logger.info(
-        "Agent data received and now being uploaded to the DB ["+str(agent_uid)+"] ...")
-
     if type(data_dict) is not dict:
         logger.error(
             "No valid agent data dict received. No agent data was uploaded.")
-        return False
+        return None
 
     for k in data_dict.keys():
         if not validate_string_key(k):
             logger.error("Agent data dict has an invalid key: " +
-                         k+". No agent data was uploaded.")
-            return False
+                         str(k)+". No agent data was uploaded.")
+            return None
 
     if not validate_string_key(agent_uid):
-        logger.error("Agent UID '" + agent_uid +
+        logger.error("Agent UID '" + str(agent_uid) +
                      "' is not valid. No agent data was uploaded.")
-        return False
+        return None
 
     # Create a new dict with a date object and date transfer direction so we can easily filter it and order entries in MongoDB
 
@@ -306,6 +332,7 @@ def upload_agent_data(collection, agent_uid=None, data_dict=None, orig_ip="127.0
     # timestamp - Data object with creation timestamp of the record
 
     complete_dict = {}
+    complete_dict["_id"] = ObjectId()
     complete_dict["scope"] = "agent_data"
     complete_dict["origin"] = "agent_"+agent_uid.lower()
     complete_dict["destiny"] = "server"
@@ -313,16 +340,90 @@ def upload_agent_data(collection, agent_uid=None, data_dict=None, orig_ip="127.0
     complete_dict["orig_ip"] = str(orig_ip)
     complete_dict["timestamp"] = get_now_utc_obj()
 
+    return complete_dict
+
+
+@siaas_metrics.time_db_operation
+def upload_agent_data(collection, agent_uid=None, data_dict=None, orig_ip="127.0.0.1"):
+    """
+    Receives a dict with agent data, validates it, and calls the mongodb insertion function to insert it
+    Returns True if all OK; False if NOK
+    """
+
+    logger.info(
+        "Agent data received and now being uploaded to the DB ["+str(agent_uid)+"] ...")
+
+    complete_dict = build_agent_data_record(agent_uid, data_dict, orig_ip)
+    if complete_dict == None:
+        return False
+
     result = insert_in_mongodb_collection(collection, complete_dict)
+    if result:
+        update_agent_latest(collection, [complete_dict])
 
     logger.info("Agent data upload to the DB finished ["+str(agent_uid)+"].")
 
     return result
-    
-    
+
+
+@siaas_metrics.time_db_operation
+def upload_agent_data_bulk(collection, items=None, orig_ip="127.0.0.1"):
+    """
+    Receives a list of agent data items ({"agent_uid": <uid>, "data": <data dict>}), validates each one, and inserts all valid ones at once
+    Invalid or failed items don't prevent the others from being inserted
+    Returns a list with a result for each item (in the same order), or False if the input is not a list
+    """
+
+    logger.info("Agent data bulk received and now being uploaded to the DB ...")
+
+    if type(items) is not list:
+        logger.error(
+            "No valid agent data list received. No agent data was uploaded.")
+        return False
+
+    results = []
+    records = []
+    record_indexes = []
+    for i, item in enumerate(items):
+        agent_uid = None
+        complete_dict = None
+        if type(item) is dict:
+            agent_uid = item.get("agent_uid")
+            complete_dict = build_agent_data_record(
+                agent_uid, item.get("data"), orig_ip)
+        if complete_dict == None:
+            results.append({"index": i, "agent_uid": str(agent_uid),
+                           "status": "failure", "error": "invalid agent UID or data dict"})
+            continue
+        results.append({"index": i, "agent_uid": agent_uid,
+                       "status": "success", "id": str(complete_dict["_id"])})
+        records.append(complete_dict)
+        record_indexes.append(i)
+
+    failed_records = insert_many_in_mongodb_collection(collection, records)
+    if failed_records == False:
+        failed_records = {r: "insertion failed" for r in range(len(records))}
+
+    inserted_records = []
+    for r, record in enumerate(records):
+        if r in failed_records.keys():
+            results[record_indexes[r]] = {"index": record_indexes[r], "agent_uid": results[record_indexes[r]]
+                                          ["agent_uid"], "status": "failure", "error": failed_records[r]}
+        else:
+            inserted_records.append(record)
+    update_agent_latest(collection, inserted_records)
+
+    logger.info("Agent data bulk upload to the DB finished. " +
+                str(len(inserted_records))+" of "+str(len(items))+" records inserted.")
+
+    return results
+
+
+@siaas_metrics.time_db_operation
 def upload_zap_data(collection, data, orig_ip="127.0.0.1"):
     """
     Receives a dict with agent data, validates it, and calls the mongodb insertion function to insert it
+    Results are unique per target, so results for an existing target replace the previous ones
     Returns True if all OK; False if NOK
     """
 
@@ -332,13 +433,20 @@ def upload_zap_data(collection, data, orig_ip="127.0.0.1"):
     logger.info(
         "Agent data received and now being uploaded to the DB...")
 
-    result = insert_in_mongodb_collection(collection, data)
+    if isinstance(data, dict) and "target" in data.keys():
+        result = replace_in_mongodb_collection(
+            collection, {"target": data["target"]}, data)
+    else:
+        result = insert_in_mongodb_collection(collection, data)
+    if result:
+        bump_data_versions(collection, ["zap_results"])
 
     logger.info("Agent data upload to the DB finished.")
 
     return result
 
 
+@siaas_metrics.time_db_operation
 def create_or_update_agent_configs(collection, agent_uid=None, config_dict=None, orig_ip="127.0.0.1", convert_to_string=True):
     """
     Receives a dict with agent configs, validates it, and calls the mongodb insertion function to insert it
@@ -415,6 +523,7 @@ def create_or_update_agent_configs(collection, agent_uid=None, config_dict=None,
 
         if not create_or_update_in_mongodb_collection(collection, complete_dict):
             result = False
+    bump_data_versions(collection, ["agent_configs"])
 
     logger.info(
         "Agent configs upload to the DB finished ["+str(agent_uid)+"].")
@@ -422,23 +531,25 @@ def create_or_update_agent_configs(collection, agent_uid=None, config_dict=None,
     return result
 
 
+@siaas_metrics.time_db_operation
 def get_dict_active_agents(collection, sort_by="date"):
     """
-    Reads a list of active agents. Returns nickname and description if they exist in configs DB
+    Reads a list of active agents from the latest agent snapshot collection. Returns nickname and description if they exist in configs DB
+    The latest published configs of all these agents are read in one batched query (by the scope/destiny index), so only two queries are made
     Returns a list of records. Returns False if data can't be read
     """
     logger.debug("Reading data from the DB server ...")
     out_dict = {}
 
     try:
-        cursor = collection.aggregate([
-            {"$match": {"origin": {"$regex": "^agent_"}}},
-            {"$group": {"_id": {"origin": "$origin"}, "origin": {
-                "$last": "$origin"}, "timestamp": {"$last": "$timestamp"},
-                "orig_ip": {"$last": "$orig_ip"}}},
-            {"$sort": {"timestamp": -1}}
-        ])
-        results = list(cursor)
+        results = list(get_agent_latest_collection(collection).find(
+            {}, {"origin": 1, "timestamp": 1, "orig_ip": 1}).sort("timestamp", -1))
+        agent_configs = {}
+        origins = [r["origin"] for r in results if "origin" in r.keys()]
+        if len(origins) > 0:
+            for r in collection.find({"scope": "agent_configs", "destiny": {"$in": origins}, "payload": {"$exists": True}},
+                                     {"destiny": 1, "payload.nickname": 1, "payload.description": 1}).sort("_id", -1):
+                agent_configs.setdefault(r["destiny"], r["payload"])  # only the latest configs of each agent matter
     except Exception as e:
         logger.error("Can't read data from the DB server: "+str(e))
         return False
@@ -447,19 +558,15 @@ def get_dict_active_agents(collection, sort_by="date"):
         try:
             uid = r["origin"].split("_", 1)[1]
             out_dict[uid] = {}
-            try:
-                out_dict[uid]["nickname"] = str(get_dict_current_agent_configs(
-                    collection, agent_uid=uid, merge_broadcast=False)[uid]["nickname"])
-            except:
-                pass
-            try:
-                out_dict[uid]["description"] = str(get_dict_current_agent_configs(
-                    collection, agent_uid=uid, merge_broadcast=False)[uid]["description"])
-            except:
-                pass
+            if r["origin"] in agent_configs.keys():
+                if "nickname" in agent_configs[r["origin"]].keys():
+                    out_dict[uid]["nickname"] = str(
+                        agent_configs[r["origin"]]["nickname"])
+                if "description" in agent_configs[r["origin"]].keys():
+                    out_dict[uid]["description"] = str(
+                        agent_configs[r["origin"]]["description"])
             out_dict[uid]["origin_ip"] = r["orig_ip"]
-            out_dict[uid]["last_seen"] = r["timestamp"].strftime(
-                '%Y-%m-%dT%H:%M:%SZ')
+            out_dict[uid]["last_seen"] = r["timestamp"]
         except:
             logger.debug(
                 "Ignoring invalid entry when grabbing active agents data.")
@@ -471,6 +578,64 @@ def get_dict_active_agents(collection, sort_by="date"):
     return out_dict
 
 
+def get_payload_projection(module=None):
+    """
+    Returns the DB projection that only fetches the selected modules from the payload (comma-separated), so other modules are never transferred
+    Returns None (fetch everything) if no modules or no valid module names are selected
+    """
+    if module == None:
+        return None
+    projection = {"scope": 1, "origin": 1, "destiny": 1,
+                  "orig_ip": 1, "timestamp": 1}
+    valid_module = False
+    for m in sorted(set(module.lower().split(','))):
+        mod = m.strip()
+        if validate_string_key(mod):
+            projection["payload."+mod] = 1
+            valid_module = True
+    if not valid_module:
+        return None
+    return projection
+
+
+def find_history_agent_data(collection, agent_uid=None, module=None, limit_outputs=99999, days=99999, older_first=False, after=None, batch_size=None):
+    """
+    Builds the query for historical agent data in the Mongo DB collection, ordered by record ID
+    If modules are selected, only those modules are fetched from the payload
+    The "after" cursor token (a record ID) continues from where a previous page ended (keyset pagination)
+    Returns the DB cursor. Raises an exception if the inputs are invalid
+    """
+    if older_first:
+        id_sort_type = 1
+    else:
+        id_sort_type = -1
+
+    if(int(limit_outputs) < 0):
+        limit_outputs = 0
+    last_d = datetime.utcnow() - timedelta(days=int(days))
+
+    query_list = [{"payload": {'$exists': True}}, {
+        "scope": "agent_data"}, {"timestamp": {"$gte": last_d}}]
+    if agent_uid != None:
+        agent_list = []
+        for u in agent_uid.split(','):
+            agent_list.append("agent_"+u.strip().lower())
+        query_list.append({"origin": {'$in': agent_list}})
+    if len(after or '') > 0:
+        if not validate_cursor_token(after):
+            raise ValueError("Invalid cursor token: "+str(after))
+        if older_first:
+            query_list.append({"_id": {"$gt": ObjectId(after)}})
+        else:
+            query_list.append({"_id": {"$lt": ObjectId(after)}})
+
+    cursor = collection.find({'$and': query_list}, get_payload_projection(module)).sort(
+        '_id', id_sort_type).limit(int(limit_outputs))
+    if batch_size != None:
+        cursor = cursor.batch_size(int(batch_size))
+    return cursor
+
+
 def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_outputs=99999, days=99999, sort_by="date", older_first=False, hide_empty=False):
     """
     Reads historical agent data from the Mongo DB collection
@@ -478,50 +643,37 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
     We can sort, select a day limit, limit outputs, order by older records first, and hide empty records
     Returns a list of records. Returns False if data can't be read
     """
+    out_dict, next_token = get_dict_history_agent_data_page(collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs,
+                                                            days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty)
+    return out_dict
+
+
+@siaas_metrics.time_db_operation
+def get_dict_history_agent_data_page(collection, agent_uid=None, module=None, limit_outputs=99999, days=99999, sort_by="date", older_first=False, hide_empty=False, after=None):
+    """
+    Reads a page of historical agent data from the Mongo DB collection (same inputs as get_dict_history_agent_data)
+    The "after" cursor token continues from where the previous page ended
+    Returns the records and the cursor token for the next page (None if there are no more records). Returns False and None if data can't be read
+    """
     logger.debug("Reading data from the DB server ...")
     out_dict = {}
+    next_token = None
 
     if sort_by.lower() == "agent":
         sort_field = "origin"
     else:
         sort_field = "_id"
 
-    if older_first:
-        id_sort_type = 1
-    else:
-        id_sort_type = -1
-
-    if agent_uid == None:
-        try:
-            if(int(limit_outputs) < 0):
-                limit_outputs = 0
-            last_d = datetime.utcnow() - timedelta(days=int(days))
-            cursor = collection.find(
-                {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"}, {"timestamp": {"$gte": last_d}}
-                          ]}
-            ).sort('_id', id_sort_type).limit(int(limit_outputs))
-            results = list(cursor)
-        except Exception as e:
-            logger.error("Can't read data from the DB server: "+str(e))
-            return False
+    try:
+        cursor = find_history_agent_data(collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs,
+                                         days=days, older_first=older_first, after=after)
+        results = list(cursor)
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False, None
 
-    else:
-        results = []
-        agent_list = []
-        for u in agent_uid.split(','):
-            agent_list.append("agent_"+u.strip().lower())
-        try:
-            if(int(limit_outputs) < 0):
-                limit_outputs = 0
-            last_d = datetime.utcnow() - timedelta(days=int(days))
-            cursor = collection.find(
-                {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"}, {
-                    "timestamp": {"$gte": last_d}}, {"origin": {'$in': agent_list}}]}
-            ).sort('_id', id_sort_type).limit(int(limit_outputs))
-            results = results+list(cursor)
-        except Exception as e:
-            logger.error("Can't read data from the DB server: "+str(e))
-            return False
+    if int(limit_outputs) > 0 and len(results) >= int(limit_outputs):
+        next_token = str(results[-1]["_id"])
 
     if sort_field == "origin":
         for r in results:
@@ -567,8 +719,6 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
                             mod = m.strip()
                             if mod in r["payload"].keys():
                                 out_dict[timestamp][uid][mod] = r["payload"][mod]
-                    out_dict[timestamp] = dict(sorted(out_dict[timestamp].items(
-                    ), key=lambda x: x[0].casefold() if len(x or "") > 0 else None))
                     if hide_empty:
                         for k in list(out_dict[timestamp][uid].keys()):
                             if len(out_dict[timestamp][uid][k]) == 0:
@@ -578,51 +728,83 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
             except:
                 logger.debug(
                     "Ignoring invalid entry when grabbing agent data.")
+        for k in out_dict.keys():  # agents are sorted once per timestamp, after all records are in
+            if len(out_dict[k]) > 1:
+                out_dict[k] = dict(sorted(out_dict[k].items(
+                ), key=lambda x: x[0].casefold() if len(x or "") > 0 else None))
 
     if hide_empty:
         for k in list(out_dict.keys()):
             if len(out_dict[k]) == 0:
                 out_dict.pop(k, None)
 
-    return out_dict
+    return out_dict, next_token
+
+
+def iter_history_agent_data(collection, agent_uid=None, module=None, limit_outputs=99999, days=99999, older_first=False, hide_empty=False, after=None, batch_size=500):
+    """
+    Yields historical agent data records one by one, as the DB cursor produces them (records are not grouped nor sorted by agent)
+    Each record is a dict with "id" (also usable as a cursor token), "agent", "timestamp" (a datetime, serialized by siaas_json) and "data"
+    Raises an exception if data can't be read
+    """
+    logger.debug("Streaming data from the DB server ...")
+    cursor = find_history_agent_data(collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs,
+                                     days=days, older_first=older_first, after=after, batch_size=batch_size)
+    for r in cursor:
+        try:
+            if not r["origin"].startswith("agent_"):
+                continue
+            if module == None:
+                data = r["payload"]
+            else:
+                data = {}
+                for m in sorted(set(module.lower().split(','))):
+                    mod = m.strip()
+                    if mod in r["payload"].keys():
+                        data[mod] = r["payload"][mod]
+            if hide_empty:
+                for k in list(data.keys()):
+                    if len(data[k]) == 0:
+                        data.pop(k, None)
+                if len(data) == 0:
+                    continue
+            yield {"id": str(r["_id"]), "agent": r["origin"].split("_", 1)[1], "timestamp": r["timestamp"], "data": data}
+        except:
+            logger.debug("Ignoring invalid entry when grabbing agent data.")
 
 
+@siaas_metrics.time_db_operation
 def get_dict_current_agent_data(collection, agent_uid=None, module=None):
     """
-    Reads agent data from the Mongo DB collection
-    We can select a list of agents and modules to display
+    Reads the latest agent data from the latest agent snapshot collection
+    We can select a list of agents and modules to display (only the selected modules are fetched from the DB)
     Returns a list of records. Returns False if data can't be read
     """
     logger.debug("Reading data from the DB server ...")
     out_dict = {}
 
+    latest_collection = get_agent_latest_collection(collection)
+
     if agent_uid == None:
         try:
-            cursor = collection.aggregate([
-                {"$match": {
-                    '$and': [{"origin": {"$regex": "^agent_"}}, {"scope": "agent_data"}]}},
-                {"$group": {"_id": {"origin": "$origin"}, "scope": {"$last": "$scope"}, "origin": {"$last": "$origin"}, "destiny": {
-                    "$last": "$destiny"}, "payload": {"$last": "$payload"}, "timestamp": {"$last": "$timestamp"}}},
-                {"$sort": {"origin": 1}}
-            ])
+            cursor = latest_collection.find(
+                {"scope": "agent_data"}, get_payload_projection(module)).sort('_id', 1)
             results = list(cursor)
         except Exception as e:
             logger.error("Can't read data from the DB server: "+str(e))
             return False
 
     else:
-        results = []
+        agent_list = []
         for u in agent_uid.split(','):
-            uid = u.strip().lower()
-            try:
-                cursor = collection.find(
-                    {'$and': [{"payload": {'$exists': True}}, {
-                        "scope": "agent_data"}, {"origin": "agent_"+uid}]}
-                ).sort('_id', -1).limit(1)
-                results = results+list(cursor)
-            except Exception as e:
-                logger.error("Can't read data from the DB server: "+str(e))
-                return False
+            agent_list.append("agent_"+u.strip().lower())
+        try:
+            cursor = latest_collection.find(
+                {'$and': [{"scope": "agent_data"}, {"_id": {'$in': agent_list}}]}, get_payload_projection(module))
+            results = list(cursor)
+        except Exception as e:
+            logger.error("Can't read data from the DB server: "+str(e))
+            return False
 
     for r in results:
         try:
@@ -645,6 +827,28 @@ def get_dict_current_agent_data(collection, agent_uid=None, module=None):
     return out_dict
 
 
+@siaas_metrics.time_db_operation
+def get_dict_agent_latest_versions(collection):
+    """
+    Reads the history record ID of the latest data snapshot of each agent (no agent data is fetched)
+    The ID changes whenever an agent uploads new data, so it can be used to detect which agents changed
+    Returns a dict of agent UIDs and IDs (as strings). Returns False if data can't be read
+    """
+    logger.debug("Reading the latest agent data versions from the DB server ...")
+    out_dict = {}
+    try:
+        cursor = get_agent_latest_collection(collection).find(
+            {"scope": "agent_data"}, {"_id": 1, "history_id": 1}).sort('_id', 1)
+        for r in cursor:
+            if r["_id"].startswith("agent_"):
+                out_dict[r["_id"].split("_", 1)[1]] = str(r.get("history_id"))
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False
+    return out_dict
+
+
+@siaas_metrics.time_db_operation
 def get_dict_current_agent_configs(collection, agent_uid=None, merge_broadcast=False):
     """
     Reads agent configs from the Mongo DB collection
@@ -731,6 +935,7 @@ def get_dict_current_agent_configs(collection, agent_uid=None, merge_broadcast=F
     return out_dict
 
 
+@siaas_metrics.time_db_operation
 def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_to_keep=99999):
     """
     Delete records older than n-days
@@ -740,6 +945,12 @@ def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_t
     logger.debug("Removing data from the DB server ...")
     out_dict = {}
     count = 0
+    # if the latest snapshot of an agent is older than the deletion date, its whole history was deleted
+    update_latest = scope == None or scope == "agent_data"
+    if scope == None:
+        changed_scopes = ["agent_data", "agent_configs", "server_configs"]
+    else:
+        changed_scopes = [scope]
 
     if agent_uid == None:
         try:
@@ -756,6 +967,9 @@ def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_t
                               ]}
                 )
                 count += c.deleted_count
+            if update_latest:
+                count_latest = get_agent_latest_collection(collection).delete_many(
+                    {"timestamp": {"$lt": last_d}}).deleted_count
         except Exception as e:
             logger.error("Can't delete data from the DB server: "+str(e))
             return False
@@ -778,126 +992,305 @@ def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_t
                         '$or': [{"destiny": {'$in': agent_list}}, {"origin": {'$in': agent_list}}]}]}
                 )
                 count += c.deleted_count
+            if update_latest:
+                count_latest = get_agent_latest_collection(collection).delete_many(
+                    {'$and': [{"timestamp": {"$lt": last_d}}, {"_id": {'$in': agent_list}}]}).deleted_count
         except Exception as e:
             logger.error("Can't delete data from the DB server: "+str(e))
             return False
 
+    if count > 0 or (update_latest and count_latest > 0):
+        bump_data_versions(collection, changed_scopes)
+
     return count
 
 
+def get_agent_latest_collection(collection):
+    """
+    Returns the collection with the latest data snapshot of each agent (it lives in the same DB as the inputted collection)
+    """
+    return collection.database[AGENT_LATEST_COLLECTION]
+
+
+@siaas_metrics.time_db_operation
+def update_agent_latest(collection, agent_data_records):
+    """
+    Upserts agent data records (already inserted in the history collection) in the latest agent snapshot collection
+    Documents are keyed by the agent origin, and keep the history record ID in "history_id"
+    A snapshot is only replaced by a newer record (history IDs are created when the data is received), so delayed or retried writes can't overwrite it
+    Returns True if all OK; False if NOK
+    """
+    latest_records = {}
+    for r in agent_data_records:
+        if r["origin"] not in latest_records.keys() or latest_records[r["origin"]]["_id"] < r["_id"]:
+            latest_records[r["origin"]] = r  # only the newest record of each agent matters
+    requests = []
+    for origin, r in latest_records.items():
+        latest_dict = dict(r)
+        latest_dict["history_id"] = latest_dict.pop("_id", None)
+        latest_dict["_id"] = origin
+        # if the snapshot is newer, the filter doesn't match and the upsert fails with a duplicate key error
+        requests.append(ReplaceOne({"_id": origin, "history_id": {
+                        '$lt': latest_dict["history_id"]}}, latest_dict, upsert=True))
+    if len(requests) == 0:
+        return True
+    try:
+        result = get_agent_latest_collection(collection).bulk_write(
+            requests, ordered=False)
+        changed = result.modified_count+result.upserted_count
+    except BulkWriteError as e:
+        other_errors = [err for err in e.details.get(
+            "writeErrors", []) if err.get("code") != 11000]
+        if len(other_errors) > 0:
+            logger.error(
+                "Can't update the latest agent data snapshot in the DB server: "+str(other_errors))
+            return False
+        changed = e.details.get("nModified", 0)+e.details.get("nUpserted", 0)
+        logger.debug("Kept "+str(len(e.details.get("writeErrors", []))) +
+                     " agent data snapshots that are newer than the received data.")
+    except Exception as e:
+        logger.error(
+            "Can't update the latest agent data snapshot in the DB server: "+str(e))
+        return False
+    if changed == 0:
+        return True
+    # agent uploads are frequent, so their version bumps are coalesced (this saves a DB round-trip per upload)
+    return bump_data_versions(collection, ["agent_data"], deferred=True)
+
+
+@siaas_metrics.time_db_operation
+def rebuild_agent_latest(collection):
+    """
+    Repopulates the latest agent snapshot collection from the agent data history (e.g. after a restore)
+    Returns the number of agents in the rebuilt collection, or False if error
+    """
+    logger.info("Rebuilding the latest agent data snapshot collection ...")
+    try:
+        cursor = collection.aggregate([
+            {"$match": {'$and': [{"scope": "agent_data"}, {
+                "origin": {"$regex": "^agent_"}}, {"payload": {'$exists': True}}]}},
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": "$origin", "history_id": {"$last": "$_id"}, "scope": {"$last": "$scope"}, "origin": {"$last": "$origin"}, "destiny": {
+                "$last": "$destiny"}, "payload": {"$last": "$payload"}, "orig_ip": {"$last": "$orig_ip"}, "timestamp": {"$last": "$timestamp"}}}
+        ], allowDiskUse=True)
+        latest_collection = get_agent_latest_collection(collection)
+        origins = []
+        for r in cursor:
+            origins.append(r["_id"])
+            latest_collection.replace_one({"_id": r["_id"]}, r, upsert=True)
+        latest_collection.delete_many({"_id": {'$nin': origins}})
+    except Exception as e:
+        logger.error(
+            "Can't rebuild the latest agent data snapshot collection: "+str(e))
+        return False
+    bump_data_versions(collection, ["agent_data"])
+    logger.info("Latest agent data snapshot collection rebuilt with " +
+                str(len(origins))+" agents.")
+    return len(origins)
+
+
+def get_data_versions_collection(collection):
+    """
+    Returns the collection with the data version counters (it lives in the same DB as the inputted collection)
+    """
+    return collection.database[DATA_VERSIONS_COLLECTION]
+
+
+@siaas_metrics.time_db_operation
+def bump_data_versions(collection, scopes=[], deferred=False):
+    """
+    Increments the version counter of each data scope (e.g. "agent_data", "agent_configs", "zap_results"), so readers know its data changed
+    Cached outputs of these scopes in this process are dropped right away (other processes see the new versions)
+    If deferred, the counters are incremented in the background a bit later (once for all bumps of the same scope in the meantime)
+    Returns True if all OK; False if NOK
+    """
+    if deferred:
+        return defer_data_versions_bump(collection, scopes)
+    requests = []
+    for scope in scopes:
+        requests.append(UpdateOne({"_id": scope}, {"$inc": {"version": 1}, "$set": {
+                        "timestamp": get_now_utc_obj()}}, upsert=True))
+    if len(requests) == 0:
+        return True
+    try:
+        get_data_versions_collection(collection).bulk_write(
+            requests, ordered=False)
+    except Exception as e:
+        logger.error("Can't update the data versions in the DB server: "+str(e))
+        siaas_cache.invalidate(scopes)
+        return False
+    siaas_cache.invalidate(scopes)
+    return True
+
+
+def defer_data_versions_bump(collection, scopes=[]):
+    """
+    Queues version bumps for the data versions thread (started if needed), and drops the cached outputs of these scopes in this process right away
+    Returns True
+    """
+    global DATA_VERSIONS_THREAD
+    siaas_cache.invalidate(scopes)
+    with PENDING_DATA_VERSIONS_LOCK:
+        for scope in scopes:
+            PENDING_DATA_VERSIONS[scope] = collection
+        if DATA_VERSIONS_THREAD == None or not DATA_VERSIONS_THREAD.is_alive():
+            DATA_VERSIONS_THREAD = threading.Thread(
+                target=data_versions_loop, name="DataVersions", daemon=True)
+            DATA_VERSIONS_THREAD.start()
+    PENDING_DATA_VERSIONS_EVENT.set()
+    return True
+
+
+def data_versions_loop():
+    """
+    Data versions thread loop (writes the deferred version bumps, at most once per delay)
+    """
+    while True:
+        PENDING_DATA_VERSIONS_EVENT.wait()
+        time.sleep(DATA_VERSIONS_DELAY_SEC)
+        with PENDING_DATA_VERSIONS_LOCK:
+            PENDING_DATA_VERSIONS_EVENT.clear()
+            pending = dict(PENDING_DATA_VERSIONS)
+            PENDING_DATA_VERSIONS.clear()
+        scopes_by_collection = {}
+        for scope, collection in pending.items():
+            scopes_by_collection.setdefault(
+                id(collection), (collection, []))[1].append(scope)
+        for collection, scopes in scopes_by_collection.values():
+            bump_data_versions(collection, scopes)
+
+
+@siaas_metrics.time_db_operation
+def get_data_versions(collection, scopes=[]):
+    """
+    Returns a dict with the version counter of each inputted data scope (0 if the scope never changed)
+    Returns None if the versions can't be read
+    """
+    versions = {}
+    for scope in scopes:
+        versions[scope] = 0
+    try:
+        for r in get_data_versions_collection(collection).find({"_id": {"$in": list(scopes)}}):
+            versions[r["_id"]] = r.get("version", 0)
+    except Exception as e:
+        logger.error("Can't read the data versions from the DB server: "+str(e))
+        return None
+    return versions
+
+
+def get_target_hosts_set(target_host=None):
+    """
+    Returns the set of hosts in a comma-separated target host string, or None if there's no target host (all hosts are selected)
+    """
+    if len(target_host or '') == 0:
+        return None
+    return set(target_host.split(','))
+
+
+def iter_vulns_from_agent_data_dict(agent_data_dict, target_host=None, report_type="vuln_only"):
+    """
+    Walks the portscanner data of an agent data dict in a single pass, and yields a flat record for each vulnerability ('exploit_vuln_only' yields exploits only)
+    Each record is a dict with "agent", "host", "port", "script", "source" (vulners or vulscan output), "service", "vuln_id", "exploit" (True if it's tagged as an exploit) and "details"
+    Raises an exception if the data is not in the expected format
+    """
+    exploits_only = str(report_type or '').lower() == "exploit_vuln_only"
+    target_hosts = get_target_hosts_set(target_host)
+    for agent, agent_data in agent_data_dict.items():
+        if "portscanner" not in agent_data.keys():
+            continue
+        for host, host_data in agent_data["portscanner"].items():
+            if target_hosts != None and host not in target_hosts:
+                continue
+            if "scanned_ports" not in host_data.keys():
+                continue
+            for port, port_data in host_data["scanned_ports"].items():
+                if "scan_results" not in port_data.keys():
+                    continue
+                for script, script_data in port_data["scan_results"].items():
+                    for source, source_data in script_data.items():
+                        if "vulners" not in source and "vulscan" not in source:
+                            continue
+                        for service, service_data in source_data.items():
+                            for vuln_id, details in service_data.items():
+                                exploit = "siaas_exploit_tag" in details
+                                if exploits_only and not exploit:
+                                    continue
+                                yield {"agent": agent, "host": host, "port": port, "script": script, "source": source,
+                                       "service": service, "vuln_id": vuln_id, "exploit": exploit, "details": details}
+
+
 def grab_vulns_from_agent_data_dict(agent_data_dict, target_host=None, report_type="vuln_only"):
     """
     Receives an agent data dict and returns a list of vulnerabilities, depending on report_type: 'all', 'vuln_only', 'exploit_vuln_only'
+    The nested vuln dict is built in a single pass; use iter_vulns_from_agent_data_dict() for flat vulnerability records instead
     Returns the vuln dict if all OK; Returns False if anything fails
     """
     if len(report_type or '') == 0:
         report_type = "vuln_only"
+    report_type = report_type.lower()
+    target_hosts = get_target_hosts_set(target_host)
 
     new_dict = {}
 
-    if report_type.lower() == "all":
-        try:
-            for a in agent_data_dict.keys():
-                for b in agent_data_dict[a].keys():
-                    if b == "portscanner":
-                        for c in agent_data_dict[a][b].keys():
-                            if len(target_host or '') > 0 and c not in target_host.split(','):
-                                continue
-                            if a not in new_dict.keys():
-                                new_dict[a] = {}
-                            if b not in new_dict[a].keys():
-                                new_dict[a][b] = {}
-                            new_dict[a][b][c] = agent_data_dict[a][b][c]
-        except Exception as e:
-            logger.error("Error generating new dict: "+str(e))
-            return False
-    else:
-        try:
-            for a in agent_data_dict.keys():
-                for b in agent_data_dict[a].keys():
-                    if b == "portscanner":
-                        for c in agent_data_dict[a][b].keys():
-                            if len(target_host or '') > 0 and c not in target_host.split(','):
-                                continue
-                            for d in agent_data_dict[a][b][c].keys():
-                                if d == "last_check":
-                                    if a not in new_dict.keys():
-                                        new_dict[a] = {}
-                                    if b not in new_dict[a].keys():
-                                        new_dict[a][b] = {}
-                                    if c not in new_dict[a][b].keys():
-                                        new_dict[a][b][c] = {}
-                                    new_dict[a][b][c]["last_check"] = agent_data_dict[a][b][c]["last_check"]
-                                if d == "scanned_ports":
-                                    for e in agent_data_dict[a][b][c][d].keys():
-                                        for f in agent_data_dict[a][b][c][d][e].keys():
-                                            if f == "scan_results":
-                                                for g in agent_data_dict[a][b][c][d][e][f].keys():
-                                                    for h in agent_data_dict[a][b][c][d][e][f][g].keys():
-                                                        if "vulners" in h or "vulscan" in h:
-                                                            if report_type.lower() == "exploit_vuln_only":
-                                                                for i in agent_data_dict[a][b][c][d][e][f][g][h].keys():
-                                                                    for j in agent_data_dict[a][b][c][d][e][f][g][h][i].keys():
-                                                                        if "siaas_exploit_tag" in agent_data_dict[a][b][c][d][e][f][g][h][i][j]:
-                                                                            if a not in new_dict.keys():
-                                                                                new_dict[a] = {
-                                                                                }
-                                                                            if b not in new_dict[a].keys():
-                                                                                new_dict[a][b] = {
-                                                                                }
-                                                                            if c not in new_dict[a][b].keys():
-                                                                                new_dict[a][b][c] = {
-                                                                                }
-                                                                            if d not in new_dict[a][b][c].keys():
-                                                                                new_dict[a][b][c][d] = {
-                                                                                }
-                                                                            if e not in new_dict[a][b][c][d].keys():
-                                                                                new_dict[a][b][c][d][e] = {
-                                                                                }
-                                                                            if f not in new_dict[a][b][c][d][e].keys():
-                                                                                new_dict[a][b][c][d][e][f] = {
-                                                                                }
-                                                                            if g not in new_dict[a][b][c][d][e][f].keys():
-                                                                                new_dict[a][b][c][d][e][f][g] = {
-                                                                                }
-                                                                            if h not in new_dict[a][b][c][d][e][f][g].keys():
-                                                                                new_dict[a][b][c][d][e][f][g][h] = {
-                                                                                }
-                                                                            if i not in new_dict[a][b][c][d][e][f][g][h].keys():
-                                                                                new_dict[a][b][c][d][e][f][g][h][i] = {
-                                                                                }
-                                                                            new_dict[a][b][c][d][e][f][g][h][i][
-                                                                                j] = agent_data_dict[a][b][c][d][e][f][g][h][i][j]
-                                                            else:  # default to vuln_only
-                                                                if a not in new_dict.keys():
-                                                                    new_dict[a] = {
-                                                                    }
-                                                                if b not in new_dict[a].keys():
-                                                                    new_dict[a][b] = {
-                                                                    }
-                                                                if c not in new_dict[a][b].keys():
-                                                                    new_dict[a][b][c] = {
-                                                                    }
-                                                                if d not in new_dict[a][b][c].keys():
-                                                                    new_dict[a][b][c][d] = {
-                                                                    }
-                                                                if e not in new_dict[a][b][c][d].keys():
-                                                                    new_dict[a][b][c][d][e] = {
-                                                                    }
-                                                                if f not in new_dict[a][b][c][d][e].keys():
-                                                                    new_dict[a][b][c][d][e][f] = {
-                                                                    }
-                                                                if g not in new_dict[a][b][c][d][e][f].keys():
-                                                                    new_dict[a][b][c][d][e][f][g] = {
-                                                                    }
-                                                                new_dict[a][b][c][d][e][f][g][h] = agent_data_dict[a][b][c][d][e][f][g][h]
-        except Exception as e:
-            logger.error("Error generating new dict: "+str(e))
-            return False
+    try:
+        for a, agent_data in agent_data_dict.items():
+            for b, module_data in agent_data.items():
+                if b != "portscanner":
+                    continue
+                for c, host_data in module_data.items():
+                    if target_hosts != None and c not in target_hosts:
+                        continue
+                    if report_type == "all":
+                        new_dict.setdefault(a, {}).setdefault(b, {})[
+                            c] = host_data
+                        continue
+                    host_out = None  # output dicts are only created when something is found
+                    for d, host_value in host_data.items():
+                        if d == "last_check":
+                            if host_out == None:
+                                host_out = new_dict.setdefault(
+                                    a, {}).setdefault(b, {}).setdefault(c, {})
+                            host_out["last_check"] = host_value
+                        if d != "scanned_ports":
+                            continue
+                        for e, port_data in host_value.items():
+                            for f, port_value in port_data.items():
+                                if f != "scan_results":
+                                    continue
+                                for g, script_data in port_value.items():
+                                    script_out = None
+                                    for h, source_data in script_data.items():
+                                        if "vulners" not in h and "vulscan" not in h:
+                                            continue
+                                        if report_type != "exploit_vuln_only":  # default to vuln_only
+                                            if script_out == None:
+                                                if host_out == None:
+                                                    host_out = new_dict.setdefault(
+                                                        a, {}).setdefault(b, {}).setdefault(c, {})
+                                                script_out = host_out.setdefault(d, {}).setdefault(
+                                                    e, {}).setdefault(f, {}).setdefault(g, {})
+                                            script_out[h] = source_data
+                                            continue
+                                        for i, service_data in source_data.items():
+                                            service_out = None
+                                            for j, details in service_data.items():
+                                                if "siaas_exploit_tag" not in details:
+                                                    continue
+                                                if service_out == None:
+                                                    if host_out == None:
+                                                        host_out = new_dict.setdefault(
+                                                            a, {}).setdefault(b, {}).setdefault(c, {})
+                                                    service_out = host_out.setdefault(d, {}).setdefault(e, {}).setdefault(
+                                                        f, {}).setdefault(g, {}).setdefault(h, {}).setdefault(i, {})
+                                                service_out[j] = details
+    except Exception as e:
+        logger.error("Error generating new dict: "+str(e))
+        return False
 
     return new_dict
 
 
+@siaas_metrics.time_db_operation
 def read_mongodb_collection(collection, siaas_uid="00000000-0000-0000-0000-000000000000"):
     """
     Reads data from the Mongo DB collection
@@ -916,13 +1309,14 @@ def read_mongodb_collection(collection, siaas_uid="00000000-0000-0000-0000-00000
 
         results = list(cursor)
         for doc in results:
-            logger.debug("Record read: "+str(doc))
+            log_debug_data("Record read:", doc)
         return results
     except Exception as e:
         logger.error("Can't read data from the DB server: "+str(e))
         return None
 
 
+@siaas_metrics.time_db_operation
 def insert_in_mongodb_collection(collection, data_to_insert):
     """
     Inserts data (usually a dict) into a said collection
@@ -930,8 +1324,8 @@ def insert_in_mongodb_collection(collection, data_to_insert):
     """
     logger.debug("Inserting data in the DB server ...")
     try:
-        logger.debug("All data that will now be inserted in the database:\n" +
-                     pprint.pformat(data_to_insert, sort_dicts=False))
+        log_debug_data(
+            "All data that will now be inserted in the database:", data_to_insert)
         collection.insert_one(copy(data_to_insert))
         logger.debug("Data successfully inserted in the DB server.")
         return True
@@ -940,6 +1334,52 @@ def insert_in_mongodb_collection(collection, data_to_insert):
         return False
 
 
+@siaas_metrics.time_db_operation
+def insert_many_in_mongodb_collection(collection, data_list):
+    """
+    Inserts a list of data (usually dicts) into a said collection, in a single unordered bulk insertion
+    Returns a dict with the failed list indexes and their errors (empty if all was OK). Returns False if the insertion failed completely
+    """
+    logger.debug("Inserting "+str(len(data_list)) +
+                 " records in the DB server ...")
+    if len(data_list) == 0:
+        return {}
+    try:
+        collection.insert_many([copy(d) for d in data_list], ordered=False)
+        logger.debug("Data successfully inserted in the DB server.")
+        return {}
+    except BulkWriteError as e:
+        failed_dict = {}
+        for err in e.details.get("writeErrors", []):
+            failed_dict[err["index"]] = str(err.get("errmsg"))
+        logger.error("Couldn't insert "+str(len(failed_dict)) +
+                     " records in the DB server.")
+        return failed_dict
+    except Exception as e:
+        logger.error("Can't insert data in the DB server: "+str(e))
+        return False
+
+
+@siaas_metrics.time_db_operation
+def replace_in_mongodb_collection(collection, query_filter, data_to_insert):
+    """
+    Replaces the object matching the filter with data, creating it if it doesn't exist
+    Returns True if all was OK. Returns False if the insertion failed
+    """
+    logger.debug("Replacing data in the DB server ...")
+    try:
+        log_debug_data(
+            "All data that will now be replaced in the database:", data_to_insert)
+        collection.replace_one(query_filter, copy(
+            data_to_insert), upsert=True)
+        logger.debug("Data successfully replaced in the DB server.")
+        return True
+    except Exception as e:
+        logger.error("Can't replace data in the DB server: "+str(e))
+        return False
+
+
+@siaas_metrics.time_db_operation
 def create_or_update_in_mongodb_collection(collection, data_to_insert):
     """
     Creates or updates an object with data
@@ -947,8 +1387,8 @@ def create_or_update_in_mongodb_collection(collection, data_to_insert):
     """
     logger.debug("Creating or updating data in the DB server ...")
     try:
-        logger.debug("All data that will now be created or updated in the database:\n" +
-                     pprint.pformat(data_to_insert, sort_dicts=False))
+        log_debug_data(
+            "All data that will now be created or updated in the database:", data_to_insert)
         data = copy(data_to_insert)
         collection.find_one_and_update(
             {'destiny': data["destiny"], 'scope': data["scope"]}, {'$set': data}, upsert=True)
@@ -962,38 +1402,18 @@ def create_or_update_in_mongodb_collection(collection, data_to_insert):
 def mongodb_ping(mongo_user=None, mongo_password=None, mongo_host=None, mongo_db=None, mongo_collection=None):
     """
     Returns True if the DB is alive, False if otherwise
+    Uses the shared DB client of this process (see siaas_mongo)
     """
-    logger.debug("Pinging the DB server at "+str(mongo_host)+" ...")
-    try:
-        uri = "mongodb://%s:%s@%s/%s" % (quote_plus(mongo_user),
-                                         quote_plus(mongo_password), mongo_host, mongo_db)
-        client = MongoClient(uri)
-        eval("client."+mongo_db+".command('ping')")
-        logger.debug("DB replied to ping.")
-        return True
-    except:
-        logger.debug("DB didn't reply to ping.")
-        return False
+    return siaas_mongo.ping(mongo_user, mongo_password, mongo_host, mongo_db)
 
 
 def connect_mongodb_collection(mongo_user=None, mongo_password=None, mongo_host=None, mongo_db=None, mongo_collection=None):
     """
     Set up a MongoDB collection connection based on the inputs
+    Collections are obtained from the shared DB client of this process (see siaas_mongo), so no new connections are opened
     Returns the collection obj if succeeded. Returns None if it failed
     """
-    logger.debug("Connecting to the DB server at "+str(mongo_host)+" ...")
-    try:
-        uri = "mongodb://%s:%s@%s/%s" % (quote_plus(mongo_user),
-                                         quote_plus(mongo_password), mongo_host, mongo_db)
-        client = MongoClient(uri)
-        db = client[mongo_db]
-        collection = db[mongo_collection]
-        logger.debug(
-            "Correctly configured the DB server connection to collection '"+mongo_collection+"'.")
-        return collection
-    except Exception as e:
-        logger.error("Can't connect to the DB server: "+str(e))
-        return None
+    return siaas_mongo.get_collection(mongo_user, mongo_password, mongo_host, mongo_db, mongo_collection)
 
 
 def write_to_local_file(file_to_write, data_to_insert):
@@ -1002,17 +1422,19 @@ def write_to_local_file(file_to_write, data_to_insert):
     Returns True if all went OK
     Returns False if it failed
     """
-    logger.debug("Inserting data to local file "+file_to_write+" ...")
+    logger.debug("Inserting data to local file %s ...", file_to_write)
     try:
         os.makedirs(os.path.dirname(os.path.join(
             sys.path[0], file_to_write)), exist_ok=True)
-        logger.debug("All data that will now be written to the file:\n" +
-                     pprint.pformat(data_to_insert, sort_dicts=False))
+        log_debug_data(
+            "All data that will now be written to the file:", data_to_insert)
         with open(file_to_write, 'w') as file:
             file.write(json.dumps(data_to_insert, sort_keys=False))
-            logger.debug("Local file write ended successfully.")
-            return True
+        invalidate_local_file_cache(file_to_write)
+        logger.debug("Local file write ended successfully.")
+        return True
     except Exception as e:
+        invalidate_local_file_cache(file_to_write)
         logger.error(
             "There was an error while writing to the local file "+file_to_write+": "+str(e))
         return False
@@ -1023,7 +1445,7 @@ def read_from_local_file(file_to_read):
     Reads data from local file and returns it
     It will return None if it failed
     """
-    logger.debug("Reading from local file "+file_to_read+" ...")
+    logger.debug("Reading from local file %s ...", file_to_read)
     try:
         with open(file_to_read, 'r') as file:
             content = file.read()
@@ -1038,6 +1460,45 @@ def read_from_local_file(file_to_read):
         return None
 
 
+def read_from_local_file_cached(file_to_read):
+    """
+    Reads a dict from a local file, keeping the parsed result in memory
+    The file is only read and parsed again if its inode, modification time or size changed, or if its cache entry was invalidated
+    It will return None if it failed
+    """
+    try:
+        file_stat = os.stat(file_to_read)
+        signature = (file_stat.st_ino, file_stat.st_mtime_ns,
+                     file_stat.st_size)
+    except Exception as e:
+        logger.error("There was an error reading from local file " +
+                     file_to_read+": "+str(e))
+        return None
+
+    with LOCAL_FILE_CACHE_LOCK:
+        cached = LOCAL_FILE_CACHE.get(file_to_read)
+    if cached != None and cached[0] == signature:
+        return cached[1]
+
+    content = read_from_local_file(file_to_read)
+    if isinstance(content, dict):  # partially written files are never cached
+        with LOCAL_FILE_CACHE_LOCK:
+            LOCAL_FILE_CACHE[file_to_read] = (signature, content)
+    return content
+
+
+def invalidate_local_file_cache(file_to_invalidate=None):
+    """
+    Drops the in-memory cache entry of a local file, forcing the next cached read to parse it again
+    If no file is given, the whole cache is dropped
+    """
+    with LOCAL_FILE_CACHE_LOCK:
+        if file_to_invalidate == None:
+            LOCAL_FILE_CACHE.clear()
+        else:
+            LOCAL_FILE_CACHE.pop(file_to_invalidate, None)
+
+
 def get_or_create_unique_system_id():
     """
     Reads the local UID file and returns it
@@ -1131,6 +1592,15 @@ def validate_bool_string(input_string, default_output=False):
         return True
 
 
+def validate_cursor_token(token):
+    """
+    Validates the format of a cursor token (a record ID) and returns a boolean (an empty token is valid, as it means the first page)
+    """
+    if len(token or '') == 0:
+        return True
+    return ObjectId.is_valid(token)
+
+
 def validate_string_key(string):
     """
     Validates the proper format of a string configuration key and returns a boolean
@@ -1151,6 +1621,33 @@ def validate_string_key(string):
     return True
 
 
+def format_data_for_log(data, max_chars=LOG_DATA_MAX_CHARS, max_depth=LOG_DATA_MAX_DEPTH):
+    """
+    Returns a summary of data (usually a dict) for logging, truncated to max_chars
+    Small data is pretty-printed (nesting deeper than max_depth is shown as "..."), while bigger data is dumped in a compact JSON format
+    """
+    try:
+        out = json.dumps(data, sort_keys=False,
+                         ensure_ascii=False, default=str)
+        if len(out) <= LOG_DATA_PRETTY_MAX_CHARS:
+            out = pprint.pformat(data, sort_dicts=False, depth=max_depth)
+    except Exception as e:
+        out = "<data can't be formatted: "+str(e)+">"
+    if len(out) > max_chars:
+        out = out[:max_chars] + \
+            " ... (truncated, "+str(len(out))+" chars in total)"
+    return out
+
+
+def log_debug_data(message, data):
+    """
+    Logs a message followed by a summary of the data, but only if debug logging is enabled
+    The summary is never built otherwise, as formatting big payloads is expensive
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s\n%s", message, format_data_for_log(data))
+
+
 def get_size(size_bytes, suffix="B"):
     """
     Scale bytes to a shorter "MB" or "GB" format
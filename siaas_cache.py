@@ -0,0 +1,151 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - API outputs cache
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Cached outputs (key -> (expiry time, data scopes, data versions, output)), least recently used first
+CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+CACHE_METRICS = {"hits": 0, "misses": 0, "expired": 0, "stale": 0,
+                 "evictions": 0, "invalidations": 0}
+
+CACHE_DEFAULT_MAX_ENTRIES = 256
+CACHE_DEFAULT_TTL_SEC = 30
+
+
+def get_cache_configs():
+    """
+    Returns the maximum number of entries and the TTL of the cache, from the configuration DB (or their defaults)
+    """
+    try:
+        max_entries = int(siaas_aux.get_config_from_configs_db(
+            config_name="api_cache_max_entries"))
+        if max_entries < 0:
+            raise ValueError("Value can't be negative.")
+    except:
+        max_entries = CACHE_DEFAULT_MAX_ENTRIES
+    try:
+        ttl_sec = float(siaas_aux.get_config_from_configs_db(
+            config_name="api_cache_ttl_sec"))
+        if ttl_sec < 0:
+            raise ValueError("Value can't be negative.")
+    except:
+        ttl_sec = CACHE_DEFAULT_TTL_SEC
+    return max_entries, ttl_sec
+
+
+def normalize_list(comma_separated_list=None):
+    """
+    Returns a sorted tuple with the unique lowercase items of a comma-separated string, so equivalent lists have the same key
+    Returns None for empty lists or if the list selects everything ("*")
+    """
+    items = set()
+    for i in str(comma_separated_list or "").split(','):
+        item = i.strip().lower()
+        if item == "*":
+            return None
+        if len(item) > 0:
+            items.add(item)
+    if len(items) == 0:
+        return None
+    return tuple(sorted(items))
+
+
+def make_key(route, agent_uid=None, module=None, **args):
+    """
+    Returns a cache key from the route and its normalized args (agent UID and module lists are order and case insensitive)
+    """
+    return (route, normalize_list(agent_uid), normalize_list(module), tuple(sorted((k, str(v)) for k, v in args.items())))
+
+
+def get(key, versions=None):
+    """
+    Returns a cached output if it's not expired and was computed from the inputted data versions
+    Returns None if there is no valid entry (or if the data versions are unknown)
+    """
+    with CACHE_LOCK:
+        entry = CACHE.get(key)
+        if entry == None or versions == None:
+            CACHE_METRICS["misses"] += 1
+            return None
+        expiry, scopes, entry_versions, output = entry
+        if time.monotonic() > expiry:
+            CACHE.pop(key, None)
+            CACHE_METRICS["expired"] += 1
+            CACHE_METRICS["misses"] += 1
+            return None
+        for scope in scopes:  # changed by another process (e.g. another API worker or the DB maintenance)
+            if entry_versions.get(scope) != versions.get(scope):
+                CACHE.pop(key, None)
+                CACHE_METRICS["stale"] += 1
+                CACHE_METRICS["misses"] += 1
+                return None
+        CACHE.move_to_end(key)
+        CACHE_METRICS["hits"] += 1
+        return output
+
+
+def put(key, output, scopes=[], versions=None):
+    """
+    Caches an output computed from the inputted data versions, evicting the least recently used entries if the cache is full
+    Nothing is cached if the data versions are unknown or if the cache is disabled (0 entries or 0 seconds TTL)
+    """
+    max_entries, ttl_sec = get_cache_configs()
+    if versions == None or max_entries == 0 or ttl_sec == 0:
+        return
+    with CACHE_LOCK:
+        CACHE[key] = (time.monotonic()+ttl_sec, tuple(scopes),
+                      dict(versions), output)
+        CACHE.move_to_end(key)
+        while len(CACHE) > max_entries:
+            CACHE.popitem(last=False)
+            CACHE_METRICS["evictions"] += 1
+
+
+def read_through(key, scopes, compute_function, versions=None):
+    """
+    Returns the cached output for the key, or computes it with the inputted function and caches it
+    Failed computations (False) are not cached
+    """
+    output = get(key, versions)
+    if output != None:
+        return output
+    output = compute_function()
+    if not (type(output) == bool and output == False):
+        put(key, output, scopes, versions)
+    return output
+
+
+def invalidate(scopes=[]):
+    """
+    Removes all cached outputs computed from data of any of the inputted scopes
+    """
+    with CACHE_LOCK:
+        for key in [k for k, v in CACHE.items() if len(set(v[1]) & set(scopes)) > 0]:
+            CACHE.pop(key, None)
+            CACHE_METRICS["invalidations"] += 1
+
+
+def get_metrics():
+    """
+    Returns a dict with the cache counters and settings
+    """
+    max_entries, ttl_sec = get_cache_configs()
+    with CACHE_LOCK:
+        metrics = dict(CACHE_METRICS)
+        metrics["entries"] = len(CACHE)
+    metrics["max_entries"] = max_entries
+    metrics["ttl_sec"] = ttl_sec
+    lookups = metrics["hits"]+metrics["misses"]
+    if lookups > 0:
+        metrics["hit_ratio"] = round(metrics["hits"]/lookups, 4)
+    else:
+        metrics["hit_ratio"] = 0
+    return metrics
@@ -0,0 +1,113 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - Config sync module
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import siaas_mongo
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def get_configs_hash(config_dict):
+    """
+    Returns a content hash of a configuration dict, independent of its key order
+    """
+    return hashlib.sha256(json.dumps(config_dict, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def sync_server_configs(db_collection, last_hash=None):
+    """
+    Reads the published server configs from the DB and merges them to the local configs DB, but only if their contents changed
+    Returns the hash of the configs that are applied locally; Returns the last hash if nothing changed or if something failed
+    """
+    upstream_dict = siaas_aux.get_dict_current_server_configs(db_collection)
+    if type(upstream_dict) == bool and upstream_dict == False:
+        logger.error(
+            "Couldn't read the published server configs. Keeping the current local configs.")
+        return last_hash
+
+    new_hash = get_configs_hash(upstream_dict)
+    if new_hash == last_hash:
+        logger.debug("Published server configs didn't change.")
+        return last_hash
+
+    logger.info(
+        "Published server configs changed. Merging them to the local configs ...")
+    if not siaas_aux.merge_configs_from_upstream(upstream_dict=upstream_dict):
+        return last_hash
+
+    return new_hash
+
+
+def loop():
+    """
+    Config sync loop (merges the published server configs whenever they change)
+    """
+    # Get the collection from the shared DB client of this process
+    db_collection = siaas_mongo.get_collection_from_config()
+
+    run = True
+    if db_collection == None:
+        logger.error(
+            "No valid DB collection received. No config sync will be performed.")
+        run = False
+
+    last_hash = None
+    while run:
+
+        logger.debug("Loop running ...")
+
+        last_hash = sync_server_configs(db_collection, last_hash)
+
+        # Sleep before next loop
+        try:
+            sleep_time = int(siaas_aux.get_config_from_configs_db(
+                config_name="configsync_loop_interval_sec"))
+            if sleep_time < 1:
+                raise ValueError("Config sync interval can't be less than 1.")
+            logger.debug("Sleeping for "+str(sleep_time) +
+                         " seconds before next loop ...")
+            time.sleep(sleep_time)
+        except:
+            logger.debug(
+                "The interval loop time is not configured or is invalid. Sleeping now for 10 seconds by default ...")
+            time.sleep(10)
+
+
+if __name__ == "__main__":
+
+    log_level = logging.INFO
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-5s %(filename)s [%(threadName)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_level)
+
+    if os.geteuid() != 0:
+        print("You need to be root to run this script!", file=sys.stderr)
+        sys.exit(1)
+
+    print('\nThis script is being directly run, so it will just read data from the DB!\n')
+
+    MONGO_USER = "siaas"
+    MONGO_PWD = "siaas"
+    MONGO_HOST = "127.0.0.1"
+    MONGO_PORT = "27017"
+    MONGO_DB = "siaas"
+    MONGO_COLLECTION = "siaas"
+
+    try:
+        collection = siaas_aux.connect_mongodb_collection(
+            MONGO_USER, MONGO_PWD, MONGO_HOST+":"+MONGO_PORT, MONGO_DB, MONGO_COLLECTION)
+    except:
+        print("Can't connect to DB!")
+        sys.exit(1)
+
+    logger.info("Syncing server configs ...")
+
+    sync_server_configs(collection)
+
+    print('\nAll done. Bye!\n')
@@ -3,9 +3,13 @@
 # By João Pedro Seara, 2022-2024
 
 import siaas_aux
+import siaas_metrics
+import siaas_mongo
+import siaas_indexes
 import logging
 import os
 import sys
+import tempfile
 import time
 
 logger = logging.getLogger(__name__)
@@ -24,8 +28,12 @@ def delete_history_data(db_collection, days_to_keep):
     if type(deleted_count) == bool and deleted_count == False:
         logger.error(
             "DB could not be cleaned up. This might result in an eventual disk exhaustion in the server!")
+        siaas_metrics.increment("dbmaintenance_runs", result="failure")
         return False
     else:
+        siaas_metrics.increment("dbmaintenance_runs", result="success")
+        siaas_metrics.increment("dbmaintenance_deleted",
+                                deleted_count, scope="agent_data")
         logger.info("DB cleanup finished. " +
                     str(deleted_count)+" records deleted.")
         return True
@@ -35,34 +43,8 @@ def loop():
     """
     DB Maintenance loop (calls the delete historical data function)
     """
-    # Generate global variables from the configuration file
-    config_dict = siaas_aux.get_config_from_configs_db(convert_to_string=True)
-    MONGO_USER = None
-    MONGO_PWD = None
-    MONGO_HOST = None
-    MONGO_PORT = None
-    MONGO_DB = None
-    MONGO_COLLECTION = None
-    for config_name in config_dict.keys():
-        if config_name.upper() == "MONGO_USER":
-            MONGO_USER = config_dict[config_name]
-        if config_name.upper() == "MONGO_PWD":
-            MONGO_PWD = config_dict[config_name]
-        if config_name.upper() == "MONGO_HOST":
-            MONGO_HOST = config_dict[config_name]
-        if config_name.upper() == "MONGO_PORT":
-            MONGO_PORT = config_dict[config_name]
-        if config_name.upper() == "MONGO_DB":
-            MONGO_DB = config_dict[config_name]
-        if config_name.upper() == "MONGO_COLLECTION":
-            MONGO_COLLECTION = config_dict[config_name]
-
-    if len(MONGO_PORT or '') > 0:
-        mongo_host_port = MONGO_HOST+":"+MONGO_PORT
-    else:
-        mongo_host_port = MONGO_HOST
-    db_collection = siaas_aux.connect_mongodb_collection(
-        MONGO_USER, MONGO_PWD, mongo_host_port, MONGO_DB, MONGO_COLLECTION)
+    # Get the collection from the shared DB client of this process
+    db_collection = siaas_mongo.get_collection_from_config()
 
     run = True
     if db_collection == None:
@@ -87,6 +69,8 @@ def loop():
 
         delete_history_data(db_collection, days_to_keep)
 
+        siaas_indexes.log_index_report(db_collection)
+
         # Sleep before next loop
         try:
             sleep_time = int(siaas_aux.get_config_from_configs_db(
@@ -115,22 +99,40 @@ if __name__ == "__main__":
     siaas_uid = siaas_aux.get_or_create_unique_system_id()
     # siaas_uid = "00000000-0000-0000-0000-000000000000" # hack to show data from all agents
 
-    MONGO_USER = "siaas"
-    MONGO_PWD = "siaas"
-    MONGO_HOST = "127.0.0.1"
-    MONGO_PORT = "27017"
-    MONGO_DB = "siaas"
-    MONGO_COLLECTION = "siaas"
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild_agent_latest":
+        # used after restores, so it connects with the DB settings of the local configuration file
+        # (written to a private configs DB, as the one in use by a running server has the published server configs merged in)
+        config_fd, config_db = tempfile.mkstemp(
+            prefix="siaas_rebuild_config_", suffix=".db")
+        os.close(config_fd)
+        try:
+            if not siaas_aux.write_config_db_from_conf_file(output=config_db):
+                print("Can't read the local configuration file!", file=sys.stderr)
+                sys.exit(1)
+            collection = siaas_mongo.get_collection_from_config(
+                local_dict=config_db)
+        finally:
+            os.remove(config_db)
+        if collection == None:
+            print("Can't connect to DB!", file=sys.stderr)
+            sys.exit(1)
+        logger.info("Rebuilding the latest agent data snapshot ...")
+        if siaas_aux.rebuild_agent_latest(collection) == False:
+            sys.exit(1)
+    else:
+        MONGO_USER = "siaas"
+        MONGO_PWD = "siaas"
+        MONGO_HOST = "127.0.0.1"
+        MONGO_PORT = "27017"
+        MONGO_DB = "siaas"
+        MONGO_COLLECTION = "siaas"
 
-    try:
         collection = siaas_aux.connect_mongodb_collection(
             MONGO_USER, MONGO_PWD, MONGO_HOST+":"+MONGO_PORT, MONGO_DB, MONGO_COLLECTION)
-    except:
-        print("Can't connect to DB!")
-        sys.exit(1)
-
-    logger.info("Cleaning up the DB ...")
-
-    delete_history_data(collection, days_to_keep=365)
+        if collection == None:
+            print("Can't connect to DB!", file=sys.stderr)
+            sys.exit(1)
+        logger.info("Cleaning up the DB ...")
+        delete_history_data(collection, days_to_keep=365)
 
     print('\nAll done. Bye!\n')
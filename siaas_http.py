@@ -0,0 +1,101 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - HTTP response helpers (ETags and compression)
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import siaas_profiling
+import gzip
+import hashlib
+import logging
+import time
+from datetime import datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Routes whose GET output only depends on the data of these scopes (and on the request args)
+ROUTE_DATA_SCOPES = {
+    "/siaas-server/agents": ["agent_data", "agent_configs"],
+    "/siaas-server/agents/data": ["agent_data"],
+    "/siaas-server/agents/data/<agent_uid>": ["agent_data"],
+    "/siaas-server/agents/configs": ["agent_configs"],
+    "/siaas-server/agents/configs/<agent_uid>": ["agent_configs"],
+    "/siaas-server/agents/history": ["agent_data"],
+    "/siaas-server/agents/history/<agent_uid>": ["agent_data"],
+    "/siaas-server/siaas-zap/results": ["zap_results"],
+    "/siaas-server/siaas-zap/results/<target>": ["zap_results"],
+}
+# Routes with a time window ("days"): records leave the window without any write, so their ETags also change every minute
+ETAG_TIME_WINDOW_ROUTES = ["/siaas-server/agents/history",
+                           "/siaas-server/agents/history/<agent_uid>"]
+
+COMPRESSION_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def get_accepted_encoding(accept_encodings):
+    """
+    Returns the preferred content encoding accepted by the client ("br" or "gzip"), or None
+    """
+    if brotli != None and accept_encodings.quality("br") > 0:
+        return "br"
+    if accept_encodings.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def get_route_data_versions(collection, rule):
+    """
+    Returns a dict with the data versions of the scopes a route reads
+    Returns None if the route output doesn't depend only on data versions, or if the data versions can't be read
+    """
+    if rule not in ROUTE_DATA_SCOPES.keys():
+        return None
+    return siaas_aux.get_data_versions(collection, ROUTE_DATA_SCOPES[rule])
+
+
+def get_etag(rule, args, view_args, encoding=None, versions=None):
+    """
+    Returns a strong ETag for a GET request, computed from the route, its args, the negotiated encoding and the data versions of the scopes the route reads
+    Returns None if the data versions are unknown
+    """
+    if versions == None:
+        return None
+    etag_source = [rule, sorted(args.items(multi=True)), sorted(
+        (view_args or {}).items()), encoding, sorted(versions.items())]
+    if rule in ETAG_TIME_WINDOW_ROUTES:
+        etag_source.append(datetime.utcnow().strftime('%Y-%m-%dT%H:%M'))
+    return hashlib.sha1(str(etag_source).encode('utf-8')).hexdigest()
+
+
+def compress_response(response, encoding):
+    """
+    Compresses the body of a response with the inputted encoding ("br" or "gzip"), if it's big enough and not streamed
+    Returns the response
+    """
+    response.vary.add("Accept-Encoding")
+    if encoding == None or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return response
+    start = time.perf_counter()
+    try:
+        if encoding == "br":
+            response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+        else:
+            response.set_data(gzip.compress(
+                body, compresslevel=GZIP_LEVEL, mtime=0))
+        response.headers["Content-Encoding"] = encoding
+    except Exception as e:
+        logger.error("Can't compress the response: "+str(e))
+        response.set_data(body)
+    siaas_profiling.add_time("compress", time.perf_counter()-start)
+    return response
@@ -0,0 +1,218 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - DB index management
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Indexes required by the query shapes in siaas_aux and siaas_routes (name, keys, options)
+MAIN_INDEXES = [
+    # latest data/history per agent (scope + origin, sorted by _id)
+    {"name": "scope_origin_id_index", "keys": [
+        ("scope", 1), ("origin", 1), ("_id", 1)], "options": {}},
+    # server and agent configs (scope + destiny, sorted by _id), also used by the configs upserts
+    {"name": "scope_destiny_id_index", "keys": [
+        ("scope", 1), ("destiny", 1), ("_id", 1)], "options": {}},
+    # history of all agents (scope, sorted by _id)
+    {"name": "scope_id_index", "keys": [
+        ("scope", 1), ("_id", 1)], "options": {}},
+    # history cleanup and day windows (scope + timestamp)
+    {"name": "scope_timestamp_index", "keys": [
+        ("scope", 1), ("timestamp", 1)], "options": {}},
+    # cleanup of all scopes at once
+    {"name": "agent_timestamp_index", "keys": [
+        ("timestamp", 1)], "options": {}},
+]
+
+AGENT_LATEST_INDEXES = [
+    {"name": "latest_timestamp_index", "keys": [
+        ("timestamp", 1)], "options": {}},
+]
+
+ZAP_INDEXES = [
+    {"name": "zap_target_index", "keys": [
+        ("target", 1)], "options": {"unique": True}},
+]
+
+# Old single-field indexes that are superseded by the compound indexes above
+LEGACY_INDEXES = ["agent_origin_index", "agent_destiny_index"]
+
+# Hot queries that should never need a collection scan (filter, sort)
+MAIN_HOT_QUERIES = [
+    ({"scope": "agent_data", "origin": "agent_"}, [("_id", -1)]),
+    ({"scope": "agent_configs", "destiny": "agent_"}, [("_id", -1)]),
+    ({"scope": "server_configs", "destiny": "server"}, [("_id", -1)]),
+    ({"scope": "agent_data", "timestamp": {"$gte": datetime(1970, 1, 1)}}, [
+     ("_id", -1)]),
+    ({"scope": "agent_data", "timestamp": {"$lt": datetime(1970, 1, 1)}}, None),
+]
+
+
+def normalize_index_keys(keys):
+    """
+    Returns index keys as a list of (field, direction) tuples, with numeric directions as integers
+    """
+    out_list = []
+    for k, d in keys:
+        if isinstance(d, (int, float)):
+            d = int(d)
+        out_list.append((k, d))
+    return out_list
+
+
+def ensure_indexes(collection, index_specs, legacy_indexes=None):
+    """
+    Creates the declared indexes in a collection, if they don't exist yet
+    Indexes with the same name but different keys or options are dropped and recreated, and legacy indexes are dropped
+    Safe to run on every startup. Returns True if all OK; False if something failed
+    """
+    if legacy_indexes == None:
+        legacy_indexes = []
+
+    result = True
+    try:
+        existing = collection.index_information()
+    except Exception as e:
+        logger.error("Can't read indexes from collection '" +
+                     collection.name+"': "+str(e))
+        return False
+
+    for name in legacy_indexes:
+        if name in existing.keys():
+            try:
+                collection.drop_index(name)
+                existing.pop(name, None)
+                logger.info("Dropped legacy index '"+name +
+                            "' from collection '"+collection.name+"'.")
+            except Exception as e:
+                logger.warning("Couldn't drop legacy index '" +
+                               name+"': "+str(e))
+
+    for spec in index_specs:
+        keys = normalize_index_keys(spec["keys"])
+        unique = bool(spec["options"].get("unique", False))
+        same_keys = [n for n, i in existing.items(
+        ) if normalize_index_keys(i["key"]) == keys]
+        if spec["name"] in same_keys and bool(existing[spec["name"]].get("unique", False)) == unique:
+            continue  # already in place
+        try:
+            # migrate indexes with the same keys or the same name to the declared name and options
+            for n in sorted(set(same_keys + [spec["name"]])):
+                if n in existing.keys():
+                    collection.drop_index(n)
+                    existing.pop(n, None)
+                    logger.info("Dropped index '"+n+"' from collection '" +
+                                collection.name+"' to recreate it as declared.")
+            collection.create_index(
+                keys, name=spec["name"], **spec["options"])
+            logger.info("Created index '"+spec["name"] +
+                        "' in collection '"+collection.name+"'.")
+        except Exception as e:
+            logger.error("Couldn't create index '"+spec["name"]+"' in collection '" +
+                         collection.name+"': "+str(e))
+            result = False
+
+    return result
+
+
+def ensure_all_indexes(db_collection, zap_collection=None):
+    """
+    Creates or migrates all declared indexes for the SIAAS collections
+    Returns True if all OK; False if something failed
+    """
+    logger.info("Making sure all DB indexes are in place ...")
+    result = ensure_indexes(db_collection, MAIN_INDEXES, LEGACY_INDEXES)
+    if not ensure_indexes(siaas_aux.get_agent_latest_collection(db_collection), AGENT_LATEST_INDEXES):
+        result = False
+    if zap_collection != None:
+        if not ensure_indexes(zap_collection, ZAP_INDEXES):
+            logger.error(
+                "ZAP collection indexes are not in place. If there are duplicated targets, remove them and restart the server.")
+            result = False
+    return result
+
+
+def get_index_report(collection, index_specs):
+    """
+    Uses $indexStats to report declared indexes that are missing, and existing indexes that were never used since the DB started
+    Returns a dict with "missing", "unused" and "usage" (operations per index), or False if error
+    """
+    try:
+        stats = list(collection.aggregate([{"$indexStats": {}}]))
+    except Exception as e:
+        logger.error("Can't read index statistics from collection '" +
+                     collection.name+"': "+str(e))
+        return False
+
+    out_dict = {"missing": [], "unused": [], "usage": {}}
+    existing_names = []
+    for s in stats:
+        try:
+            existing_names.append(s["name"])
+            ops = int(s["accesses"]["ops"])
+            out_dict["usage"][s["name"]] = ops
+            if ops == 0 and s["name"] != "_id_":
+                out_dict["unused"].append(s["name"])
+        except:
+            logger.debug("Ignoring invalid entry when grabbing index stats.")
+    for spec in index_specs:
+        if spec["name"] not in existing_names:
+            out_dict["missing"].append(spec["name"])
+    return out_dict
+
+
+def find_collection_scans(collection, hot_queries):
+    """
+    Explains the hot queries and returns the list of those whose winning plan is a collection scan, or False if error
+    """
+    def plan_stages(plan):
+        stages = [plan.get("stage")]
+        for k in ["inputStage", "queryPlan"]:
+            if k in plan.keys():
+                stages += plan_stages(plan[k])
+        for p in plan.get("inputStages", []):
+            stages += plan_stages(p)
+        return stages
+
+    out_list = []
+    try:
+        for query_filter, query_sort in hot_queries:
+            cursor = collection.find(query_filter).limit(1)
+            if query_sort != None:
+                cursor = cursor.sort(query_sort)
+            winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            if "COLLSCAN" in plan_stages(winning_plan):
+                out_list.append(
+                    {"filter": str(query_filter), "sort": str(query_sort)})
+    except Exception as e:
+        logger.error("Can't explain queries in collection '" +
+                     collection.name+"': "+str(e))
+        return False
+    return out_list
+
+
+def log_index_report(db_collection):
+    """
+    Logs missing and unused indexes and hot queries that need collection scans, for the main and latest snapshot collections
+    """
+    for collection, index_specs in [(db_collection, MAIN_INDEXES), (siaas_aux.get_agent_latest_collection(db_collection), AGENT_LATEST_INDEXES)]:
+        report = get_index_report(collection, index_specs)
+        if report == False:
+            continue
+        if len(report["missing"]) > 0:
+            logger.warning("Missing indexes in collection '"+collection.name +
+                           "': "+", ".join(report["missing"]))
+        if len(report["unused"]) > 0:
+            logger.info("Indexes never used since the DB started in collection '" +
+                        collection.name+"': "+", ".join(report["unused"]))
+        logger.debug("Index usage in collection '" +
+                     collection.name+"': "+str(report["usage"]))
+
+    scans = find_collection_scans(db_collection, MAIN_HOT_QUERIES)
+    if scans != False:
+        for s in scans:
+            logger.warning("Hot query is doing a collection scan in collection '" +
+                           db_collection.name+"': "+s["filter"]+" sorted by "+s["sort"])
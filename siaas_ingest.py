@@ -0,0 +1,277 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - Ingest queue module (write-behind agent data uploads)
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import logging
+import os
+import sys
+import queue
+import threading
+import time
+from bson import json_util
+
+logger = logging.getLogger(__name__)
+
+INGEST_QUEUE = None
+INGEST_SPILL_FILE = None
+INGEST_SPILL_LOCK = threading.Lock()
+INGEST_METRICS_LOCK = threading.Lock()
+INGEST_METRICS = {
+    "accepted": 0,
+    "rejected": 0,
+    "written": 0,
+    "failed": 0,
+    "batches": 0,
+    "batch_retries": 0,
+    "replayed": 0,
+    "last_flush": None
+}
+
+
+def increment_metric(metric_name, value=1):
+    """
+    Increments an ingest queue counter
+    """
+    with INGEST_METRICS_LOCK:
+        INGEST_METRICS[metric_name] += value
+
+
+def is_enabled():
+    """
+    Returns True if the ingest queue is running (uploads are written behind); False if uploads are written synchronously
+    """
+    return INGEST_QUEUE != None
+
+
+def get_metrics():
+    """
+    Returns a dict with the ingest queue metrics
+    """
+    with INGEST_METRICS_LOCK:
+        metrics = dict(INGEST_METRICS)
+    metrics["enabled"] = is_enabled()
+    if is_enabled():
+        metrics["queue_size"] = INGEST_QUEUE.qsize()
+        metrics["queue_max_size"] = INGEST_QUEUE.maxsize
+        try:
+            metrics["spill_file_bytes"] = os.path.getsize(INGEST_SPILL_FILE)
+        except:
+            metrics["spill_file_bytes"] = 0
+    return metrics
+
+
+def submit(record):
+    """
+    Queues an agent data record (from siaas_aux.build_agent_data_record) to be written to the DB in the background
+    The record is appended to the spill file before being queued, so it can be replayed if the process dies
+    Returns the ingest ID (the record ID) if accepted; None if the queue is full or the spill file can't be written
+    """
+    with INGEST_SPILL_LOCK:
+        if INGEST_QUEUE.full():
+            increment_metric("rejected")
+            logger.warning(
+                "Ingest queue is full. Rejecting agent data upload ["+str(record["origin"])+"].")
+            return None
+        try:
+            with open(INGEST_SPILL_FILE, 'a') as file:
+                file.write(json_util.dumps(record)+"\n")
+                file.flush()
+        except Exception as e:
+            increment_metric("rejected")
+            logger.error("Can't write to the ingest spill file " +
+                         INGEST_SPILL_FILE+": "+str(e))
+            return None
+        INGEST_QUEUE.put_nowait(record)
+    increment_metric("accepted")
+    return str(record["_id"])
+
+
+def write_batch(collection, batch):
+    """
+    Inserts a batch of agent data records in the DB and updates the latest agent snapshot
+    Records that already exist (e.g. replayed from the spill file) count as written
+    Returns True if the batch was handled; False if the DB couldn't be reached and the batch must be retried
+    """
+    failed_records = siaas_aux.insert_many_in_mongodb_collection(
+        collection, batch)
+    if type(failed_records) == bool and failed_records == False:
+        return False
+    inserted_records = []
+    for r, record in enumerate(batch):
+        if r in failed_records.keys() and "E11000" not in failed_records[r]:
+            increment_metric("failed")
+            logger.error("Dropping agent data record that can't be inserted [" +
+                         str(record["origin"])+"]: "+failed_records[r])
+        else:
+            inserted_records.append(record)
+    siaas_aux.update_agent_latest(collection, inserted_records)
+    increment_metric("written", len(inserted_records))
+    increment_metric("batches")
+    with INGEST_METRICS_LOCK:
+        INGEST_METRICS["last_flush"] = siaas_aux.get_now_utc_str()
+    return True
+
+
+def compact_spill_file(max_bytes=67108864):
+    """
+    Empties the spill file if there are no queued records left (everything in it was already written)
+    Under constant load the queue might never drain, so a spill file bigger than max_bytes is rewritten with the queued records only
+    """
+    with INGEST_SPILL_LOCK:
+        try:
+            if INGEST_QUEUE.empty():
+                open(INGEST_SPILL_FILE, 'w').close()
+            elif os.path.getsize(INGEST_SPILL_FILE) > max_bytes:
+                with open(INGEST_SPILL_FILE+".tmp", 'w') as file:
+                    for record in list(INGEST_QUEUE.queue):
+                        file.write(json_util.dumps(record)+"\n")
+                os.replace(INGEST_SPILL_FILE+".tmp", INGEST_SPILL_FILE)
+        except Exception as e:
+            logger.error("Can't compact the ingest spill file " +
+                         INGEST_SPILL_FILE+": "+str(e))
+
+
+def replay_spill_file(collection, batch_size, spill_file=None):
+    """
+    Writes to the DB all records left in the spill file by a previous run, and empties it (the spill file of this process, if none is inputted)
+    Returns True if all OK; False if the records couldn't be written (the spill file is kept)
+    """
+    if spill_file == None:
+        spill_file = INGEST_SPILL_FILE
+    batch = []
+    count = 0
+    try:
+        if not os.path.exists(spill_file):
+            return True
+        with open(spill_file, 'r') as file:
+            for line in file:
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    batch.append(json_util.loads(line))
+                except:
+                    logger.warning(
+                        "Ignoring invalid line in the ingest spill file.")
+                    continue
+                if len(batch) >= batch_size:
+                    if not write_batch(collection, batch):
+                        return False
+                    count += len(batch)
+                    batch = []
+        if len(batch) > 0:
+            if not write_batch(collection, batch):
+                return False
+            count += len(batch)
+        open(spill_file, 'w').close()
+    except Exception as e:
+        logger.error("Can't replay the ingest spill file " +
+                     spill_file+": "+str(e))
+        return False
+    if count > 0:
+        logger.warning(str(count) +
+                       " agent data records were replayed from the ingest spill file "+spill_file+".")
+    increment_metric("replayed", count)
+    return True
+
+
+def replay_all_spill_files(collection, batch_size=500, spill_dir=os.path.join(sys.path[0], 'var')):
+    """
+    Replays the spill files of all API workers of a previous run (including workers that no longer exist, e.g. after lowering "api_workers")
+    Needs to be called by the main process before the API workers start, whatever the ingest mode is
+    Returns True if all OK; False if some spill file couldn't be replayed (it's kept, to be replayed later)
+    """
+    result = True
+    try:
+        spill_files = sorted([f for f in os.listdir(spill_dir) if f.startswith(
+            "ingest_spill") and f.endswith(".ndjson")])
+    except FileNotFoundError:
+        return True
+    except Exception as e:
+        logger.error("Can't list the ingest spill files: "+str(e))
+        return False
+    for f in spill_files:
+        if not replay_spill_file(collection, batch_size, spill_file=os.path.join(spill_dir, f)):
+            result = False
+    return result
+
+
+def writer_loop(collection, batch_size, flush_interval_sec):
+    """
+    Ingest writer thread loop: drains the queue and writes records in batches, when the batch is full or the flush interval has passed
+    Batches that fail because the DB is unreachable are retried with backoff, so no records are lost
+    """
+    while True:
+        batch = [INGEST_QUEUE.get()]
+        deadline = time.monotonic() + flush_interval_sec
+        while len(batch) < batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(INGEST_QUEUE.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        retry_sleep = 1
+        while not write_batch(collection, batch):
+            increment_metric("batch_retries")
+            logger.warning("Couldn't write "+str(len(batch)) +
+                           " queued agent data records. Retrying in "+str(retry_sleep)+" seconds ...")
+            time.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep*2, 60)
+
+        compact_spill_file()
+
+
+def start(collection, max_size=10000, batch_size=500, flush_interval_sec=1.0, spill_file=os.path.join(sys.path[0], 'var/ingest_spill.ndjson')):
+    """
+    Starts the write-behind ingest: replays any leftover spill file, creates the bounded queue and starts the writer thread
+    Returns True if started; False if something failed (uploads keep being written synchronously)
+    """
+    global INGEST_QUEUE, INGEST_SPILL_FILE
+
+    INGEST_SPILL_FILE = spill_file
+    try:
+        os.makedirs(os.path.dirname(INGEST_SPILL_FILE), exist_ok=True)
+        max_size = int(max_size)
+        batch_size = int(batch_size)
+        flush_interval_sec = float(flush_interval_sec)
+        if max_size < 1 or batch_size < 1 or flush_interval_sec <= 0:
+            raise ValueError("Ingest queue settings must be positive.")
+    except Exception as e:
+        logger.error("Can't start the ingest queue: "+str(e))
+        return False
+
+    if not replay_spill_file(collection, batch_size):
+        logger.error(
+            "Can't start the ingest queue, as the ingest spill file couldn't be replayed.")
+        return False
+
+    INGEST_QUEUE = queue.Queue(maxsize=max_size)
+    threading.Thread(target=writer_loop, args=(collection, batch_size, flush_interval_sec),
+                     name="IngestWriter", daemon=True).start()
+    logger.info("Ingest queue started (max size: "+str(max_size)+", batch size: "+str(
+        batch_size)+", flush interval: "+str(flush_interval_sec)+" sec).")
+    return True
+
+
+def start_from_config(collection, spill_file=os.path.join(sys.path[0], 'var/ingest_spill.ndjson')):
+    """
+    Starts the write-behind ingest if "ingest_mode" is configured as "queue", using the ingest configs (or their defaults)
+    Each API worker process needs its own spill file
+    Returns True if started; False if uploads are written synchronously
+    """
+    ingest_mode = siaas_aux.get_config_from_configs_db(
+        config_name="ingest_mode")
+    if str(ingest_mode or "sync").strip().lower() != "queue":
+        logger.debug(
+            "Ingest mode is not 'queue'. Agent data uploads are written synchronously.")
+        return False
+    return start(collection,
+                 max_size=siaas_aux.get_config_from_configs_db(
+                     config_name="ingest_queue_max_size") or 10000,
+                 batch_size=siaas_aux.get_config_from_configs_db(
+                     config_name="ingest_batch_size") or 500,
+                 flush_interval_sec=siaas_aux.get_config_from_configs_db(config_name="ingest_flush_interval_sec") or 1.0,
+                 spill_file=spill_file)
@@ -0,0 +1,104 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - JSON encoding module
+# By João Pedro Seara, 2022-2024
+
+import siaas_profiling
+import json
+import logging
+import time
+from datetime import date, datetime, timezone
+from bson.objectid import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Same format as the timestamps stored by the server (naive datetimes are in UTC)
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+if orjson != None:
+    ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_OMIT_MICROSECONDS | orjson.OPT_NON_STR_KEYS
+
+
+def default(obj):
+    """
+    Converts the types that JSON doesn't support natively (datetimes, ObjectIds, sets)
+    Raises TypeError for any other type
+    """
+    if isinstance(obj, datetime):
+        if obj.tzinfo != None:
+            obj = obj.astimezone(timezone.utc)
+        return obj.strftime(DATETIME_FORMAT)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Object of type "+type(obj).__name__ +
+                    " is not JSON serializable")
+
+
+def dumps_bytes(obj, indent=None):
+    """
+    Serializes an object to UTF-8 JSON bytes (uses orjson if it's installed, and the standard library if not)
+    The time it takes is added to the timings of the API request being served by the same thread
+    """
+    start = time.perf_counter()
+    try:
+        return encode_bytes(obj, indent=indent)
+    finally:
+        siaas_profiling.add_time("serialize", time.perf_counter()-start)
+
+
+def encode_bytes(obj, indent=None):
+    """
+    Serializes an object to UTF-8 JSON bytes, with orjson or the standard library
+    """
+    if orjson != None:
+        try:
+            if indent != None:
+                return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS | orjson.OPT_INDENT_2)
+            return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+        except (TypeError, orjson.JSONEncodeError) as e:  # e.g. integers bigger than 64 bits
+            logger.debug(
+                "Fast JSON encoder failed. Falling back to the standard JSON encoder: "+str(e))
+    if indent != None:
+        return json.dumps(obj, default=default, ensure_ascii=False, indent=indent).encode('utf-8')
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+
+def dumps(obj, indent=None):
+    """
+    Serializes an object to a JSON string (uses orjson if it's installed, and the standard library if not)
+    """
+    return dumps_bytes(obj, indent=indent).decode('utf-8')
+
+
+class SiaasJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that serializes responses with the fast encoder, keeping the key order (no sorting) and non-ASCII characters
+    Request bodies are still parsed by the standard library (it accepts NaN and integers bigger than 64 bits)
+    """
+    ensure_ascii = False
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if set(kwargs.keys()) - {"indent", "separators"}:  # unusual options: let the standard library handle them
+            kwargs.setdefault("default", default)
+            kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+            kwargs.setdefault("sort_keys", self.sort_keys)
+            return json.dumps(obj, **kwargs)
+        return dumps(obj, indent=kwargs.get("indent"))
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            body = dumps_bytes(obj, indent=2)
+        else:
+            body = dumps_bytes(obj)
+        return self._app.response_class(body+b"\n", mimetype=self.mimetype)
@@ -0,0 +1,284 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - Logging module
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import atexit
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler
+from logging.handlers import RotatingFileHandler
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s.%(msecs)03d %(levelname)-5s %(filename)s [%(processName)s|%(threadName)s] %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Queue where all processes (and their threads) put log records, and the thread that writes them to the log file
+# (created by the main process before the other processes are forked, so they inherit both the queue and the drop counter)
+LOG_QUEUE = None
+LOG_DROPPED = None
+LOG_LISTENER_THREAD = None
+LOG_FILE_HANDLER = None
+LOG_SETTINGS = {}
+
+# Bursts of debug logging from all processes need a big queue (each queued record takes around 1 KB of memory)
+LOG_QUEUE_SIZE = 50000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL_SEC = 1
+# How often the listener reports records dropped since the last report
+LOG_DROPPED_REPORT_SEC = 60
+# Configs read once at startup (protected: published server configs can't override them)
+LOG_CONFIGS = ["log_batch_size", "log_flush_interval_sec",
+               "log_format", "log_queue_size"]
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that never waits for the log queue: when it's full, the record is dropped and counted
+    """
+
+    def prepare(self, record):
+        """
+        Merges the arguments and the exception into the message, so the record can be pickled
+        (unlike the default, the record isn't formatted and copied, as this is the only handler)
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.msg += "\n"+logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+            record.exc_text = None
+        if record.stack_info:
+            record.msg += "\n"+record.stack_info
+            record.stack_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with LOG_DROPPED.get_lock():
+                LOG_DROPPED.value += 1
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler that leaves records in the file buffer until flush() is called (once per batch, by the listener)
+    The file size (in encoded bytes) is tracked in memory, instead of being checked on the disk for every record
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.size = None
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)+self.terminator
+            if msg.isascii():
+                size = len(msg)
+            else:
+                size = len(msg.encode(self.encoding or 'utf-8',
+                          self.errors or 'strict'))
+            if self.stream == None:
+                self.stream = self._open()
+                self.size = None
+            if self.size == None:
+                self.size = self.stream.seek(0, os.SEEK_END)
+            if self.maxBytes > 0 and self.size > 0 and self.size+size >= self.maxBytes:
+                self.doRollover()
+                if self.stream == None:
+                    self.stream = self._open()
+                self.size = 0
+            self.stream.write(msg)
+            self.size += size
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """
+    Formats each record as a JSON object in a single line (for log shippers)
+    Exceptions are already part of the message, as records are prepared by the queue handler
+    """
+
+    def format(self, record):
+        line = {"time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+                "level": record.levelname, "file": record.filename, "process": record.processName,
+                "pid": record.process, "thread": record.threadName, "message": record.getMessage()}
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+def get_logging_configs():
+    """
+    Returns the log format ("text" or "json"), the size of the log queue, the maximum records written per batch, and the maximum seconds between flushes
+    """
+    log_format = str(siaas_aux.get_config_from_configs_db(
+        config_name="log_format") or "text").strip().lower()
+    if log_format not in ["text", "json"]:
+        log_format = "text"
+    try:
+        queue_size = int(siaas_aux.get_config_from_configs_db(
+            config_name="log_queue_size"))
+        if queue_size < 1:
+            raise ValueError("Value needs to be positive.")
+    except:
+        queue_size = LOG_QUEUE_SIZE
+    try:
+        batch_size = int(siaas_aux.get_config_from_configs_db(
+            config_name="log_batch_size"))
+        if batch_size < 1:
+            raise ValueError("Value needs to be positive.")
+    except:
+        batch_size = LOG_BATCH_SIZE
+    try:
+        flush_interval_sec = float(siaas_aux.get_config_from_configs_db(
+            config_name="log_flush_interval_sec"))
+        if flush_interval_sec < 0:
+            raise ValueError("Value can't be negative.")
+    except:
+        flush_interval_sec = LOG_FLUSH_INTERVAL_SEC
+    return log_format, queue_size, batch_size, flush_interval_sec
+
+
+def listener_loop(file_handler, batch_size, flush_interval_sec):
+    """
+    Log listener thread loop (writes the queued records to the log file, flushing once per batch or after some time)
+    Stops when it gets None from the queue
+    """
+    pending = 0
+    last_flush = time.monotonic()
+    last_dropped_report = time.monotonic()
+    reported_dropped = 0
+    while True:
+        timeout = None
+        if pending > 0:
+            timeout = max(flush_interval_sec -
+                          (time.monotonic()-last_flush), 0)
+        try:
+            records = [LOG_QUEUE.get(timeout=timeout)]
+        except queue.Empty:
+            records = []
+        except (EOFError, OSError):
+            break
+        while len(records) > 0 and records[-1] != None and len(records) < batch_size:
+            try:
+                records.append(LOG_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        stop = len(records) > 0 and records[-1] == None
+        for record in records:
+            if record != None:
+                file_handler.handle(record)
+                pending += 1
+        if time.monotonic()-last_dropped_report >= LOG_DROPPED_REPORT_SEC or stop:
+            last_dropped_report = time.monotonic()
+            dropped = LOG_DROPPED.value
+            if dropped > reported_dropped:
+                file_handler.handle(logging.makeLogRecord({"name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                                                           "pathname": __file__, "filename": os.path.basename(__file__),
+                                                           "msg": "Logging couldn't keep up: "+str(dropped-reported_dropped)+" log records were dropped (full log queue)."}))
+                reported_dropped = dropped
+                pending += 1
+        if pending > 0 and (pending >= batch_size or stop or time.monotonic()-last_flush >= flush_interval_sec):
+            file_handler.flush()
+            pending = 0
+            last_flush = time.monotonic()
+        if stop:
+            break
+
+
+def start(log_file, log_level=logging.INFO, max_bytes=10240000, backup_count=3):
+    """
+    Sends the log records of this process (and of all processes forked from it afterwards) to a bounded queue,
+    and starts the thread that writes them to the rotating log file
+    Needs to be called once by the main process, before any other process is started
+    """
+    global LOG_QUEUE, LOG_DROPPED, LOG_LISTENER_THREAD, LOG_FILE_HANDLER
+    log_format, queue_size, batch_size, flush_interval_sec = get_logging_configs()
+    LOG_SETTINGS.update({"format": log_format, "queue_max_size": queue_size,
+                         "batch_size": batch_size, "flush_interval_sec": flush_interval_sec})
+    LOG_QUEUE = multiprocessing.Queue(maxsize=queue_size)
+    LOG_DROPPED = multiprocessing.Value('q', 0)
+    LOG_FILE_HANDLER = BatchRotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', errors='backslashreplace')
+    if log_format == "json":
+        LOG_FILE_HANDLER.setFormatter(JSONLinesFormatter())
+    else:
+        LOG_FILE_HANDLER.setFormatter(logging.Formatter(
+            LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    while len(logging.root.handlers) > 0:
+        logging.root.removeHandler(logging.root.handlers[-1])
+    logging.root.addHandler(NonBlockingQueueHandler(LOG_QUEUE))
+    logging.root.setLevel(log_level)
+    LOG_LISTENER_THREAD = threading.Thread(target=listener_loop, args=(
+        LOG_FILE_HANDLER, batch_size, flush_interval_sec), name="LogListener", daemon=True)
+    LOG_LISTENER_THREAD.start()
+    atexit.register(stop)
+
+
+def stop(timeout=5):
+    """
+    Writes the records still in the log queue to the log file and stops the listener thread (only in the main process)
+    """
+    if LOG_LISTENER_THREAD == None or not LOG_LISTENER_THREAD.is_alive():
+        return
+    try:
+        LOG_QUEUE.put(None, timeout=timeout)
+        LOG_LISTENER_THREAD.join(timeout=timeout)
+    except Exception as e:
+        print("Can't stop the log listener: "+str(e), file=sys.stderr)
+
+
+def get_metrics():
+    """
+    Returns a dict with the log queue counters
+    """
+    if LOG_QUEUE == None:
+        return {}
+    metrics = dict(LOG_SETTINGS)
+    metrics["dropped"] = LOG_DROPPED.value
+    try:
+        metrics["queue_size"] = LOG_QUEUE.qsize()
+    except NotImplementedError:
+        pass
+    return metrics
+
+
+if __name__ == "__main__":
+
+    print('\nThis script is being directly run, so it will log a burst of records from a few processes to a test log file!\n')
+
+    log_file = os.path.join(sys.path[0], "tmp/siaas-logging-test.log")
+    if len(sys.argv) > 1:
+        log_file = sys.argv[1]
+    os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+    start(log_file, log_level=logging.DEBUG)
+
+    def log_burst(records):
+        for i in range(records):
+            logger.debug("Test record "+str(i+1)+" of "+str(records)+".")
+
+    processes = [multiprocessing.Process(
+        target=log_burst, args=(20000,)) for i in range(4)]
+    start_time = time.perf_counter()
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter()-start_time
+    stop()
+    print(str(get_metrics()))
+    print("Logged by "+str(len(processes))+" processes in " +
+          f'{elapsed:.2f}'+" seconds. Log file: "+log_file)
+
+    print('\nAll done. Bye!\n')
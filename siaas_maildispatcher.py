@@ -0,0 +1,229 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - Mail dispatcher module
+# By João Pedro Seara, 2022-2024
+
+import logging
+import queue
+import smtplib
+import ssl
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Pending mail jobs (one job is a list of messages for the same recipients)
+MAIL_QUEUE = queue.Queue()
+MAIL_DISPATCHER_THREAD = None
+MAIL_DISPATCHER_LOCK = threading.Lock()
+
+# Open SMTP connection of the dispatcher thread ((server, port, account, starttls) -> (connection, last use time))
+SMTP_CONNECTION = {}
+
+MAIL_METRICS = {"sent": 0, "failed": 0, "retries": 0,
+                "batches": 0, "connections_opened": 0}
+
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_MIN_SEC = 10
+MAIL_RETRY_MAX_SEC = 600
+# SMTP servers drop idle connections, so the dispatcher closes them first
+SMTP_IDLE_TIMEOUT_SEC = 60
+SMTP_TIMEOUT_SEC = 60
+
+
+def get_smtp_connection(smtp_settings):
+    """
+    Returns an authenticated SMTP connection for the inputted settings, reusing the open one if it's still alive
+    Raises an exception if it can't connect
+    """
+    smtp_server, smtp_port, smtp_account, smtp_pwd, smtp_starttls = smtp_settings
+    key = (smtp_server, smtp_port, smtp_account, smtp_starttls)
+    if key in SMTP_CONNECTION.keys():
+        server, last_use = SMTP_CONNECTION[key]
+        try:
+            if server.noop()[0] == 250:
+                return server
+        except Exception as e:
+            logger.debug("SMTP connection is no longer valid: "+str(e))
+    close_smtp_connections()  # only one connection is kept open
+    logger.debug("Connecting to the SMTP server at " +
+                 str(smtp_server)+":"+str(smtp_port)+" ...")
+    server = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT_SEC)
+    try:
+        if smtp_starttls:
+            server.starttls(context=ssl.create_default_context())
+        server.ehlo_or_helo_if_needed()
+        if len(smtp_pwd or '') > 0 and server.has_extn("auth"):
+            server.login(smtp_account, smtp_pwd)
+    except:
+        server.close()
+        raise
+    SMTP_CONNECTION[key] = (server, time.monotonic())
+    MAIL_METRICS["connections_opened"] += 1
+    return server
+
+
+def close_smtp_connections(idle_only=False):
+    """
+    Closes the open SMTP connection (or only if it's idle for too long)
+    """
+    for key in list(SMTP_CONNECTION.keys()):
+        server, last_use = SMTP_CONNECTION[key]
+        if idle_only and time.monotonic()-last_use < SMTP_IDLE_TIMEOUT_SEC:
+            continue
+        SMTP_CONNECTION.pop(key, None)
+        try:
+            server.quit()
+        except:
+            server.close()
+
+
+def send_batch(smtp_settings, recipients, messages):
+    """
+    Sends a batch of messages to the same recipients, over a single SMTP connection
+    Returns the number of messages sent (it stops at the first failure)
+    """
+    smtp_server, smtp_port, smtp_account, smtp_pwd, smtp_starttls = smtp_settings
+    sent_count = 0
+    try:
+        server = get_smtp_connection(smtp_settings)
+        for message in messages:
+            server.sendmail(smtp_account, list(recipients), message.as_string())
+            sent_count += 1
+        SMTP_CONNECTION[(smtp_server, smtp_port, smtp_account, smtp_starttls)] = (
+            server, time.monotonic())
+    except Exception as e:
+        logger.warning("Error while sending email ("+str(sent_count) +
+                       " of "+str(len(messages))+" sent): "+str(e))
+        close_smtp_connections()
+    return sent_count
+
+
+def dispatch_jobs(jobs):
+    """
+    Groups mail jobs by SMTP settings and recipients, and sends each group as one batch (retrying with exponential backoff)
+    Job callbacks are called with True if all messages of the job were sent, or False if they weren't
+    """
+    batches = {}
+    for job in jobs:
+        batches.setdefault(
+            (job["smtp_settings"], job["recipients"]), []).append(job)
+
+    for (smtp_settings, recipients), batch_jobs in batches.items():
+        MAIL_METRICS["batches"] += 1
+        pending = [(job_number, message) for job_number in range(
+            len(batch_jobs)) for message in batch_jobs[job_number]["messages"]]
+        attempt = 1
+        while len(pending) > 0:
+            sent_count = send_batch(smtp_settings, recipients, [
+                                    message for (job_number, message) in pending])
+            MAIL_METRICS["sent"] += sent_count
+            pending = pending[sent_count:]
+            if len(pending) == 0:
+                break
+            if attempt >= MAIL_MAX_ATTEMPTS:
+                logger.error("Couldn't send "+str(len(pending)) +
+                             " emails after "+str(attempt)+" attempts. Giving up.")
+                MAIL_METRICS["failed"] += len(pending)
+                break
+            retry_sec = min(MAIL_RETRY_MIN_SEC*2**(attempt-1),
+                            MAIL_RETRY_MAX_SEC)
+            logger.info("Retrying to send "+str(len(pending)) +
+                        " emails in "+str(retry_sec)+" seconds ...")
+            MAIL_METRICS["retries"] += 1
+            time.sleep(retry_sec)
+            attempt += 1
+
+        failed_jobs = set([job_number for (job_number, message) in pending])
+        for job_number in range(len(batch_jobs)):
+            if batch_jobs[job_number]["callback"] != None:
+                try:
+                    batch_jobs[job_number]["callback"](
+                        job_number not in failed_jobs)
+                except Exception as e:
+                    logger.error("Error in the mail job callback: "+str(e))
+
+
+def dispatcher_loop():
+    """
+    Mail dispatcher thread loop (sends the queued mail jobs, batching all jobs that are pending at the same time)
+    """
+    while True:
+        try:
+            jobs = [MAIL_QUEUE.get(timeout=SMTP_IDLE_TIMEOUT_SEC)]
+        except queue.Empty:
+            close_smtp_connections(idle_only=True)
+            continue
+        while True:
+            try:
+                jobs.append(MAIL_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            dispatch_jobs(jobs)
+        except Exception as e:
+            logger.error("Error while dispatching emails: "+str(e))
+        for job in jobs:
+            MAIL_QUEUE.task_done()
+        logger.debug("Mail dispatcher counters: "+str(MAIL_METRICS))
+
+
+def submit(smtp_server, smtp_port, smtp_account, smtp_pwd, recipients, messages, smtp_starttls=True, callback=None):
+    """
+    Queues messages to be sent in the background, to a list of recipients (the dispatcher thread is started if needed)
+    The callback (optional) is called from the dispatcher thread with True if all messages were sent, or False if they weren't
+    """
+    global MAIL_DISPATCHER_THREAD
+    with MAIL_DISPATCHER_LOCK:
+        if MAIL_DISPATCHER_THREAD == None or not MAIL_DISPATCHER_THREAD.is_alive():
+            MAIL_DISPATCHER_THREAD = threading.Thread(
+                target=dispatcher_loop, name="MailDispatcher", daemon=True)
+            MAIL_DISPATCHER_THREAD.start()
+    MAIL_QUEUE.put({"smtp_settings": (smtp_server, int(smtp_port), smtp_account, smtp_pwd, smtp_starttls),
+                    "recipients": tuple(recipients), "messages": list(messages), "callback": callback})
+
+
+def flush():
+    """
+    Waits until all queued mail jobs are dispatched (sent or given up on)
+    """
+    MAIL_QUEUE.join()
+
+
+def get_metrics():
+    """
+    Returns a dict with the mail dispatcher counters
+    """
+    metrics = dict(MAIL_METRICS)
+    metrics["queue_size"] = MAIL_QUEUE.qsize()
+    return metrics
+
+
+if __name__ == "__main__":
+
+    from email.mime.text import MIMEText
+
+    log_level = logging.DEBUG
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-5s %(filename)s [%(threadName)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=log_level)
+
+    print('\nThis script is being directly run, so it will send test emails to a local SMTP server without TLS!')
+    print('(e.g. start one with: python3 -m aiosmtpd -n -l 127.0.0.1:1025)\n')
+
+    smtp_port = 1025
+    if len(sys.argv) > 1:
+        smtp_port = int(sys.argv[1])
+
+    messages = []
+    for i in range(3):
+        message = MIMEText("Test email "+str(i+1)+" of 3.", "plain")
+        message["Subject"] = "SIAAS mail dispatcher test ("+str(i+1)+")"
+        message["From"] = "siaas@localhost"
+        message["To"] = "test@localhost"
+        messages.append(message)
+    submit("127.0.0.1", smtp_port, "siaas@localhost", None, ["test@localhost"], messages, smtp_starttls=False,
+           callback=lambda result: print("\nAll sent: "+str(result)))
+    flush()
+    print(str(get_metrics()))
+
+    print('\nAll done. Bye!\n')
@@ -3,16 +3,22 @@
 # By João Pedro Seara, 2022-2024
 
 import siaas_aux
-import smtplib
-import ssl
+import siaas_maildispatcher
+import siaas_metrics
+import siaas_mongo
+import hashlib
 import csv
+import gzip
+import io
+import tempfile
+import zipfile
 import platform
 import json
 import os
 import sys
 import logging
+import threading
 import time
-from pathlib import Path
 from datetime import datetime
 from email.utils import formataddr
 from email.mime.text import MIMEText
@@ -22,33 +28,260 @@ from email.mime.application import MIMEApplication
 logger = logging.getLogger(__name__)
 
 
-def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp_server, smtp_tls_port, smtp_report_type, last_dict=None):
+# Last report state (report hash, and the data version and vulns hash of each agent), kept across restarts
+MAILER_STATE_FILE = os.path.join(sys.path[0], 'var/mailer_report_state.json')
+MAILER_STATE_LOCK = threading.RLock()
+
+# Reports handed to the mail dispatcher (report hash -> True if sent, False if not sent, None while pending)
+REPORT_DISPATCHES = {}
+
+
+def get_empty_report_state():
     """
-    Receives the DB collection and SMTP server details, and the last data dict that was sent
-    If changes are detected in the data dict, an email is sent. Otherwise, nothing happens
-    Returns the new data dict if all OK; Returns the last dict if no changes were detected or if something has failed
+    Returns a report state with no agents and no report sent
     """
-    logger.info("Generating a new email report to send ...")
+    return {"report_type": None, "report_hash": None, "agents": {}}
 
-    out_dict = siaas_aux.get_dict_current_agent_data(
-        db_collection, agent_uid=None, module="portscanner")
 
-    if out_dict == False:
-        logger.error(
-            "There was an error getting agent data to be sent in the email. Not sending any email.")
-        return last_dict
+def load_report_state(state_file=MAILER_STATE_FILE):
+    """
+    Reads the last report state from the local disk
+    Returns an empty report state if there's none or if it's invalid
+    """
+    if not os.path.exists(state_file):
+        return get_empty_report_state()
+    try:
+        with open(state_file, 'r') as file:
+            report_state = json.load(file)
+        if type(report_state.get("agents")) is not dict:
+            raise TypeError("Agents list is invalid.")
+    except Exception as e:
+        logger.warning(
+            "Couldn't read the last report state. The next report will be sent anyway: "+str(e))
+        return get_empty_report_state()
+    return report_state
 
-    new_dict = siaas_aux.grab_vulns_from_agent_data_dict(
-        out_dict, report_type=smtp_report_type)
 
-    if new_dict == False:
-        logger.error(
-            "There was an error parsing vulnerability data to be sent in the email. Not sending any email.")
-        return last_dict
+def save_report_state(report_state, state_file=MAILER_STATE_FILE):
+    """
+    Writes the report state to the local disk (extracted vulns are only kept in memory)
+    Returns True if all OK; False if NOK
+    """
+    persisted_state = {"report_type": report_state["report_type"],
+                       "report_hash": report_state["report_hash"], "agents": {}}
+    for uid, agent_state in report_state["agents"].items():
+        persisted_state["agents"][uid] = {"history_id": agent_state["history_id"],
+                                          "vulns_hash": agent_state["vulns_hash"]}
+    with MAILER_STATE_LOCK:
+        return siaas_aux.write_to_local_file(state_file, persisted_state)
+
+
+def apply_report_dispatches(report_state):
+    """
+    Updates the report state with the reports the mail dispatcher already sent
+    Returns a list with the hashes of the reports that are still pending
+    """
+    with MAILER_STATE_LOCK:
+        for report_hash in list(REPORT_DISPATCHES.keys()):
+            if REPORT_DISPATCHES[report_hash] == None:
+                continue
+            if REPORT_DISPATCHES.pop(report_hash):
+                report_state["report_hash"] = report_hash
+        return list(REPORT_DISPATCHES.keys())
+
+
+def get_hash(data):
+    """
+    Returns the SHA-256 hex digest of a JSON-serializable object
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def get_history_ids(report_state):
+    """
+    Returns a dict with the data version (history record ID) of each agent in the report state
+    """
+    history_ids = {}
+    for uid, agent_state in report_state["agents"].items():
+        history_ids[uid] = agent_state["history_id"]
+    return history_ids
+
+
+def update_report_state(db_collection, report_type, report_state):
+    """
+    Re-extracts the vulns of the agents whose latest data snapshot changed since the last report state (or that were never extracted by this process)
+    Returns the updated report state (without a new report hash), or False if something failed
+    """
+    latest_versions = siaas_aux.get_dict_agent_latest_versions(db_collection)
+    if latest_versions == False:
+        return False
+
+    if report_state["report_type"] == report_type:
+        agents_state = dict(report_state["agents"])
+    else:
+        agents_state = {}
+
+    changed_agents = []
+    for uid, history_id in latest_versions.items():
+        if uid not in agents_state.keys() or agents_state[uid]["history_id"] != history_id or "vulns" not in agents_state[uid].keys():
+            changed_agents.append(uid)
+    for uid in list(agents_state.keys()):
+        if uid not in latest_versions.keys():
+            agents_state.pop(uid, None)
+
+    if len(changed_agents) > 0:
+        logger.info("Extracting vulns from "+str(len(changed_agents)) +
+                    " out of "+str(len(latest_versions))+" agents ...")
+        if len(changed_agents) == len(latest_versions):
+            agent_uid = None
+        else:
+            agent_uid = ",".join(changed_agents)
+        out_dict = siaas_aux.get_dict_current_agent_data(
+            db_collection, agent_uid=agent_uid, module="portscanner")
+        if out_dict == False:
+            logger.error(
+                "There was an error getting agent data to be sent in the email.")
+            return False
+        vulns_dict = siaas_aux.grab_vulns_from_agent_data_dict(
+            out_dict, report_type=report_type)
+        if vulns_dict == False:
+            logger.error(
+                "There was an error parsing vulnerability data to be sent in the email.")
+            return False
+        for uid in changed_agents:
+            agent_vulns = vulns_dict.get(uid, {})
+            agents_state[uid] = {"history_id": latest_versions[uid],
+                                 "vulns_hash": get_hash(agent_vulns), "vulns": agent_vulns}
+
+    return {"report_type": report_type, "report_hash": report_state["report_hash"], "agents": agents_state}
+
+
+# Reports are streamed to memory, and only spill to a temporary file in ./tmp if they grow bigger than this
+REPORT_SPOOL_MAX_BYTES = 8388608
+REPORT_CSV_DELIMITER = ';'
+REPORT_CSV_HEADER = ["AgentUID", "TargetHost", "InformationType", "Findings"]
+
+
+def iter_report_rows(vulns_dict):
+    """
+    Yields the CSV report rows of a vuln dict (one row per agent, host and information type, with the findings in JSON)
+    """
+    findings_encoder = json.JSONEncoder(sort_keys=False, ensure_ascii=False)
+    for a, agent_vulns in vulns_dict.items():
+        for b, module_vulns in agent_vulns.items():
+            for c, host_vulns in module_vulns.items():
+                for d, findings in host_vulns.items():
+                    yield [a, c, d, findings_encoder.encode(findings)]
 
-    if str(new_dict) == str(last_dict) and last_dict != None:
+
+def open_report_part(csv_name, compression=None):
+    """
+    Creates a spooled buffer for a report part, and a CSV writer (with the header row already written) that streams to it, compressed if configured ('gzip' or 'zip')
+    Returns a dict with the attachment name, the buffer, the writer and the streams to close when the part is complete
+    """
+    report_part = {"buffer": tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX_BYTES, dir=os.path.join(sys.path[0], 'tmp')),
+                   "streams": []}
+    if compression == "gzip":
+        report_part["name"] = csv_name+".gz"
+        raw_stream = gzip.GzipFile(filename=csv_name, mode='wb',
+                                   compresslevel=6, fileobj=report_part["buffer"], mtime=0)
+        report_part["streams"].append(raw_stream)
+    elif compression == "zip":
+        report_part["name"] = os.path.splitext(csv_name)[0]+".zip"
+        zip_file = zipfile.ZipFile(
+            report_part["buffer"], mode='w', compression=zipfile.ZIP_DEFLATED)
+        raw_stream = zip_file.open(csv_name, mode='w', force_zip64=True)
+        report_part["streams"] += [raw_stream, zip_file]
+    else:
+        report_part["name"] = csv_name
+        raw_stream = report_part["buffer"]
+    report_part["text_stream"] = io.TextIOWrapper(
+        raw_stream, encoding='utf-8', newline='')
+    report_part["writer"] = csv.writer(
+        report_part["text_stream"], delimiter=REPORT_CSV_DELIMITER)
+    report_part["size"] = report_part["writer"].writerow(REPORT_CSV_HEADER)
+    return report_part
+
+
+def close_report_part(report_part):
+    """
+    Flushes and closes the streams of a report part, leaving its buffer open and rewound
+    """
+    report_part["text_stream"].flush()
+    report_part["text_stream"].detach()  # the buffer must stay open
+    for stream in report_part["streams"]:
+        stream.close()
+    report_part["buffer"].seek(0)
+
+
+def build_report_attachments(vulns_dict, csv_name, compression=None, max_part_bytes=0):
+    """
+    Streams the CSV report of a vuln dict to spooled buffers, starting a new part whenever a part has more than max_part_bytes of CSV data (0 means no limit)
+    Parts after the first have "_partN" in their names
+    Returns a list of (attachment name, buffer) with the buffers rewound (to be closed by the caller)
+    """
+    os.makedirs(os.path.join(sys.path[0], 'tmp'), exist_ok=True)
+    report_parts = [open_report_part(csv_name, compression)]
+    for row in iter_report_rows(vulns_dict):
+        if max_part_bytes > 0 and report_parts[-1]["size"] >= max_part_bytes:
+            close_report_part(report_parts[-1])
+            part_name = os.path.splitext(csv_name)[0]+"_part" + \
+                str(len(report_parts)+1)+os.path.splitext(csv_name)[1]
+            report_parts.append(open_report_part(part_name, compression))
+        report_parts[-1]["size"] += report_parts[-1]["writer"].writerow(row)
+    close_report_part(report_parts[-1])
+    return [(r["name"], r["buffer"]) for r in report_parts]
+
+
+def get_report_configs():
+    """
+    Returns the report compression ('gzip', 'zip' or None) and the maximum CSV size of each report part in bytes (0 means no limit), from the configuration DB (or their defaults)
+    """
+    compression = str(siaas_aux.get_config_from_configs_db(
+        config_name="mailer_report_compression") or '').strip().lower()
+    if compression not in ["gzip", "zip"]:
+        compression = None
+    try:
+        max_part_bytes = int(float(siaas_aux.get_config_from_configs_db(
+            config_name="mailer_report_max_part_mb"))*1024*1024)
+        if max_part_bytes < 0:
+            raise ValueError("Value can't be negative.")
+    except:
+        max_part_bytes = 15*1024*1024
+    return compression, max_part_bytes
+
+
+def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp_server, smtp_tls_port, smtp_report_type, report_state=None, smtp_starttls=True):
+    """
+    Receives the DB collection and SMTP server details, and the state of the last report that was sent
+    Only the agents whose data changed are re-extracted. If the report changed, it's queued in the mail dispatcher. Otherwise, nothing happens
+    Returns the new report state (also saved to the local disk, and again once the mail dispatcher sends the report)
+    """
+    logger.info("Generating a new email report to send ...")
+
+    if report_state == None:
+        report_state = get_empty_report_state()
+    pending_hashes = apply_report_dispatches(report_state)
+    smtp_report_type = smtp_report_type.lower()
+
+    new_state = update_report_state(
+        db_collection, smtp_report_type, report_state)
+    if new_state == False:
+        logger.error("Not sending any email.")
+        return report_state
+
+    new_dict = {}
+    for uid in sorted(new_state["agents"].keys(), key=lambda x: x.casefold()):
+        if len(new_state["agents"][uid]["vulns"]) > 0:
+            new_dict[uid] = new_state["agents"][uid]["vulns"]
+    report_hash = get_hash([smtp_report_type, [(uid, new_state["agents"][uid]["vulns_hash"])
+                           for uid in new_dict.keys()]])
+
+    if report_hash == report_state["report_hash"] or report_hash in pending_hashes:
         logger.info("No new data to report. Not sending any email.")
-        return last_dict
+        if get_history_ids(new_state) != get_history_ids(report_state):
+            save_report_state(new_state)
+        return new_state
 
     if smtp_report_type.lower() == "all":
         mail_type = "All scanned data"
@@ -60,7 +293,6 @@ def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp
         mail_type = "Vulnerabilities"
         csv_type = "vulns"
 
-    last_dict = new_dict
     signature = "Server UID: " + siaas_aux.get_or_create_unique_system_id() + \
         "\nServer IP: " + siaas_aux.get_main_ip_address()
 
@@ -71,104 +303,80 @@ def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp
         mail_body = "Report attached."
     mail_body = mail_body + "\n\n" + signature
 
-    # Create a CSV report
-
-    csv_contents = []
-    for a in new_dict.keys():
-        for b in new_dict[a].keys():
-            for c in new_dict[a][b].keys():
-                for d in new_dict[a][b][c].keys():
-                    csv_contents.append([a, c, d, json.dumps(
-                        new_dict[a][b][c][d], sort_keys=False, ensure_ascii=False)])
-
-    csv_delimiter = ';'
-    file_to_write = "./tmp/siaas_report_" + csv_type + "_" + siaas_aux.get_or_create_unique_system_id() + \
+    # Create a CSV report (streamed to memory, and split into many emails if it's too big)
+    csv_name = "siaas_report_" + csv_type + "_" + siaas_aux.get_or_create_unique_system_id() + \
         "_" + datetime.utcnow().strftime('%Y%m%d%H%M%S')+".csv"
-    os.makedirs(os.path.dirname(os.path.join(
-        sys.path[0], file_to_write)), exist_ok=True)
-    with open(file_to_write, 'w') as f:
-        w = csv.writer(f, delimiter=csv_delimiter)
-        w.writerow(["AgentUID", "TargetHost", "InformationType", "Findings"])
-        w.writerows(csv_contents)
-
-    # Message headers
-    message = MIMEMultipart("alternative")
-    message["Subject"] = "SIAAS Report ("+mail_type+") from "+platform.node().split('.', 1)[
-        0]+" on "+datetime.now().strftime('%Y-%m-%d at %H:%M')+" "+datetime.now().astimezone().tzname()
-    #message["From"] = smtp_account
-    message["From"] = formataddr(
-        ("SIAAS Server ("+platform.node().split('.', 1)[0]+")", smtp_account))
-    message["To"] = smtp_receivers
-
-    # Create the MIMEText object
-    part1 = MIMEText(mail_body, "plain")
-    message.attach(part1)
-
-    with open(file_to_write, "r") as file:
-        part = MIMEApplication(
-            file.read(),
-            Name=os.path.basename(file_to_write)
-        )
-    part['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(
-        file_to_write)
-
+    attachments = []
     if len(new_dict) > 0:
-        message.attach(part)
-
-    # Create secure connection with server and send email
-    try:
-        context = ssl.create_default_context()
-        smtp_receivers_list = sorted(set(smtp_receivers.split(
-            ',')), key=lambda x: x.casefold() if len(x or "") > 0 else "")
-        with smtplib.SMTP(smtp_server, smtp_tls_port) as server:
-            server.starttls(context=context)
-            server.login(smtp_account, smtp_pwd)
-            server.sendmail(
-                smtp_account, smtp_receivers_list, message.as_string()
+        compression, max_part_bytes = get_report_configs()
+        try:
+            attachments = build_report_attachments(
+                new_dict, csv_name, compression=compression, max_part_bytes=max_part_bytes)
+        except Exception as e:
+            logger.error("Error while generating the CSV report: "+str(e))
+            return new_state
+
+    messages = []
+    for part_number in range(max(len(attachments), 1)):
+
+        # Message headers
+        message = MIMEMultipart("alternative")
+        message["Subject"] = "SIAAS Report ("+mail_type+") from "+platform.node().split('.', 1)[
+            0]+" on "+datetime.now().strftime('%Y-%m-%d at %H:%M')+" "+datetime.now().astimezone().tzname()
+        if len(attachments) > 1:
+            message["Subject"] += " (part "+str(part_number+1) + \
+                " of "+str(len(attachments))+")"
+        #message["From"] = smtp_account
+        message["From"] = formataddr(
+            ("SIAAS Server ("+platform.node().split('.', 1)[0]+")", smtp_account))
+        message["To"] = smtp_receivers
+
+        # Create the MIMEText object
+        part1 = MIMEText(mail_body, "plain")
+        message.attach(part1)
+
+        if len(attachments) > 0:
+            attachment_name, attachment_buffer = attachments[part_number]
+            part = MIMEApplication(
+                attachment_buffer.read(),
+                Name=attachment_name
             )
-
-        Path(file_to_write).unlink(missing_ok=True)
-    except Exception as e:
-        logger.error("Error while sending email report: "+str(e))
-        return last_dict
-
-    logger.info("Report sent via email.")
-    logger.debug("Sent email contents:\n"+str(mail_body))
-    return new_dict
+            attachment_buffer.close()
+            part['Content-Disposition'] = 'attachment; filename="%s"' % attachment_name
+            message.attach(part)
+
+        messages.append(message)
+
+    def report_dispatched(sent):
+        with MAILER_STATE_LOCK:
+            REPORT_DISPATCHES[report_hash] = sent
+            if not sent:
+                logger.error(
+                    "Error while sending email report. It will be sent again in the next run.")
+                return
+            new_state["report_hash"] = report_hash
+            save_report_state(new_state)
+        logger.info("Report sent via email.")
+        logger.debug("Sent email contents:\n"+str(mail_body))
+
+    # Queue the emails in the mail dispatcher (sent in the background, over a reused SMTP connection)
+    smtp_receivers_list = sorted(set(smtp_receivers.split(
+        ',')), key=lambda x: x.casefold() if len(x or "") > 0 else "")
+    with MAILER_STATE_LOCK:
+        REPORT_DISPATCHES[report_hash] = None
+    save_report_state(new_state)  # keeps the old report hash until the report is sent
+    siaas_maildispatcher.submit(smtp_server, smtp_tls_port, smtp_account, smtp_pwd, smtp_receivers_list,
+                                messages, smtp_starttls=smtp_starttls, callback=report_dispatched)
+    logger.info("Report queued to be sent via email.")
+    return new_state
 
 
 def loop():
     """
     Mailer module loop (calls the email sending function)
     """
-    # Generate global variables from the configurations DB
-    config_dict = siaas_aux.get_config_from_configs_db(convert_to_string=True)
-    MONGO_USER = None
-    MONGO_PWD = None
-    MONGO_HOST = None
-    MONGO_PORT = None
-    MONGO_DB = None
-    MONGO_COLLECTION = None
-    for config_name in config_dict.keys():
-        if config_name.upper() == "MONGO_USER":
-            MONGO_USER = config_dict[config_name]
-        if config_name.upper() == "MONGO_PWD":
-            MONGO_PWD = config_dict[config_name]
-        if config_name.upper() == "MONGO_HOST":
-            MONGO_HOST = config_dict[config_name]
-        if config_name.upper() == "MONGO_PORT":
-            MONGO_PORT = config_dict[config_name]
-        if config_name.upper() == "MONGO_DB":
-            MONGO_DB = config_dict[config_name]
-        if config_name.upper() == "MONGO_COLLECTION":
-            MONGO_COLLECTION = config_dict[config_name]
-
-    if len(MONGO_PORT or '') > 0:
-        mongo_host_port = MONGO_HOST+":"+MONGO_PORT
-    else:
-        mongo_host_port = MONGO_HOST
-    db_collection = siaas_aux.connect_mongodb_collection(
-        MONGO_USER, MONGO_PWD, mongo_host_port, MONGO_DB, MONGO_COLLECTION)
+    # Get the collection from the shared DB client of this process
+    db_collection = siaas_mongo.get_collection_from_config()
 
     run = True
     if db_collection == None:
@@ -176,7 +384,7 @@ def loop():
             "No valid DB collection received. No DB maintenance will be performed.")
         run = False
 
-    last_dict = None
+    report_state = load_report_state()
     while run:
 
         send_mail = True
@@ -195,6 +403,8 @@ def loop():
             config_name="mailer_smtp_tls_port")
         mailer_smtp_report_type = siaas_aux.get_config_from_configs_db(
             config_name="mailer_smtp_report_type")
+        mailer_smtp_starttls = siaas_aux.validate_bool_string(siaas_aux.get_config_from_configs_db(
+            config_name="mailer_smtp_starttls"), default_output=True)
 
         if len(mailer_smtp_recipients or '') == 0:
             logger.info(
@@ -223,8 +433,11 @@ def loop():
                     "SMTP TLS port is invalid or not defined. Using SMTP TLS port default (587).")
 
             if send_mail:
-                last_dict = send_siaas_email(db_collection, mailer_smtp_account, mailer_smtp_pwd,
-                                             mailer_smtp_recipients, mailer_smtp_server, smtp_tls_port, mailer_smtp_report_type, last_dict)
+                cycle_start = time.perf_counter()
+                report_state = send_siaas_email(db_collection, mailer_smtp_account, mailer_smtp_pwd,
+                                                mailer_smtp_recipients, mailer_smtp_server, smtp_tls_port, mailer_smtp_report_type, report_state, smtp_starttls=mailer_smtp_starttls)
+                siaas_metrics.observe("mailer_cycle_duration", time.perf_counter(
+                )-cycle_start, report_type=mailer_smtp_report_type.lower())
 
         # Sleep before next loop
         try:
@@ -280,5 +493,6 @@ if __name__ == "__main__":
 
     send_siaas_email(collection, smtp_account, smtp_pwd,
                      smtp_receivers, smtp_server, smtp_tls_port, smtp_report_type)
+    siaas_maildispatcher.flush()
 
     print('\nAll done. Bye!\n')
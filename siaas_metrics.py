@@ -0,0 +1,124 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - Metrics module (Prometheus)
+# By João Pedro Seara, 2022-2024
+
+import functools
+import logging
+import os
+import sys
+import time
+
+# Directory where each process of the server writes its metric values, so they can be aggregated by any API worker
+# (needs to be defined before the Prometheus client is imported)
+METRICS_DIR = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(sys.path[0], 'tmp/metrics'))
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# All metrics have labels, so no process writes any value file before it records something
+METRICS = {}
+if prometheus_client != None:
+    METRICS["api_requests"] = prometheus_client.Counter(
+        "siaas_api_requests_total", "API requests", ["route", "method", "status"])
+    METRICS["api_request_duration"] = prometheus_client.Histogram(
+        "siaas_api_request_duration_seconds", "API request duration", ["route", "method"],
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+    METRICS["mongo_operation_duration"] = prometheus_client.Histogram(
+        "siaas_mongo_operation_duration_seconds", "Duration of the DB helper functions", ["operation"],
+        buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+    METRICS["ingest_documents"] = prometheus_client.Counter(
+        "siaas_ingest_documents_total", "Agent data documents accepted", ["agent"])
+    METRICS["ingest_bytes"] = prometheus_client.Counter(
+        "siaas_ingest_bytes_total", "Agent data bytes accepted", ["agent"])
+    METRICS["mailer_cycle_duration"] = prometheus_client.Histogram(
+        "siaas_mailer_cycle_duration_seconds", "Duration of the mailer report cycles", ["report_type"],
+        buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+    METRICS["dbmaintenance_runs"] = prometheus_client.Counter(
+        "siaas_dbmaintenance_runs_total", "DB maintenance cleanup runs", ["result"])
+    METRICS["dbmaintenance_deleted"] = prometheus_client.Counter(
+        "siaas_dbmaintenance_deleted_records_total", "Records deleted by the DB maintenance", ["scope"])
+
+
+def is_enabled():
+    """
+    Returns True if metrics are being recorded (the Prometheus client is installed); False if not
+    """
+    return prometheus_client != None
+
+
+def init_metrics_dir():
+    """
+    Creates the metrics directory, deleting the values left by processes of a previous run
+    Needs to be called once by the main process, before any metric is recorded
+    """
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        for metrics_file in os.listdir(METRICS_DIR):
+            if metrics_file.endswith(".db"):
+                os.remove(os.path.join(METRICS_DIR, metrics_file))
+    except Exception as e:
+        logger.error("Can't initialize the metrics directory: "+str(e))
+
+
+def increment(metric_name, value=1, **labels):
+    """
+    Increments a counter metric (nothing happens if metrics are disabled or can't be recorded)
+    """
+    if metric_name not in METRICS.keys():
+        return
+    try:
+        METRICS[metric_name].labels(**labels).inc(value)
+    except Exception as e:
+        logger.debug("Can't record metric "+metric_name+": "+str(e))
+
+
+def observe(metric_name, value, **labels):
+    """
+    Observes a value in a histogram metric (nothing happens if metrics are disabled or can't be recorded)
+    """
+    if metric_name not in METRICS.keys():
+        return
+    try:
+        METRICS[metric_name].labels(**labels).observe(value)
+    except Exception as e:
+        logger.debug("Can't record metric "+metric_name+": "+str(e))
+
+
+def time_db_operation(function):
+    """
+    Decorator that observes the duration of a DB helper function, labeled with the function name
+    """
+    if prometheus_client == None:
+        return function
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            observe("mongo_operation_duration", time.perf_counter() -
+                    start, operation=function.__name__)
+    return timed_function
+
+
+def get_metrics_output():
+    """
+    Returns the metrics of all processes of the server in the Prometheus text format, and its content type
+    Returns None (and None) if metrics are disabled or can't be read
+    """
+    if prometheus_client == None:
+        return None, None
+    try:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=METRICS_DIR)
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+    except Exception as e:
+        logger.error("Can't read the metrics: "+str(e))
+        return None, None
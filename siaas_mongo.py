@@ -0,0 +1,258 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - MongoDB connection manager
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import siaas_profiling
+import logging
+import os
+import sys
+import threading
+from pymongo import MongoClient, monitoring
+from urllib.parse import quote_plus
+
+logger = logging.getLogger(__name__)
+
+# One client per DB URI and per process (clients are not fork-safe, so children create their own)
+MONGO_CLIENTS = {}
+MONGO_CLIENTS_PID = os.getpid()
+MONGO_CLIENTS_LOCK = threading.Lock()
+
+POOL_STATS_LOCK = threading.Lock()
+POOL_STATS = {}
+
+# Client options and their configuration keys (Default: pymongo defaults, except for the ones below)
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": ("mongo_max_pool_size", int, 50),
+    "minPoolSize": ("mongo_min_pool_size", int, 0),
+    "maxIdleTimeMS": ("mongo_max_idle_time_ms", int, None),
+    "connectTimeoutMS": ("mongo_connect_timeout_ms", int, 10000),
+    "serverSelectionTimeoutMS": ("mongo_server_selection_timeout_ms", int, 10000),
+    "socketTimeoutMS": ("mongo_socket_timeout_ms", int, None),
+    "retryWrites": ("mongo_retry_writes", lambda x: siaas_aux.validate_bool_string(x, default_output=True), True),
+    "compressors": ("mongo_compressors", str, None),
+    "readPreference": ("mongo_read_preference", str, "primary"),
+}
+
+
+def reset_pool_stats():
+    """
+    Sets all connection pool counters of this process to zero
+    """
+    with POOL_STATS_LOCK:
+        POOL_STATS.clear()
+        for k in ["pools_created", "pools_cleared", "pools_closed", "connections_created", "connections_closed", "connections_checked_out", "connections_checked_in", "check_out_failures"]:
+            POOL_STATS[k] = 0
+
+
+def increment_pool_stat(stat_name):
+    """
+    Increments a connection pool counter
+    """
+    with POOL_STATS_LOCK:
+        POOL_STATS[stat_name] = POOL_STATS.get(stat_name, 0) + 1
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Counts connection pool events of the clients of this process
+    """
+
+    def pool_created(self, event):
+        increment_pool_stat("pools_created")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        increment_pool_stat("pools_cleared")
+
+    def pool_closed(self, event):
+        increment_pool_stat("pools_closed")
+
+    def connection_created(self, event):
+        increment_pool_stat("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        increment_pool_stat("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        increment_pool_stat("check_out_failures")
+
+    def connection_checked_out(self, event):
+        increment_pool_stat("connections_checked_out")
+
+    def connection_checked_in(self, event):
+        increment_pool_stat("connections_checked_in")
+
+
+class CommandTimingListener(monitoring.CommandListener):
+    """
+    Adds the duration of each DB command to the timings of the API request being served by the same thread
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        siaas_profiling.add_time("mongo", event.duration_micros/1000000)
+
+    def failed(self, event):
+        siaas_profiling.add_time("mongo", event.duration_micros/1000000)
+
+
+def reset_after_fork():
+    """
+    Forgets the clients inherited from the parent process, so a forked child creates its own (never closes them, as they belong to the parent)
+    """
+    global MONGO_CLIENTS, MONGO_CLIENTS_PID, MONGO_CLIENTS_LOCK
+    MONGO_CLIENTS = {}
+    MONGO_CLIENTS_PID = os.getpid()
+    MONGO_CLIENTS_LOCK = threading.Lock()
+    reset_pool_stats()
+
+
+def get_client_options():
+    """
+    Returns the MongoClient options from the configuration DB (or their defaults)
+    """
+    options = {}
+    for option, (config_name, convert, default) in MONGO_CLIENT_OPTIONS.items():
+        value = siaas_aux.get_config_from_configs_db(config_name=config_name)
+        try:
+            if len(str(value or '')) > 0:
+                value = convert(value)
+            else:
+                value = default
+        except:
+            logger.warning("Invalid value for '"+config_name +
+                           "'. Using the default: "+str(default))
+            value = default
+        if value != None:
+            options[option] = value
+    return options
+
+
+def get_client(mongo_user=None, mongo_password=None, mongo_host=None, mongo_db=None):
+    """
+    Returns the shared MongoClient of this process for the inputted DB, creating it with the configured pool options if needed
+    Returns None if it failed
+    """
+    if os.getpid() != MONGO_CLIENTS_PID:  # forked without the fork hook (shouldn't happen)
+        reset_after_fork()
+    try:
+        uri = "mongodb://%s:%s@%s/%s" % (quote_plus(mongo_user),
+                                         quote_plus(mongo_password), mongo_host, mongo_db)
+    except Exception as e:
+        logger.error("Invalid DB server connection details: "+str(e))
+        return None
+    with MONGO_CLIENTS_LOCK:
+        if uri in MONGO_CLIENTS.keys():
+            return MONGO_CLIENTS[uri]
+        try:
+            options = get_client_options()
+            logger.debug("Creating a new DB client for "+str(mongo_host) +
+                         " with options: "+str(options))
+            client = MongoClient(
+                uri, event_listeners=[PoolStatsListener(), CommandTimingListener()], **options)
+            MONGO_CLIENTS[uri] = client
+            return client
+        except Exception as e:
+            logger.error("Can't create a DB client: "+str(e))
+            return None
+
+
+def get_connection_details_from_config(local_dict=os.path.join(sys.path[0], 'var/config.db')):
+    """
+    Returns the DB user, password, host (with port) and DB name from the configuration DB (or from another configs DB file, if inputted)
+    """
+    config_dict = siaas_aux.get_config_from_configs_db(
+        local_dict=local_dict, convert_to_string=True)
+    details = {}
+    for config_name in ["mongo_user", "mongo_pwd", "mongo_host", "mongo_port", "mongo_db"]:
+        details[config_name] = None
+        for k in config_dict.keys():
+            if k.lower() == config_name:
+                details[config_name] = config_dict[k]
+    if len(details["mongo_port"] or '') > 0:
+        mongo_host_port = str(details["mongo_host"])+":"+details["mongo_port"]
+    else:
+        mongo_host_port = details["mongo_host"]
+    return details["mongo_user"], details["mongo_pwd"], mongo_host_port, details["mongo_db"]
+
+
+def get_collection(mongo_user=None, mongo_password=None, mongo_host=None, mongo_db=None, mongo_collection=None):
+    """
+    Returns a collection object from the shared client of this process
+    Returns None if it failed
+    """
+    logger.debug("Connecting to the DB server at "+str(mongo_host)+" ...")
+    client = get_client(mongo_user, mongo_password, mongo_host, mongo_db)
+    if client == None:
+        return None
+    try:
+        collection = client[mongo_db][mongo_collection]
+        logger.debug(
+            "Correctly configured the DB server connection to collection '"+mongo_collection+"'.")
+        return collection
+    except Exception as e:
+        logger.error("Can't connect to the DB server: "+str(e))
+        return None
+
+
+def get_collection_from_config(collection_config_name="mongo_collection", local_dict=os.path.join(sys.path[0], 'var/config.db')):
+    """
+    Returns a collection object from the shared client of this process, using the connection details from the configuration DB (or from another configs DB file, if inputted)
+    The collection name is read from the inputted config key (e.g. "mongo_collection" or "mongo_zap_collection")
+    Returns None if it failed
+    """
+    mongo_user, mongo_pwd, mongo_host_port, mongo_db = get_connection_details_from_config(
+        local_dict=local_dict)
+    mongo_collection = siaas_aux.get_config_from_configs_db(
+        local_dict=local_dict, config_name=collection_config_name)
+    if len(mongo_collection or '') == 0:
+        logger.error("No collection is configured in '" +
+                     collection_config_name+"'.")
+        return None
+    return get_collection(mongo_user, mongo_pwd, mongo_host_port, mongo_db, mongo_collection)
+
+
+def ping(mongo_user=None, mongo_password=None, mongo_host=None, mongo_db=None):
+    """
+    Returns True if the DB is alive, False if otherwise (uses the shared client of this process)
+    """
+    logger.debug("Pinging the DB server at "+str(mongo_host)+" ...")
+    try:
+        client = get_client(mongo_user, mongo_password, mongo_host, mongo_db)
+        client[mongo_db].command('ping')
+        logger.debug("DB replied to ping.")
+        return True
+    except:
+        logger.debug("DB didn't reply to ping.")
+        return False
+
+
+def get_pool_stats():
+    """
+    Returns a dict with the connection pool counters and client options of this process
+    """
+    with POOL_STATS_LOCK:
+        stats = dict(POOL_STATS)
+    stats["pid"] = os.getpid()
+    stats["clients"] = len(MONGO_CLIENTS)
+    stats["connections_open"] = stats["connections_created"] - \
+        stats["connections_closed"]
+    stats["connections_in_use"] = stats["connections_checked_out"] - \
+        stats["connections_checked_in"]
+    stats["options"] = get_client_options()
+    return stats
+
+
+reset_pool_stats()
+os.register_at_fork(after_in_child=reset_after_fork)
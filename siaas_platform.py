@@ -13,17 +13,350 @@ import ipaddress
 import logging
 import subprocess
 import pprint
+import bisect
+import json
+import threading
 import time
 from datetime import datetime
+from multiprocessing.sharedctypes import RawArray, RawValue
 
 start_time = time.time()
 
 logger = logging.getLogger(__name__)
 
+# Facts that don't change until the next boot (hardware, processor, cores, boot time), kept across restarts
+STATIC_FACTS_FILE = os.path.join(sys.path[0], 'var/platform_static.json')
+STATIC_FACTS = None
+
+DMIDECODE_STRINGS = {"manufacturer": "system-manufacturer", "product_name": "system-product-name",
+                     "version": "system-version", "serial_number": "system-serial-number", "bios_version": "bios-version"}
+DEVICETREE_STRINGS = {"product_name": "model",
+                      "serial_number": "serial-number"}
+
+# Sample history: one shared array of doubles per metric, used as a ring buffer (created before forking, so all processes see the same samples)
+HISTORY = None
+HISTORY_METRICS = ["time", "cpu_percent", "load_1min", "memory_used", "memory_percent", "swap_percent",
+                   "disk_read_bytes", "disk_written_bytes", "net_received_bytes", "net_sent_bytes"]
+# Cumulative counters: the history shows their rates (per second) instead of their values
+HISTORY_COUNTERS = ["disk_read_bytes", "disk_written_bytes",
+                    "net_received_bytes", "net_sent_bytes"]
+HISTORY_PERCENTILES = [50, 90, 95, 99]
+HISTORY_DEFAULT_SAMPLES = 720
+HISTORY_DEFAULT_SAMPLE_SEC = 5
+
+# Legacy (human-readable) format of each raw platform value, by key
+LEGACY_FORMATS = {"service_uptime": "duration", "load_percent": "percent", "usage_percent": "percent", "percent": "percent",
+                  "current_freq": "freq", "max_freq": "freq", "temp": "temp", "total": "size", "used": "size", "available": "size",
+                  "free": "size", "total_read": "size", "total_written": "size", "total_received": "size", "total_sent": "size"}
+
+
+def get_boot_id():
+    """
+    Returns an ID that is unique for each boot of the system (the boot time is used if the kernel doesn't provide one)
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id", 'r') as file:
+            return file.read().strip()
+    except:
+        return str(int(psutil.boot_time()))
+
+
+def collect_static_facts():
+    """
+    Grabs the platform facts that don't change until the next boot (it's slow: it runs dmidecode and reads the CPU info)
+    Returns a dict with the facts (and the boot ID they belong to), and whether all of them could be collected
+    """
+    logger.info("Grabbing static system information for this platform ...")
+
+    static_facts = {"boot_id": get_boot_id(), "hardware": {}}
+    complete = True
+
+    # Hardware
+    try:
+        if str(os.uname()[4]).lower().startswith("arm") or str(os.uname()[4]) == "aarch64":
+            for key, devicetree_string in DEVICETREE_STRINGS.items():
+                with open("/sys/firmware/devicetree/base/"+devicetree_string, 'r') as file:
+                    static_facts["hardware"][key] = file.read().strip().strip('\x00')
+        else:
+            for key, dmidecode_string in DMIDECODE_STRINGS.items():
+                static_facts["hardware"][key] = subprocess.check_output(
+                    ["dmidecode", "--string", dmidecode_string], universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except FileNotFoundError as e:  # no dmidecode or device tree in this platform: it won't change by collecting again
+        logger.warning("Couldn't get all hardware information: "+str(e))
+    except Exception as e:
+        logger.warning("Couldn't get all hardware information: "+str(e))
+        complete = False
+
+    # Processor and cores
+    try:
+        static_facts["processor"] = cpuinfo.get_cpu_info()['brand_raw']
+    except Exception as e:
+        logger.warning("Couldn't get the processor information: "+str(e))
+        complete = False
+    try:
+        static_facts["physical_cores"] = psutil.cpu_count(logical=False)
+        static_facts["logical_cores"] = psutil.cpu_count(logical=True)
+    except Exception as e:
+        logger.warning("Couldn't get the CPU core counts: "+str(e))
+        complete = False
+
+    # Boot Time
+    try:
+        static_facts["last_boot"] = datetime.utcfromtimestamp(
+            psutil.boot_time()).strftime('%Y-%m-%dT%H:%M:%SZ')
+    except Exception as e:
+        logger.warning("Couldn't grab boot time information: "+str(e))
+        complete = False
+
+    return static_facts, complete
+
+
+def get_static_facts(state_file=STATIC_FACTS_FILE):
+    """
+    Returns the static platform facts of the current boot
+    They are collected once per boot: kept in memory, and cached to the local disk for the next restarts
+    (if some of them couldn't be collected, nothing is cached, so they are collected again on the next call)
+    """
+    global STATIC_FACTS
+    boot_id = get_boot_id()
+    if STATIC_FACTS != None and STATIC_FACTS.get("boot_id") == boot_id:
+        return STATIC_FACTS
+
+    try:
+        with open(state_file, 'r') as file:
+            static_facts = json.load(file)
+        if static_facts.get("boot_id") == boot_id and type(static_facts.get("hardware")) is dict and "processor" in static_facts.keys() and "physical_cores" in static_facts.keys():
+            STATIC_FACTS = static_facts
+            return STATIC_FACTS
+        logger.debug(
+            "Static platform facts on disk are from a previous boot. Collecting them again ...")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(
+            "Couldn't read the static platform facts from the local disk: "+str(e))
+
+    static_facts, complete = collect_static_facts()
+    if not complete:
+        return static_facts
+    STATIC_FACTS = static_facts
+    if siaas_aux.write_to_local_file(state_file, STATIC_FACTS):
+        os.chmod(state_file, os.stat(state_file).st_mode & ~0o007)
+    return STATIC_FACTS
+
+
+def init_history(samples=None):
+    """
+    Creates the shared ring buffers of the sample history, with room for the configured number of samples
+    Needs to be called before the processes that record or read samples are forked
+    """
+    global HISTORY
+    if samples == None:
+        try:
+            samples = int(siaas_aux.get_config_from_configs_db(
+                config_name="platform_history_samples"))
+            if samples < 2:
+                raise ValueError("History needs at least 2 samples.")
+        except:
+            samples = HISTORY_DEFAULT_SAMPLES
+    HISTORY = {"capacity": samples, "count": RawValue('q', 0), "arrays": {}}
+    for metric in HISTORY_METRICS:
+        HISTORY["arrays"][metric] = RawArray('d', samples)
+    return HISTORY
+
+
+def take_sample():
+    """
+    Grabs the current value of each history metric (only cheap calls; the CPU load is the average since the previous sample)
+    Returns a dict with the numeric value of each metric
+    """
+    svmem = psutil.virtual_memory()
+    disk_io = psutil.disk_io_counters()
+    net_io = psutil.net_io_counters()
+    return {"time": time.time(), "cpu_percent": psutil.cpu_percent(), "load_1min": os.getloadavg()[0],
+            "memory_used": svmem.used, "memory_percent": svmem.percent, "swap_percent": psutil.swap_memory().percent,
+            "disk_read_bytes": disk_io.read_bytes if disk_io != None else 0, "disk_written_bytes": disk_io.write_bytes if disk_io != None else 0,
+            "net_received_bytes": net_io.bytes_recv, "net_sent_bytes": net_io.bytes_sent}
+
+
+def record_sample(sample):
+    """
+    Writes a sample to the next slot of the ring buffers (overwriting the oldest sample when they're full)
+    """
+    count = HISTORY["count"].value
+    slot = count % HISTORY["capacity"]
+    for metric in HISTORY_METRICS:
+        HISTORY["arrays"][metric][slot] = sample[metric]
+    HISTORY["count"].value = count+1  # the sample is only visible to readers after all metrics are written
+
+
+def sampler_loop():
+    """
+    Sampler thread loop (records a sample of the history metrics at a fixed rate)
+    """
+    psutil.cpu_percent()  # the first call has no previous sample to compare with
+    next_time = time.monotonic()
+    while True:
+        try:
+            sample_sec = float(siaas_aux.get_config_from_configs_db(
+                config_name="platform_history_sample_sec"))
+            if sample_sec <= 0:
+                raise ValueError("Sample interval must be positive.")
+        except:
+            sample_sec = HISTORY_DEFAULT_SAMPLE_SEC
+        next_time = max(next_time+sample_sec, time.monotonic())
+        time.sleep(next_time-time.monotonic())
+        try:
+            record_sample(take_sample())
+        except Exception as e:
+            logger.error("Couldn't record a platform sample: "+str(e))
+
+
+def start_sampler():
+    """
+    Starts the sampler thread (and creates the sample history, if it wasn't created before forking)
+    """
+    if HISTORY == None:
+        init_history()
+    sampler = threading.Thread(
+        target=sampler_loop, name="PlatformSampler", daemon=True)
+    sampler.start()
+    return sampler
+
+
+def get_history_samples(window_sec=None):
+    """
+    Returns a dict with the list of values of each history metric (oldest first), for the samples inside the time window
+    Samples that may have been overwritten while they were being read are left out. Returns None if there's no sample history
+    """
+    if HISTORY == None:
+        return None
+    capacity = HISTORY["capacity"]
+    count = HISTORY["count"].value
+    samples = {}
+    for metric in HISTORY_METRICS:
+        values = HISTORY["arrays"][metric][:]
+        if count > capacity:
+            slot = count % capacity
+            values = values[slot:]+values[:slot]
+        else:
+            values = values[:count]
+        samples[metric] = values
+    # the sampler writes the slot of the oldest sample next (and might have written more slots meanwhile)
+    overwritten = max(HISTORY["count"].value-capacity+1 -
+                      max(count-capacity, 0), 0)
+    first = overwritten
+    if window_sec != None and len(samples["time"]) > 0:
+        first = max(first, bisect.bisect_left(
+            samples["time"], samples["time"][-1]-window_sec))
+    if first > 0:
+        for metric in HISTORY_METRICS:
+            samples[metric] = samples[metric][first:]
+    return samples
+
+
+def get_percentile(sorted_values, percent):
+    """
+    Returns the percentile of a sorted list of values (linear interpolation between the closest ranks)
+    """
+    position = (len(sorted_values)-1)*percent/100
+    lower = int(position)
+    upper = min(lower+1, len(sorted_values)-1)
+    return sorted_values[lower]+(sorted_values[upper]-sorted_values[lower])*(position-lower)
+
+
+def get_stats(values):
+    """
+    Returns a dict with the average, minimum, maximum and percentiles of a list of values
+    Returns None if the list is empty
+    """
+    if len(values) == 0:
+        return None
+    sorted_values = sorted(values)
+    stats = {"avg": round(sum(values)/len(values), 2),
+             "min": round(sorted_values[0], 2), "max": round(sorted_values[-1], 2)}
+    for percent in HISTORY_PERCENTILES:
+        stats["p"+str(percent)] = round(get_percentile(sorted_values, percent), 2)
+    return stats
+
+
+def get_history(window_sec=None):
+    """
+    Returns a dict with the statistics of the history metrics inside the time window (the rates of the cumulative counters are per second)
+    Returns None if there's no sample history
+    """
+    samples = get_history_samples(window_sec)
+    if samples == None:
+        return None
+    times = samples["time"]
+    history = {"samples": len(times), "window_sec": window_sec}
+    if len(times) > 0:
+        history["from"] = datetime.utcfromtimestamp(
+            times[0]).strftime('%Y-%m-%dT%H:%M:%SZ')
+        history["to"] = datetime.utcfromtimestamp(
+            times[-1]).strftime('%Y-%m-%dT%H:%M:%SZ')
+    history["metrics"] = {}
+    for metric in HISTORY_METRICS:
+        if metric == "time":
+            continue
+        if metric not in HISTORY_COUNTERS:
+            history["metrics"][metric] = get_stats(samples[metric])
+            continue
+        rates = []
+        for i in range(1, len(times)):
+            elapsed = times[i]-times[i-1]
+            delta = samples[metric][i]-samples[metric][i-1]
+            if elapsed > 0 and delta >= 0:  # counters are reset when devices come and go
+                rates.append(delta/elapsed)
+        history["metrics"][metric.replace("_bytes", "_bytes_per_sec")] = get_stats(rates)
+    return history
+
+
+def get_latest_sample():
+    """
+    Returns a dict with the most recent sample of the history metrics, or None if there's none
+    """
+    if HISTORY == None or HISTORY["count"].value == 0:
+        return None
+    slot = (HISTORY["count"].value-1) % HISTORY["capacity"]
+    return {metric: HISTORY["arrays"][metric][slot] for metric in HISTORY_METRICS}
+
+
+def get_legacy_value(legacy_format, value):
+    """
+    Returns the human-readable string of a raw platform value (e.g. "12.3 %", "1.17 GB", "1500.00 MHz")
+    """
+    if legacy_format == "duration":
+        return siaas_aux.convert_sec_to_pretty_format(int(value))
+    if legacy_format == "percent":
+        return str(value)+" %"
+    if legacy_format == "freq":
+        return f'{value/1000000:.2f}'+" MHz"
+    if legacy_format == "temp":
+        return f'{value:.2f}'+" C"
+    return siaas_aux.get_size(value)
+
+
+def get_legacy_view(platform_dict):
+    """
+    Returns a copy of the raw platform dict with its numeric values converted to the legacy human-readable strings
+    """
+    legacy_dict = {}
+    for key, value in platform_dict.items():
+        if isinstance(value, dict):
+            legacy_dict[key] = get_legacy_view(value)
+        elif key in LEGACY_FORMATS.keys() and type(value) in (int, float):
+            legacy_dict[key] = get_legacy_value(LEGACY_FORMATS[key], value)
+        else:
+            legacy_dict[key] = value
+    return legacy_dict
+
 
 def main(version="N/A"):
     """
     Main platform function (grabs all hardware information)
+    Static facts are only collected once per boot, so each run only grabs the dynamic metrics (CPU, memory, IO, network)
+    Values are raw numbers (bytes, percentages, Hz, Celsius degrees, seconds). Use get_legacy_view() for the human-readable strings
     """
     logger.info("Grabbing all system information for this platform ...")
 
@@ -31,31 +364,14 @@ def main(version="N/A"):
 
     platform["version"] = version
     platform["uid"] = siaas_aux.get_or_create_unique_system_id()
-    platform["service_uptime"] = siaas_aux.convert_sec_to_pretty_format(
-        int(time.time() - start_time))
+    platform["service_uptime"] = int(time.time() - start_time)
     platform["system_info"] = {}
 
+    static_facts = get_static_facts()
+
     # Hardware
-    try:
-        platform["system_info"]["hardware"] = {}
-        if str(os.uname()[4]).lower().startswith("arm") or str(os.uname()[4]) == "aarch64":
-            platform["system_info"]["hardware"]["product_name"] = subprocess.check_output(
-                "cat /sys/firmware/devicetree/base/model", universal_newlines=True, shell=True).strip().strip('\x00')
-            platform["system_info"]["hardware"]["serial_number"] = subprocess.check_output(
-                "cat /sys/firmware/devicetree/base/serial-number", universal_newlines=True, shell=True).strip().strip('\x00')
-        else:
-            platform["system_info"]["hardware"]["manufacturer"] = subprocess.check_output(
-                "dmidecode --string system-manufacturer", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["product_name"] = subprocess.check_output(
-                "dmidecode --string system-product-name", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["version"] = subprocess.check_output(
-                "dmidecode --string system-version", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["serial_number"] = subprocess.check_output(
-                "dmidecode --string system-serial-number", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["bios_version"] = subprocess.check_output(
-                "dmidecode --string bios-version", universal_newlines=True, shell=True).strip()
-    except Exception as e:
-        logger.warning("Couldn't get all hardware information: "+str(e))
+    platform["system_info"]["hardware"] = dict(
+        static_facts.get("hardware") or {})
 
     # OS and Arch
     try:
@@ -66,8 +382,7 @@ def main(version="N/A"):
         platform["system_info"]["system"]["kernel"] = uname.release
         platform["system_info"]["system"]["flavor"] = uname.version
         platform["system_info"]["system"]["arch"] = uname.machine
-        platform["system_info"]["system"]["processor"] = cpuinfo.get_cpu_info()[
-            'brand_raw']
+        platform["system_info"]["system"]["processor"] = static_facts.get("processor")
     except Exception as e:
         logger.warning(
             "Couldn't get all OS and architecture information: "+str(e))
@@ -75,19 +390,23 @@ def main(version="N/A"):
     # CPU information
     try:
         platform["system_info"]["cpu"] = {}
-        platform["system_info"]["cpu"]["load_percent"] = str(
-            psutil.cpu_percent())+" %"
-        platform["system_info"]["cpu"]["physical_cores"] = psutil.cpu_count(
-            logical=False)
-        platform["system_info"]["cpu"]["logical_cores"] = psutil.cpu_count(
-            logical=True)
+        latest_sample = get_latest_sample()
+        if latest_sample != None:  # average since the previous sample of the sampler thread
+            cpu_percent = latest_sample["cpu_percent"]
+        else:
+            cpu_percent = psutil.cpu_percent(interval=1)
+        platform["system_info"]["cpu"]["load_percent"] = cpu_percent
+        platform["system_info"]["cpu"]["physical_cores"] = static_facts.get("physical_cores")
+        platform["system_info"]["cpu"]["logical_cores"] = static_facts.get("logical_cores")
         cpu_freq = psutil.cpu_freq()
-        platform["system_info"]["cpu"]["current_freq"] = f'{float(str(cpu_freq.current)):.2f}'+" MHz"
-        if float(str(cpu_freq.max)) > 0:
-            platform["system_info"]["cpu"]["max_freq"] = f'{float(str(cpu_freq.max)):.2f}'+" MHz"
+        platform["system_info"]["cpu"]["current_freq"] = float(
+            cpu_freq.current)*1000000
+        if float(cpu_freq.max) > 0:
+            platform["system_info"]["cpu"]["max_freq"] = float(
+                cpu_freq.max)*1000000
         with open("/sys/class/thermal/thermal_zone0/temp", 'r') as file:
             current_temp = file.readline()
-        platform["system_info"]["cpu"]["temp"] = f'{(float(str(current_temp))/1000):.2f}'+" C"
+        platform["system_info"]["cpu"]["temp"] = float(current_temp)/1000
     except Exception as e:
         logger.warning("Couldn't get all CPU information: "+str(e))
 
@@ -95,24 +414,16 @@ def main(version="N/A"):
     try:
         svmem = psutil.virtual_memory()
         platform["system_info"]["memory"] = {}
-        platform["system_info"]["memory"]["usage_percent"] = str(
-            svmem.percent)+" %"
-        platform["system_info"]["memory"]["total"] = siaas_aux.get_size(
-            svmem.total)
-        platform["system_info"]["memory"]["used"] = siaas_aux.get_size(
-            svmem.used)
-        platform["system_info"]["memory"]["available"] = siaas_aux.get_size(
-            svmem.available)
+        platform["system_info"]["memory"]["usage_percent"] = svmem.percent
+        platform["system_info"]["memory"]["total"] = svmem.total
+        platform["system_info"]["memory"]["used"] = svmem.used
+        platform["system_info"]["memory"]["available"] = svmem.available
         swap = psutil.swap_memory()
         platform["system_info"]["memory"]["swap"] = {}
-        platform["system_info"]["memory"]["swap"]["usage_percent"] = str(
-            swap.percent)+" %"
-        platform["system_info"]["memory"]["swap"]["total"] = siaas_aux.get_size(
-            swap.total)
-        platform["system_info"]["memory"]["swap"]["used"] = siaas_aux.get_size(
-            swap.used)
-        platform["system_info"]["memory"]["swap"]["free"] = siaas_aux.get_size(
-            swap.free)
+        platform["system_info"]["memory"]["swap"]["usage_percent"] = swap.percent
+        platform["system_info"]["memory"]["swap"]["total"] = swap.total
+        platform["system_info"]["memory"]["swap"]["used"] = swap.used
+        platform["system_info"]["memory"]["swap"]["free"] = swap.free
     except Exception as e:
         logger.warning("Couldn't get all memory information: "+str(e))
 
@@ -132,21 +443,15 @@ def main(version="N/A"):
                 platform["system_info"]["io"]["volumes"][partition.device]["usage"] = {}
                 try:
                     partition_usage = psutil.disk_usage(partition.mountpoint)
-                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["percent"] = str(
-                        partition_usage.percent)+" %"
-                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["total"] = siaas_aux.get_size(
-                        partition_usage.total)
-                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["used"] = siaas_aux.get_size(
-                        partition_usage.used)
-                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["free"] = siaas_aux.get_size(
-                        partition_usage.free)
+                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["percent"] = partition_usage.percent
+                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["total"] = partition_usage.total
+                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["used"] = partition_usage.used
+                    platform["system_info"]["io"]["volumes"][partition.device]["usage"]["free"] = partition_usage.free
                 except:
                     pass
         disk_io = psutil.disk_io_counters()
-        platform["system_info"]["io"]["total_read"] = siaas_aux.get_size(
-            disk_io.read_bytes)
-        platform["system_info"]["io"]["total_written"] = siaas_aux.get_size(
-            disk_io.write_bytes)
+        platform["system_info"]["io"]["total_read"] = disk_io.read_bytes
+        platform["system_info"]["io"]["total_written"] = disk_io.write_bytes
     except Exception as e:
         logger.warning(
             "Couldn't get all IO information and statistics: "+str(e))
@@ -176,22 +481,15 @@ def main(version="N/A"):
             if len(list_addr_mask) > 0:
                 platform["system_info"]["network"]["interfaces"][interface_name] = list_addr_mask
         net_io = psutil.net_io_counters()
-        platform["system_info"]["network"]["total_received"] = siaas_aux.get_size(
-            net_io.bytes_recv)
-        platform["system_info"]["network"]["total_sent"] = siaas_aux.get_size(
-            net_io.bytes_sent)
+        platform["system_info"]["network"]["total_received"] = net_io.bytes_recv
+        platform["system_info"]["network"]["total_sent"] = net_io.bytes_sent
     except Exception as e:
         logger.warning(
             "Couldn't get all network information and statistics: "+str(e))
 
     # Boot Time
-    try:
-        boot_time_timestamp = psutil.boot_time()
-        bt = datetime.utcfromtimestamp(
-            boot_time_timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
-        platform["system_info"]["last_boot"] = str(bt)
-    except Exception as e:
-        logger.warning("Couldn't grab boot time information: "+str(e))
+    if "last_boot" in static_facts.keys():
+        platform["system_info"]["last_boot"] = static_facts["last_boot"]
 
     platform["last_check"] = siaas_aux.get_now_utc_str()
 
@@ -211,6 +509,12 @@ def loop(version=""):
     os.chmod(os.path.join(sys.path[0], 'var/platform.db'), os.stat(
         os.path.join(sys.path[0], 'var/platform.db')).st_mode & ~0o007)
 
+    # Collecting the static facts once, at startup
+    get_static_facts()
+
+    # Recording samples of the dynamic metrics in the background
+    start_sampler()
+
     while True:
 
         platform_dict = {}
@@ -247,7 +551,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     print('\n')
-    output = main()
+    output = get_legacy_view(main())
     print('\nOutput is:\n')
     pprint.pprint(output, sort_dicts=False)
 
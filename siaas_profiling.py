@@ -0,0 +1,204 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - Request timing and profiling
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import cProfile
+import heapq
+import itertools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Timings of the request being served by each thread (total, mongo, serialize, compress, ...)
+REQUEST_TIMINGS = threading.local()
+
+PROFILES_DIR = os.path.join(sys.path[0], 'tmp/profiles')
+
+# Stack samples of the requests being served while the slowest requests profiler is on (thread ID -> {collapsed stack: count})
+SAMPLED_REQUESTS = {}
+SAMPLED_REQUESTS_LOCK = threading.Lock()
+SAMPLER_THREAD = None
+SAMPLER_INTERVAL_SEC = 0.005
+# Profiles kept for the slowest requests of this process (min-heap of (duration, file))
+SLOWEST_PROFILES = []
+SLOWEST_PROFILES_LOCK = threading.Lock()
+PROFILE_NUMBERS = itertools.count(1)
+
+
+def start_request():
+    """
+    Starts timing the request of the current thread
+    """
+    REQUEST_TIMINGS.start = time.perf_counter()
+    REQUEST_TIMINGS.durations = {}
+    REQUEST_TIMINGS.counts = {}
+
+
+def add_time(name, seconds):
+    """
+    Adds time spent on something (e.g. "mongo") to the request of the current thread (nothing happens outside requests)
+    """
+    durations = getattr(REQUEST_TIMINGS, "durations", None)
+    if durations == None:
+        return
+    durations[name] = durations.get(name, 0)+seconds
+    REQUEST_TIMINGS.counts[name] = REQUEST_TIMINGS.counts.get(name, 0)+1
+
+
+def end_request():
+    """
+    Stops timing the request of the current thread
+    Returns the total time, a dict with the time spent on each thing, and a dict with how many times each thing was done (or None, None, None)
+    """
+    durations = getattr(REQUEST_TIMINGS, "durations", None)
+    if durations == None:
+        return None, None, None
+    total = time.perf_counter()-REQUEST_TIMINGS.start
+    counts = REQUEST_TIMINGS.counts
+    REQUEST_TIMINGS.durations = None
+    return total, durations, counts
+
+
+def get_server_timing(total, durations, counts, response_size=None):
+    """
+    Returns the value of the Server-Timing header (durations in milliseconds; "app" is the time not spent on the other items)
+    """
+    items = []
+    for name in sorted(durations.keys()):
+        items.append(name+";dur="+f'{durations[name]*1000:.2f}' +
+                     ";desc=\""+str(counts[name])+"x\"")
+    items.append(
+        "app;dur="+f'{max(total-sum(durations.values()), 0)*1000:.2f}')
+    items.append("total;dur="+f'{total*1000:.2f}')
+    if response_size != None:
+        items.append("size;desc=\""+str(response_size)+" bytes\"")
+    return ", ".join(items)
+
+
+def get_profiling_configs():
+    """
+    Returns if the Server-Timing header is on, if profiling single requests ("?profile=1") is allowed, and how many of the slowest requests to profile
+    """
+    server_timing = siaas_aux.validate_bool_string(siaas_aux.get_config_from_configs_db(
+        config_name="api_server_timing"), default_output=True)
+    profiling = siaas_aux.validate_bool_string(siaas_aux.get_config_from_configs_db(
+        config_name="api_profiling"), default_output=False)
+    try:
+        slowest = int(siaas_aux.get_config_from_configs_db(
+            config_name="api_profile_slowest"))
+        if slowest < 0:
+            raise ValueError("Value can't be negative.")
+    except:
+        slowest = 0
+    return server_timing, profiling, slowest
+
+
+def get_profile_file_name(route, extension, duration=None):
+    """
+    Returns the path of a new profile file for a route (inside the profiles directory)
+    """
+    name = re.sub('[^A-Za-z0-9_-]+', '_', route).strip('_') or "index"
+    if duration != None:
+        name = f'{duration*1000:.0f}'+"ms_"+name
+    return os.path.join(PROFILES_DIR, time.strftime('%Y%m%d%H%M%S')+"_"+name+"_"+str(os.getpid())+"_"+str(next(PROFILE_NUMBERS))+"."+extension)
+
+
+def start_profiler():
+    """
+    Starts a deterministic profiler (cProfile) for the request of the current thread
+    Returns the profiler
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler, route):
+    """
+    Stops a request profiler and dumps its stats to a pstats file (e.g. for "python3 -m pstats" or snakeviz)
+    Returns the file name, or None if it failed
+    """
+    profiler.disable()
+    try:
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        profile_file = get_profile_file_name(route, "pstats")
+        profiler.dump_stats(profile_file)
+        return os.path.basename(profile_file)
+    except Exception as e:
+        logger.error("Can't write the request profile: "+str(e))
+        return None
+
+
+def sampler_loop():
+    """
+    Sampler thread loop (records the stack of each thread serving a sampled request, at a fixed rate)
+    """
+    while True:
+        time.sleep(SAMPLER_INTERVAL_SEC)
+        with SAMPLED_REQUESTS_LOCK:
+            sampled_requests = list(SAMPLED_REQUESTS.items())
+        if len(sampled_requests) == 0:
+            continue
+        frames = sys._current_frames()
+        for thread_id, stacks in sampled_requests:
+            frame = frames.get(thread_id)
+            stack = []
+            while frame != None:
+                stack.append(frame.f_code.co_name+" ("+os.path.basename(
+                    frame.f_code.co_filename)+":"+str(frame.f_code.co_firstlineno)+")")
+                frame = frame.f_back
+            if len(stack) > 0:
+                collapsed_stack = ";".join(reversed(stack))
+                stacks[collapsed_stack] = stacks.get(collapsed_stack, 0)+1
+
+
+def start_sampling():
+    """
+    Starts sampling the stack of the current thread (the sampler thread is started if needed)
+    """
+    global SAMPLER_THREAD
+    with SAMPLED_REQUESTS_LOCK:
+        SAMPLED_REQUESTS[threading.get_ident()] = {}
+        if SAMPLER_THREAD == None or not SAMPLER_THREAD.is_alive():
+            SAMPLER_THREAD = threading.Thread(
+                target=sampler_loop, name="RequestSampler", daemon=True)
+            SAMPLER_THREAD.start()
+
+
+def stop_sampling(route, duration, slowest):
+    """
+    Stops sampling the stack of the current thread, and keeps its profile if the request is one of the N slowest of this process
+    Profiles are written in the collapsed stack format (e.g. for speedscope or flamegraph.pl), and the ones that stop being among the slowest are deleted
+    Returns the file name, or None if the profile wasn't kept
+    """
+    with SAMPLED_REQUESTS_LOCK:
+        stacks = SAMPLED_REQUESTS.pop(threading.get_ident(), None)
+    if stacks == None or len(stacks) == 0:
+        return None
+    with SLOWEST_PROFILES_LOCK:
+        if len(SLOWEST_PROFILES) >= slowest and duration <= SLOWEST_PROFILES[0][0]:
+            return None
+        try:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            profile_file = get_profile_file_name(
+                route, "collapsed", duration=duration)
+            with open(profile_file, 'w') as file:
+                for collapsed_stack, count in stacks.items():
+                    file.write(collapsed_stack+" "+str(count)+"\n")
+        except Exception as e:
+            logger.error("Can't write the request profile: "+str(e))
+            return None
+        heapq.heappush(SLOWEST_PROFILES, (duration, profile_file))
+        while len(SLOWEST_PROFILES) > slowest:
+            faster_duration, faster_file = heapq.heappop(SLOWEST_PROFILES)
+            try:
+                os.remove(faster_file)
+            except:
+                pass
+    return os.path.basename(profile_file)
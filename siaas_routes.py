@@ -3,20 +3,144 @@
 # By João Pedro Seara, 2022-2024
 
 from __main__ import app, get_db_collection, get_db_collection_zap
-from flask import jsonify, request
+from flask import jsonify, request, Response, stream_with_context, g
 import configparser, os
+import logging
+import time
 import siaas_aux
+import siaas_cache
+import siaas_http
+import siaas_ingest
+import siaas_json
+import siaas_logging
+import siaas_metrics
+import siaas_mongo
+import siaas_platform
+import siaas_profiling
 
 
+logger = logging.getLogger(__name__)
+
 SIAAS_VERSION = "1.0.1"
 
-app.config['JSON_AS_ASCII'] = False
-app.config['JSON_SORT_KEYS'] = False
+# responses keep their key order and non-ASCII chars, and datetimes/ObjectIds are serialized natively
+app.json = siaas_json.SiaasJSONProvider(app)
 
 config = configparser.ConfigParser()
 config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf', 'zap_config.ini'))
 
 
+def stream_history_agent_data(agent_uid=None, module=None, limit_outputs=0, days=15, older_first=False, hide_empty=False, after=None, batch_size=500):
+    """
+    Streams historical agent data as NDJSON (one record per line, as the DB cursor produces them)
+    The last line has the status, the number of records and the cursor token for the next page
+    """
+    collection = get_db_collection()
+
+    def generate():
+        count = 0
+        last_id = None
+        status = "success"
+        try:
+            for r in siaas_aux.iter_history_agent_data(collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs,
+                                                       days=days, older_first=older_first, hide_empty=hide_empty, after=after, batch_size=batch_size):
+                count += 1
+                last_id = r["id"]
+                yield siaas_json.dumps_bytes(r)+b"\n"
+        except Exception as e:
+            logger.error(
+                "Can't stream data from the DB server: "+str(e))
+            status = "failure"
+        next_token = None
+        if status == "success" and limit_outputs > 0 and count >= limit_outputs:
+            next_token = last_id
+        yield siaas_json.dumps_bytes({'status': status, 'total_entries': count, 'next': next_token, 'time': siaas_aux.get_now_utc_str()})+b"\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Starts timing the request (and profiling it, if asked with "?profile=1" and allowed, or if the slowest requests are being profiled)
+    """
+    g.request_start = time.perf_counter()
+    siaas_profiling.start_request()
+    g.server_timing, profiling, g.profile_slowest = siaas_profiling.get_profiling_configs()
+    g.profiler = None
+    if profiling and request.args.get('profile', default=0, type=int) == 1:
+        g.profiler = siaas_profiling.start_profiler()
+    elif g.profile_slowest > 0:
+        siaas_profiling.start_sampling()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Counts the request and observes its duration, per route, and adds its timings to the Server-Timing header
+    Registered first, so it runs after all other response handlers (the response size is the final, compressed one)
+    """
+    if request.url_rule != None:
+        route = request.url_rule.rule
+    else:
+        route = "unmatched"
+    total, durations, counts = siaas_profiling.end_request()
+    profile_file = None
+    if g.get("profiler") != None:
+        profile_file = siaas_profiling.stop_profiler(g.profiler, route)
+    elif g.get("profile_slowest", 0) > 0 and total != None:
+        profile_file = siaas_profiling.stop_sampling(
+            route, total, g.profile_slowest)
+    if profile_file != None:
+        response.headers["X-Profile-File"] = profile_file
+    if g.get("server_timing") and total != None:
+        response.headers["Server-Timing"] = siaas_profiling.get_server_timing(
+            total, durations, counts, response.calculate_content_length())
+    siaas_metrics.increment("api_requests", route=route,
+                            method=request.method, status=str(response.status_code))
+    if g.get("request_start") != None:
+        siaas_metrics.observe("api_request_duration", time.perf_counter() -
+                              g.request_start, route=route, method=request.method)
+    return response
+
+
+@app.before_request
+def check_not_modified():
+    """
+    Answers 304 (without reading any data) if the client already has the current version of the requested output
+    """
+    g.etag = None
+    g.data_versions = None
+    g.encoding = siaas_http.get_accepted_encoding(request.accept_encodings)
+    if request.method != "GET" or request.url_rule == None:
+        return None
+    if request.args.get('stream', default=0, type=int) == 1:  # streamed outputs have no ETag
+        return None
+    # the data versions are also used to validate cached outputs
+    g.data_versions = siaas_http.get_route_data_versions(
+        get_db_collection(), request.url_rule.rule)
+    g.etag = siaas_http.get_etag(request.url_rule.rule, request.args,
+                                 request.view_args, g.encoding, g.data_versions)
+    if g.etag != None and request.if_none_match.contains_weak(g.etag):
+        response = app.response_class(status=304)
+        response.set_etag(g.etag)
+        response.vary.add("Accept-Encoding")
+        return response
+    return None
+
+
+@app.after_request
+def add_etag_and_compress(response):
+    """
+    Adds the ETag to successful outputs, and compresses them if the client accepts it
+    """
+    if response.status_code == 304:
+        return response
+    if g.get("etag") != None and response.status_code == 200:
+        response.set_etag(g.etag)
+    return siaas_http.compress_response(response, g.get("encoding"))
+
+
 @app.route('/', strict_slashes=False)
 def index():
     """
@@ -43,6 +167,23 @@ def index():
     ), ret_code
 
 
+@app.route('/metrics', methods=['GET'], strict_slashes=False)
+def metrics():
+    """
+    Server API route - metrics of all server processes, in the Prometheus text format
+    """
+    output, content_type = siaas_metrics.get_metrics_output()
+    if output == None:
+        return jsonify(
+            {
+                'output': "Metrics are not available (is the Prometheus client installed?)",
+                'status': "failure",
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), 500
+    return Response(output, content_type=content_type)
+
+
 @app.route('/siaas-server', methods=['GET'], strict_slashes=False)
 def siaas_server():
     """
@@ -54,19 +195,37 @@ def siaas_server():
         ip = request.remote_addr
     ret_code = 200
     module = request.args.get('module', default='*', type=str)
-    all_existing_modules = "platform,config"
-    siaas_aux.merge_configs_from_upstream(
-        upstream_dict=siaas_aux.get_dict_current_server_configs(get_db_collection()))
+    history = request.args.get('history', default=0, type=int)
+    view = request.args.get('format', default='legacy', type=str)
+    all_existing_modules = "platform,config,ingest,mongo,cache,logging"
+    # modules with in-memory data instead of a local DB
+    in_memory_modules = {"ingest": siaas_ingest.get_metrics, "mongo": siaas_mongo.get_pool_stats,
+                         "cache": siaas_cache.get_metrics, "logging": siaas_logging.get_metrics}
+    # the published server configs are merged to the local configs in the background by the config sync module
     for m in module.split(','):
         if m.strip() == "*":
             module = all_existing_modules
-    output = siaas_aux.merge_module_dicts(module)
+    file_modules = [m for m in module.split(',') if m.strip().lower()
+                    not in in_memory_modules.keys()]
+    output = {}
+    if len(file_modules) > 0:
+        output = siaas_aux.merge_module_dicts(",".join(file_modules))
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
         output = {}
     else:
         status = "success"
+        for m in module.split(','):
+            if m.strip().lower() in in_memory_modules.keys():
+                output[m.strip().lower()] = in_memory_modules[m.strip().lower()]()
+            if m.strip().lower() == "platform" and "platform" in output.keys() and view.lower() != "raw":
+                output["platform"] = siaas_platform.get_legacy_view(
+                    output["platform"])
+            if m.strip().lower() == "platform" and history > 0:  # statistics of the samples of the last N seconds
+                output.setdefault("platform", {})
+                output["platform"]["history"] = siaas_platform.get_history(
+                    window_sec=history)
     try:
         for k in output["config"].keys():
             if k.endswith("_pwd") or k.endswith("_passwd") or k.endswith("_password"):
@@ -161,7 +320,8 @@ def agents():
     ret_code = 200
     collection = get_db_collection()
     sort_by = request.args.get('sort', default="date", type=str)
-    output = siaas_aux.get_dict_active_agents(collection, sort_by=sort_by)
+    output = siaas_cache.read_through(siaas_cache.make_key("agents", sort=sort_by), siaas_http.ROUTE_DATA_SCOPES[request.url_rule.rule],
+                                      lambda: siaas_aux.get_dict_active_agents(collection, sort_by=sort_by), g.data_versions)
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
@@ -178,22 +338,60 @@ def agents():
     ), ret_code
 
 
-@app.route('/siaas-server/agents/data', methods=['GET'], strict_slashes=False)
+@app.route('/siaas-server/agents/data', methods=['GET', 'POST'], strict_slashes=False)
 def agents_data():
     """
-    Server API route - agents data
+    Server API route - agents data (POST uploads data from many agents at once)
     """
     if request.headers.getlist("X-Forwarded-For"):
         ip = request.headers.getlist("X-Forwarded-For")[0]
     else:
         ip = request.remote_addr
     ret_code = 200
+    collection = get_db_collection()
+    if request.method == 'POST':
+        content = request.json
+        output = siaas_aux.upload_agent_data_bulk(
+            collection, items=content, orig_ip=ip)
+        if type(output) == bool and output == False:
+            status = "failure"
+            ret_code = 500
+            output = []
+        else:
+            failed_count = len(
+                [r for r in output if r["status"] != "success"])
+            accepted_agents = set()
+            for r in output:
+                if r["status"] == "success":
+                    siaas_metrics.increment(
+                        "ingest_documents", agent=r["agent_uid"].lower())
+                    accepted_agents.add(r["agent_uid"].lower())
+            # The request body is counted once (under "bulk" when it carries data from more than one agent)
+            if len(accepted_agents) > 0:
+                siaas_metrics.increment("ingest_bytes", request.content_length or 0, agent=accepted_agents.pop(
+                ) if len(accepted_agents) == 1 else "bulk")
+            if failed_count == 0:
+                status = "success"
+            elif failed_count < len(output):
+                status = "partial"
+                ret_code = 207
+            else:
+                status = "failure"
+                ret_code = 500
+        return jsonify(
+            {
+                'output': output,
+                'status': status,
+                'total_entries': len(output),
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), ret_code
     module = request.args.get('module', default='*', type=str)
     for m in module.split(','):
         if m.strip() == "*":
             module = None
-    collection = get_db_collection()
-    output = siaas_aux.get_dict_current_agent_data(collection, module=module)
+    output = siaas_cache.read_through(siaas_cache.make_key("agents_data", module=module), siaas_http.ROUTE_DATA_SCOPES[request.url_rule.rule],
+                                      lambda: siaas_aux.get_dict_current_agent_data(collection, module=module), g.data_versions)
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
@@ -226,8 +424,8 @@ def agents_data_id(agent_uid):
         for m in module.split(','):
             if m.strip() == "*":
                 module = None
-        output = siaas_aux.get_dict_current_agent_data(
-            collection, agent_uid=agent_uid, module=module)
+        output = siaas_cache.read_through(siaas_cache.make_key("agents_data", agent_uid=agent_uid, module=module), siaas_http.ROUTE_DATA_SCOPES[request.url_rule.rule],
+                                          lambda: siaas_aux.get_dict_current_agent_data(collection, agent_uid=agent_uid, module=module), g.data_versions)
         if type(output) == bool and output == False:
             status = "failure"
             ret_code = 500
@@ -244,10 +442,40 @@ def agents_data_id(agent_uid):
         ), ret_code
     if request.method == 'POST':
         content = request.json
+        if siaas_ingest.is_enabled():  # write-behind: validate now, write later
+            record = siaas_aux.build_agent_data_record(
+                agent_uid=agent_uid, data_dict=content, orig_ip=ip)
+            if record == None:
+                status = "failure"
+                ret_code = 500
+                ingest_id = None
+            else:
+                ingest_id = siaas_ingest.submit(record)
+                if ingest_id == None:
+                    status = "failure"
+                    ret_code = 429
+                else:
+                    status = "accepted"
+                    ret_code = 202
+                    siaas_metrics.increment(
+                        "ingest_documents", agent=agent_uid.lower())
+                    siaas_metrics.increment(
+                        "ingest_bytes", request.content_length or 0, agent=agent_uid.lower())
+            return jsonify(
+                {
+                    'ingest_id': ingest_id,
+                    'status': status,
+                    'time': siaas_aux.get_now_utc_str()
+                }
+            ), ret_code
         output = siaas_aux.upload_agent_data(
             collection, agent_uid=agent_uid, data_dict=content, orig_ip=ip)
         if output:
             status = "success"
+            siaas_metrics.increment(
+                "ingest_documents", agent=agent_uid.lower())
+            siaas_metrics.increment(
+                "ingest_bytes", request.content_length or 0, agent=agent_uid.lower())
         else:
             status = "failure"
             ret_code = 500
@@ -289,8 +517,8 @@ def agents_configs():
     ret_code = 200
     collection = get_db_collection()
     merge_broadcast = request.args.get('merge_broadcast', default=0, type=int)
-    output = siaas_aux.get_dict_current_agent_configs(
-        collection, merge_broadcast=merge_broadcast)
+    output = siaas_cache.read_through(siaas_cache.make_key("agents_configs", merge_broadcast=merge_broadcast), siaas_http.ROUTE_DATA_SCOPES[request.url_rule.rule],
+                                      lambda: siaas_aux.get_dict_current_agent_configs(collection, merge_broadcast=merge_broadcast), g.data_versions)
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
@@ -321,8 +549,8 @@ def agents_configs_id(agent_uid):
     if request.method == 'GET':
         merge_broadcast = request.args.get(
             'merge_broadcast', default=0, type=int)
-        output = siaas_aux.get_dict_current_agent_configs(
-            collection, agent_uid=agent_uid, merge_broadcast=merge_broadcast)
+        output = siaas_cache.read_through(siaas_cache.make_key("agents_configs", agent_uid=agent_uid, merge_broadcast=merge_broadcast), siaas_http.ROUTE_DATA_SCOPES[request.url_rule.rule],
+                                          lambda: siaas_aux.get_dict_current_agent_configs(collection, agent_uid=agent_uid, merge_broadcast=merge_broadcast), g.data_versions)
         if type(output) == bool and output == False:
             status = "failure"
             ret_code = 500
@@ -388,26 +616,43 @@ def agents_history():
     sort_by = request.args.get('sort', default="date", type=str)
     older_first = request.args.get('older', default=0, type=int)
     hide_empty = request.args.get('hide', default=0, type=int)
+    # cursor token from the "next" field of the previous page
+    after = request.args.get('after', default=None, type=str)
+    # streams records as NDJSON instead of building the whole output
+    stream = request.args.get('stream', default=0, type=int)
     for m in module.split(','):
         if m.strip() == "*":
             module = None
     collection = get_db_collection()
     if limit_outputs < 0:
         limit_outputs = 0  # a negative value makes MongoDB behave differently. Let's avoid that
-    output = siaas_aux.get_dict_history_agent_data(
-        collection, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty)
+    if not siaas_aux.validate_cursor_token(after):  # client error, for both the paged and the streamed output
+        return jsonify(
+            {
+                'output': {},
+                'status': 'failure',
+                'error': 'invalid cursor token',
+                'total_entries': 0,
+                'next': None,
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), 400
+    if stream:
+        return stream_history_agent_data(agent_uid=None, module=module, limit_outputs=limit_outputs, days=days, older_first=older_first, hide_empty=hide_empty, after=after)
+    output, next_token = siaas_aux.get_dict_history_agent_data_page(
+        collection, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty, after=after)
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
         output = {}
     else:
         status = "success"
-
     return jsonify(
         {
             'output': output,
             'status': status,
             'total_entries': len(output),
+            'next': next_token,
             'time': siaas_aux.get_now_utc_str()
         }
     ), ret_code
@@ -430,14 +675,31 @@ def agents_history_id(agent_uid):
     sort_by = request.args.get('sort', default="date", type=str)
     older_first = request.args.get('older', default=0, type=int)
     hide_empty = request.args.get('hide', default=0, type=int)
+    # cursor token from the "next" field of the previous page
+    after = request.args.get('after', default=None, type=str)
+    # streams records as NDJSON instead of building the whole output
+    stream = request.args.get('stream', default=0, type=int)
     for m in module.split(','):
         if m.strip() == "*":
             module = None
     collection = get_db_collection()
     if limit_outputs < 0:
         limit_outputs = 0  # a negative value makes MongoDB behave differently. Let's avoid that
-    output = siaas_aux.get_dict_history_agent_data(
-        collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty)
+    if not siaas_aux.validate_cursor_token(after):  # client error, for both the paged and the streamed output
+        return jsonify(
+            {
+                'output': {},
+                'status': 'failure',
+                'error': 'invalid cursor token',
+                'total_entries': 0,
+                'next': None,
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), 400
+    if stream:
+        return stream_history_agent_data(agent_uid=agent_uid, module=module, limit_outputs=limit_outputs, days=days, older_first=older_first, hide_empty=hide_empty, after=after)
+    output, next_token = siaas_aux.get_dict_history_agent_data_page(
+        collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty, after=after)
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
@@ -449,6 +711,7 @@ def agents_history_id(agent_uid):
             'output': output,
             'status': status,
             'total_entries': len(output),
+            'next': next_token,
             'time': siaas_aux.get_now_utc_str()
         }
     ), ret_code
@@ -545,7 +808,8 @@ def get_zap_results():
     ret_code = 200
     collection_zap = get_db_collection_zap()
     if request.method == 'GET':
-        output = list(collection_zap.find({}, {'_id': 0}))
+        output = siaas_cache.read_through(siaas_cache.make_key("zap_results"), siaas_http.ROUTE_DATA_SCOPES[request.url_rule.rule],
+                                          lambda: list(collection_zap.find({}, {'_id': 0})), g.data_versions)
         if type(output) == bool and output == False:
             status = "failure"
             ret_code = 500
@@ -589,10 +853,12 @@ def get_zap_results_by_target(target):
     ret_code = 200
     collection_zap = get_db_collection_zap()
     if request.method == 'GET':
-        output = collection_zap.find_one({"target": target}, {'_id': 0})
+        output = siaas_cache.read_through(siaas_cache.make_key("zap_results", target=target), siaas_http.ROUTE_DATA_SCOPES[request.url_rule.rule],
+                                          lambda: collection_zap.find_one({"target": target}, {'_id': 0}), g.data_versions)
         if risk:
             risks = risk.split(',')
             filtered_alerts = [alert for alert in output['alerts'] if alert['risk'] in risks]
+            output = dict(output)  # the cached output is shared, so it's never changed in place
             output['alerts'] = filtered_alerts
         
         if type(output) == bool and output == False:
@@ -612,6 +878,8 @@ def get_zap_results_by_target(target):
         try:
             result = collection_zap.delete_one({"target": target})
             if result.deleted_count == 1:
+                siaas_aux.bump_data_versions(
+                    collection_zap, ["zap_results"])
                 status = "success"
                 ret_code = 200
             else:
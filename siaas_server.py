@@ -6,12 +6,11 @@ import os
 import sys
 import logging
 import time
-import multiprocessing_logging
-from logging.handlers import RotatingFileHandler
 from flask import Flask
 from flask_swagger_ui import get_swaggerui_blueprint
 from multiprocessing import Process
 from waitress import serve
+import socket
 
 app = Flask(__name__)
 logger = logging.getLogger(__name__)
@@ -19,6 +18,7 @@ logger = logging.getLogger(__name__)
 SIAAS_VERSION = "1.0.1"
 LOG_DIR = "log"
 API_PORT = 5000
+API_WORKER_CHECK_SEC = 5
 SWAGGER_URL = "/docs"  # route for exposing Swagger UI
 SWAGGER_JSON_URL = "/static/swagger_siaas_server.json"
 SWAGGER_APP_NAME = "SIAAS Server"
@@ -39,11 +39,61 @@ def get_db_collection_zap():
     """
     return DB_ZAP_COLLECTION_OBJ
 
+def get_api_serve_options():
+    """
+    Returns the API serving options (worker processes and waitress settings) from the configurations DB (or their defaults)
+    """
+    serve_options = {}
+    for (config_name, default) in [("api_workers", 1), ("api_threads", 4), ("api_connection_limit", 100), ("api_backlog", 1024), ("api_channel_timeout", 120)]:
+        try:
+            serve_options[config_name] = int(
+                siaas_aux.get_config_from_configs_db(config_name=config_name))
+            if serve_options[config_name] < 1:
+                raise ValueError("Value must be positive.")
+        except:
+            serve_options[config_name] = default
+    return serve_options
+
+def api_worker(sock, worker_num, serve_options):
+    """
+    API worker process (serves the API from a listening socket shared with the other workers)
+    The DB client from the parent process is not reused after fork, so each worker opens its own DB connection pool
+    """
+    global DB_COLLECTION_OBJ, DB_ZAP_COLLECTION_OBJ
+    DB_COLLECTION_OBJ = siaas_mongo.get_collection_from_config(
+        "mongo_collection")
+    DB_ZAP_COLLECTION_OBJ = siaas_mongo.get_collection_from_config(
+        "mongo_zap_collection")
+    if worker_num == 0:  # the first worker keeps the default spill file, so it's replayed after switching from a single process
+        siaas_ingest.start_from_config(DB_COLLECTION_OBJ)
+    else:
+        siaas_ingest.start_from_config(DB_COLLECTION_OBJ, spill_file=os.path.join(
+            sys.path[0], 'var/ingest_spill_'+str(worker_num)+'.ndjson'))
+    logger.info("API worker "+str(worker_num)+" starting ...")
+    serve(app, sockets=[sock], threads=serve_options["api_threads"], connection_limit=serve_options["api_connection_limit"],
+          backlog=serve_options["api_backlog"], channel_timeout=serve_options["api_channel_timeout"], ident="SIAAS Server")
+
+def start_api_worker(sock, worker_num, serve_options):
+    """
+    Starts an API worker process
+    Returns the process object
+    """
+    worker = Process(target=api_worker, name="API-Worker-"+str(worker_num), args=(
+        sock, worker_num, serve_options))
+    worker.start()
+    return worker
+
 if __name__ == "__main__":
 
     import siaas_aux
+    import siaas_configsync
     import siaas_dbmaintenance
+    import siaas_indexes
+    import siaas_ingest
+    import siaas_logging
     import siaas_mailer
+    import siaas_metrics
+    import siaas_mongo
     import siaas_platform
     import siaas_routes
 
@@ -66,6 +116,9 @@ if __name__ == "__main__":
     os.makedirs(os.path.join(sys.path[0], 'tmp'), exist_ok=True)
     os.makedirs(os.path.join(sys.path[0], 'var'), exist_ok=True)
 
+    # Clearing the metric values of the previous run (all processes write their values in this directory)
+    siaas_metrics.init_metrics_dir()
+
     # Deleting any existing databases leftovers
     old_dbs = os.listdir(os.path.join(sys.path[0], 'var/'))
     for db in old_dbs:
@@ -88,30 +141,6 @@ if __name__ == "__main__":
     siaas_aux.write_config_db_from_conf_file(
         output=os.path.join(sys.path[0], 'var/config_local.db'))
 
-    # Get all values
-    config_dict = siaas_aux.get_config_from_configs_db(convert_to_string=True)
-    MONGO_USER = None
-    MONGO_PWD = None
-    MONGO_HOST = None
-    MONGO_PORT = None
-    MONGO_DB = None
-    MONGO_COLLECTION = None
-    for config_name in config_dict.keys():
-        if config_name.upper() == "MONGO_USER":
-            MONGO_USER = config_dict[config_name]
-        if config_name.upper() == "MONGO_PWD":
-            MONGO_PWD = config_dict[config_name]
-        if config_name.upper() == "MONGO_HOST":
-            MONGO_HOST = config_dict[config_name]
-        if config_name.upper() == "MONGO_PORT":
-            MONGO_PORT = config_dict[config_name]
-        if config_name.upper() == "MONGO_DB":
-            MONGO_DB = config_dict[config_name]
-        if config_name.upper() == "MONGO_COLLECTION":
-            MONGO_COLLECTION = config_dict[config_name]
-        if config_name.upper() == "MONGO_ZAP_COLLECTION":
-            MONGO_ZAP_COLLECTION = config_dict[config_name]
-
     # Define logging level according to user config
     os.makedirs(os.path.join(sys.path[0], LOG_DIR), exist_ok=True)
     log_file = os.path.join(os.path.join(
@@ -119,15 +148,13 @@ if __name__ == "__main__":
     log_level = siaas_aux.get_config_from_configs_db(config_name="log_level")
     log_max_bytes = 10240000
     log_backup_count = 3
-    while len(logging.root.handlers) > 0:
-        logging.root.removeHandler(logging.root.handlers[-1])
     try:
-        logging.basicConfig(handlers=[RotatingFileHandler(os.path.join(sys.path[0], log_file), maxBytes=log_max_bytes, backupCount=log_backup_count)],
-                            format='%(asctime)s.%(msecs)03d %(levelname)-5s %(filename)s [%(processName)s|%(threadName)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=eval("logging."+log_level.upper()))
+        log_level = eval("logging."+log_level.upper())
     except:
-        logging.basicConfig(handlers=[RotatingFileHandler(os.path.join(sys.path[0], log_file), maxBytes=log_max_bytes, backupCount=log_backup_count)],
-                            format='%(asctime)s.%(msecs)03d %(levelname)-5s %(filename)s [%(processName)s|%(threadName)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
-    multiprocessing_logging.install_mp_handler()
+        log_level = logging.INFO
+    # all processes (forked afterwards) and threads put their records in a bounded queue, and a single thread of this process writes the log file
+    siaas_logging.start(os.path.join(sys.path[0], log_file), log_level=log_level,
+                        max_bytes=log_max_bytes, backup_count=log_backup_count)
 
     # Grabbing a unique system ID before proceeding
     server_uid = siaas_aux.get_or_create_unique_system_id()
@@ -136,16 +163,14 @@ if __name__ == "__main__":
             "Can't proceed without an unique system ID. Aborting !")
         sys.exit(1)
 
-    # Create connection to MongoDB
-    if len(MONGO_PORT or '') > 0:
-        mongo_host_port = MONGO_HOST+":"+MONGO_PORT
-    else:
-        mongo_host_port = MONGO_HOST
-    DB_COLLECTION_OBJ = siaas_aux.connect_mongodb_collection(MONGO_USER, MONGO_PWD, mongo_host_port, MONGO_DB, MONGO_COLLECTION)
-    DB_ZAP_COLLECTION_OBJ = siaas_aux.connect_mongodb_collection(MONGO_USER, MONGO_PWD, mongo_host_port, MONGO_DB, MONGO_ZAP_COLLECTION)
+    # Create connection to MongoDB (a single shared DB client for this process)
+    DB_COLLECTION_OBJ = siaas_mongo.get_collection_from_config(
+        "mongo_collection")
+    DB_ZAP_COLLECTION_OBJ = siaas_mongo.get_collection_from_config(
+        "mongo_zap_collection")
 
     # Check if DB is alive
-    if not siaas_aux.mongodb_ping(MONGO_USER, MONGO_PWD, mongo_host_port, MONGO_DB, MONGO_COLLECTION):
+    if not siaas_mongo.ping(*siaas_mongo.get_connection_details_from_config()):
         logger.critical(
             "DB is down. Aborting !")
         sys.exit(1)
@@ -154,13 +179,24 @@ if __name__ == "__main__":
     siaas_aux.merge_configs_from_upstream(
         upstream_dict=siaas_aux.get_dict_current_server_configs(DB_COLLECTION_OBJ))
 
-    # Create MongoDB indexes
-    DB_COLLECTION_OBJ.create_index(
-        "origin", unique=False, name="agent_origin_index")
-    DB_COLLECTION_OBJ.create_index(
-        "destiny", unique=False, name="agent_destiny_index")
-    DB_COLLECTION_OBJ.create_index(
-        "timestamp", unique=False, name="agent_timestamp_index")
+    # Populate the latest agent data snapshot collection if it's empty (e.g. first run after an upgrade)
+    try:
+        if siaas_aux.get_agent_latest_collection(DB_COLLECTION_OBJ).estimated_document_count() == 0:
+            siaas_aux.rebuild_agent_latest(DB_COLLECTION_OBJ)
+    except Exception as e:
+        logger.error(
+            "Couldn't check the latest agent data snapshot collection: "+str(e))
+
+    # Create or migrate MongoDB indexes
+    siaas_indexes.ensure_all_indexes(DB_COLLECTION_OBJ, DB_ZAP_COLLECTION_OBJ)
+
+    # Replay the ingest spill files left by a previous run (by any API worker, even if the ingest mode or the number of workers changed)
+    serve_options = get_api_serve_options()
+    siaas_ingest.replay_all_spill_files(DB_COLLECTION_OBJ)
+
+    # Start the write-behind ingest queue (only if configured; with many API workers, each worker starts its own)
+    if serve_options["api_workers"] == 1:
+        siaas_ingest.start_from_config(DB_COLLECTION_OBJ)
 
     print("\nSIAAS Server v"+SIAAS_VERSION +
           " starting ["+server_uid+"]\n\nLogging to: "+os.path.join(sys.path[0], log_file)+"\n")
@@ -168,23 +204,52 @@ if __name__ == "__main__":
 
     # Main logic
 
+    # Create the platform sample history (shared with the forked processes)
+    siaas_platform.init_history()
+
     platform = Process(target=siaas_platform.loop, args=(SIAAS_VERSION,))
     dbmaintenance = Process(target=siaas_dbmaintenance.loop, args=())
     mailer = Process(target=siaas_mailer.loop, args=())
+    configsync = Process(target=siaas_configsync.loop, args=())
 
     platform.start()
     dbmaintenance.start()
     mailer.start()
+    configsync.start()
 
     # give the modules some time to start before launching the API
     time.sleep(5)
     app.register_blueprint(get_swaggerui_blueprint(SWAGGER_URL, SWAGGER_JSON_URL, config={
                            'app_name': SWAGGER_APP_NAME, 'validatorUrl': 'none'}), url_prefix=SWAGGER_URL)
     #app.run(debug=True, use_reloader=False, host="127.0.0.1", port=API_PORT)
-    serve(app, host="127.0.0.1", port=API_PORT)
+    if serve_options["api_workers"] == 1:
+        serve(app, host="127.0.0.1", port=API_PORT, threads=serve_options["api_threads"], connection_limit=serve_options["api_connection_limit"],
+              backlog=serve_options["api_backlog"], channel_timeout=serve_options["api_channel_timeout"], ident="SIAAS Server")
+    else:
+        # pre-fork: all workers accept connections from the same listening socket
+        api_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        api_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        api_socket.bind(("127.0.0.1", API_PORT))
+        api_socket.listen(serve_options["api_backlog"])
+        logger.info("Serving the API with "+str(serve_options["api_workers"])+" worker processes of " +
+                    str(serve_options["api_threads"])+" threads each.")
+        api_workers = []
+        for worker_num in range(serve_options["api_workers"]):
+            api_workers.append(start_api_worker(
+                api_socket, worker_num, serve_options))
+        # workers that exit are restarted (a restarted worker replays its own spill file)
+        while True:
+            time.sleep(API_WORKER_CHECK_SEC)
+            for worker_num in range(len(api_workers)):
+                if not api_workers[worker_num].is_alive():
+                    logger.error("API worker "+str(worker_num)+" exited (exit code: "+str(
+                        api_workers[worker_num].exitcode)+"). Restarting it ...")
+                    api_workers[worker_num] = start_api_worker(
+                        api_socket, worker_num, serve_options)
 
     platform.join()
     dbmaintenance.join()
     mailer.join()
+    configsync.join()
 
     sys.exit(0)
@@ -0,0 +1,13 @@
+#!/bin/bash
+
+SCRIPT_DIR=$( cd -- "$( dirname -- "`readlink -f ${BASH_SOURCE[0]}`" )" &> /dev/null && pwd )
+
+if [[ $EUID -ne 0 ]]; then
+  echo "This script must be run as root or using sudo!"
+  exit 1
+fi
+
+cd ${SCRIPT_DIR}
+
+source ./venv/bin/activate
+python3 -u ./siaas_dbmaintenance.py rebuild_agent_latest
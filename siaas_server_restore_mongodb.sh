@@ -14,3 +14,6 @@ else
 fi
 
 mongorestore --nsInclude=siaas.* --drop --archive=${BACKUP_FILE}
+
+# Repopulate the latest agent data snapshot from the restored history
+${SCRIPT_DIR}/siaas_server_rebuild_agent_latest.sh